@@ -101,7 +101,8 @@ class MTreeGui:
         if self._tree.add(data):
             self._show_message(f'{data} added successfully')
         else:
-            self._show_message(f'{data} is already in the database')
+            # the same data can be added more times, the tree refused the object itself
+            messagebox.showerror('Error', f'{data} could not be added')
 
     def _on_remove_data(self):
         """
@@ -0,0 +1,84 @@
+"""
+Handles M-Tree storage of the GUI app, the tree is a DurableMTree kept in its store file & write-ahead log
+(every change is logged right away, closing the tree checkpoints only the changed nodes)
+"""
+import os
+
+from mtree.durable import DurableMTree
+from test.engine.generator import Generator
+from test.engine import parser
+from mtree.heuristics import *
+
+# sample data config
+STORE_DIR = 'stored/'
+STORE_FILE = 'sample.durable'
+STORE_PATH = STORE_DIR + STORE_FILE
+SAMPLE_DATA_DIR = 'test/datasets/'
+SAMPLE_DATA_FILE_NAME = 'sample_data.txt'
+SAMPLE_DATA_LINES = 10000
+SAMPLE_DATA_DIM = 3
+
+
+def _close_mtree(mtree):
+    """
+    Checkpoints changes of the M-Tree into its files, closes the tree
+    :type mtree: durable M-Tree
+    """
+    mtree.close()
+
+
+def _open_mtree(path):
+    """
+    Opens durable M-Tree, recovers it from the last checkpoint and the log
+    :param path: path to the store file
+    :return: recovered M-Tree
+    """
+    # functions are not saved, sample app uses default metrics, smart split is used for loaded trees
+    return DurableMTree(path, split_function=split_data_smart)
+
+
+def generate_sample():
+    """
+    Generates sample data, builds durable M-Tree of them (store file) to be loaded by a GUI app
+    """
+    # generate sample data
+    Generator().gen_data_file(SAMPLE_DATA_DIR, SAMPLE_DATA_FILE_NAME, SAMPLE_DATA_LINES, SAMPLE_DATA_DIM)
+    if not os.path.exists(STORE_DIR):
+        os.mkdir(STORE_DIR)
+    # build new M-Tree from the whole dataset at once (written to its files)
+    mtree = DurableMTree.bulk_load(STORE_PATH, parser.read_dataset(SAMPLE_DATA_DIR + SAMPLE_DATA_FILE_NAME),
+                                   split_function=split_data_smart)
+    _close_mtree(mtree)
+
+
+def new_mtree():
+    """
+    Creates new blank M-Tree in place of the saved one
+    :return: empty durable M-Tree
+    """
+    if not os.path.exists(STORE_DIR):
+        os.mkdir(STORE_DIR)
+    # drop the saved tree along with its log
+    for path in (STORE_PATH, STORE_PATH + '.wal'):
+        if os.path.exists(path):
+            os.remove(path)
+    return DurableMTree(STORE_PATH, dim=SAMPLE_DATA_DIM, split_function=split_data_perfect)
+
+
+def save_tree(mtree):
+    """
+    Saves M-Tree instance, only the changes since the last checkpoint are written (every change is logged already)
+    :param mtree: durable M-Tree instance
+    """
+    _close_mtree(mtree)
+
+
+def load_tree():
+    """
+    Opens the stored M-Tree (recovered from the store file & the log)
+    :return: durable M-Tree or None, when there is nothing to load
+    """
+    # check the path
+    if not os.path.exists(STORE_PATH):
+        return None
+    return _open_mtree(STORE_PATH)
@@ -1,5 +1,8 @@
 """
     Definitions of different metric objects
+
+    Entries are the most numerous objects of the tree (one per stored object), so they use slots
+    instead of instance dictionaries
 """
 
 
@@ -9,19 +12,23 @@ class _Entry:
     more info about routing and ground entries:
     https://www.sciencedirect.com/science/article/pii/S1570866708000786#bib015
     """
-    def __init__(self, data, r):
+    __slots__ = ('data', 'parent_dist')
+
+    def __init__(self, data, parent_dist):
         """
         :param data: data defining entry's position in the metric space
-        :param r: radius (range)
+        :param parent_dist: distance to parent
         """
         self.data = data
-        self.r = r
+        self.parent_dist = parent_dist
 
 
 class RoutingEntry(_Entry):
     """
     Represents routing entry in any non-leaf object
     """
+    __slots__ = ('r', 'node')
+
     def __init__(self, subtree, data=None, r: float = 0, parent_dist: float = 0):
         """
         :type subtree: pointer to subtree node
@@ -29,31 +36,94 @@ class RoutingEntry(_Entry):
         :param r: radius (range)
         :param parent_dist: distance to parent
         """
-        super(RoutingEntry, self).__init__(data, r)
-        self.parent_dist = parent_dist
+        super(RoutingEntry, self).__init__(data, parent_dist)
+        self.r = r
         self.node = subtree
 
     def __str__(self):
         # display only the subtree
         return str(self.node)
 
+    def new_entry(self, subtree, data, r: float = 0, parent_dist: float = 0):
+        """
+        Creates routing entry of the same kind (used when the subtree is split)
+        :return: new routing entry pointing to the subtree
+        """
+        return RoutingEntry(subtree=subtree, data=data, r=r, parent_dist=parent_dist)
+
+    def release(self):
+        """
+        Called when the entry is removed from the tree along with its subtree node
+        """
+        pass
+
+
+class PagedRoutingEntry(RoutingEntry):
+    """
+    Represents routing entry pointing to a subtree node stored in a page, the node is loaded on demand
+    """
+    # the node slot of the base class stays empty, the node property below shadows it
+    __slots__ = ('_pool', 'page_id')
+
+    def __init__(self, pool, subtree=None, data=None, r: float = 0, parent_dist: float = 0, page_id: int = None):
+        """
+        :param pool: buffer pool the pages are loaded through
+        :param subtree: pointer to subtree node (new nodes only, stored to a new page)
+        :param data: metric data
+        :param r: radius (range)
+        :param parent_dist: distance to parent
+        :param page_id: page of the subtree node (nodes already stored only)
+        """
+        self._pool = pool
+        self.page_id = page_id
+        super(PagedRoutingEntry, self).__init__(subtree, data, r, parent_dist)
+
+    @property
+    def node(self):
+        """
+        :return: subtree node, loaded from its page when it is not in the buffer pool
+        """
+        return self._pool.get(self.page_id)
+
+    @node.setter
+    def node(self, subtree):
+        # entries loaded from a page only know the page of their subtree
+        if subtree is not None:
+            self.page_id = self._pool.put(subtree)
+
+    def new_entry(self, subtree, data, r: float = 0, parent_dist: float = 0):
+        """
+        Creates routing entry of the same kind (used when the subtree is split)
+        :return: new routing entry pointing to the subtree (stored to a new page)
+        """
+        return PagedRoutingEntry(self._pool, subtree=subtree, data=data, r=r, parent_dist=parent_dist)
+
+    def release(self):
+        """
+        Called when the entry is removed from the tree along with its subtree node, frees the page
+        """
+        self._pool.free(self.page_id)
+
 
 class GroundEntry(_Entry):
     """
     Represents ground entry in leafs
     """
+    __slots__ = ('oid', 'payload')
+    # ground entries are points, their radius is always zero (shared, not stored per entry)
+    r = 0
 
-    def __init__(self, oid=0, data=None, r: float = 0, parent_dist: float = 0):
+    def __init__(self, oid=0, data=None, parent_dist: float = 0, payload=None):
         """
         Initializes new instance of ground entry object
-        :param oid: external identifier of original object
+        :param oid: external identifier of original object (integer)
         :param data: metric data
-        :param r: radius (range)
         :param parent_dist: distance to parent
+        :param payload: any object attached to the data (optional)
         """
-        super(GroundEntry, self).__init__(data, r)
+        super(GroundEntry, self).__init__(data, parent_dist)
         self.oid = oid
-        self.parent_dist = parent_dist
+        self.payload = payload
 
     def __str__(self):
         # display only the data
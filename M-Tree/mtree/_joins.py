@@ -0,0 +1,265 @@
+"""
+    Similarity join and kNN graph, both traverse pairs of subtrees together
+
+    A pair of nodes is pruned as a whole when their covering radii can't get close enough, stored distances
+    to the parents prune pairs of entries before their distance is counted
+"""
+
+from mtree._nodes import Leaf
+from mtree._queries import NearestCollector, PendingQueue
+from mtree.heuristics import SortableData, SimilarPair
+
+
+class SimilarityJoin:
+    """
+    Finds all pairs of objects within a fixed range, one object of each pair from each of the trees
+    (self-join of a single tree reports each pair once, never an object with itself)
+    """
+
+    def __init__(self, r, dist_function, stats, same: bool):
+        """
+        :param r: maximal distance of the objects of a pair
+        :param dist_function: distance function of the trees
+        :param stats: stats of the join
+        :param same: both trees are the same one
+        """
+        self.r = r
+        self.dist_function = dist_function
+        self.stats = stats
+        self.same = same
+        self.pairs = []
+
+    def join(self, node_a, node_b, d_ab):
+        """
+        Collects all pairs of objects of the two subtrees which are close enough
+        :param node_a: subtree of the first tree
+        :param node_b: subtree of the second tree
+        :param d_ab: distance between the centers of the nodes
+        """
+        self.stats.nodes_visited += 1
+        if self.same and node_a is node_b:
+            # self-join of a single subtree
+            if isinstance(node_a, Leaf):
+                self._join_leaf_itself(node_a)
+            else:
+                self._join_node_itself(node_a)
+        elif isinstance(node_a, Leaf) and isinstance(node_b, Leaf):
+            self._join_leafs(node_a, node_b, d_ab)
+        elif isinstance(node_a, Leaf):
+            # leaf is paired with each of the subtrees of the other node
+            for entry, d in self._reachable(node_b, d_ab, node_a):
+                self.join(node_a, entry.node, d)
+        elif isinstance(node_b, Leaf):
+            for entry, d in self._reachable(node_a, d_ab, node_b):
+                self.join(entry.node, node_b, d)
+        else:
+            self._join_nodes(node_a, node_b, d_ab)
+
+    def _reachable(self, node, d_node, other) -> list:
+        """
+        :param node: non-leaf node whose subtrees are paired with the other node
+        :param d_node: distance between the centers of the nodes
+        :param other: the other node
+        :return: list of (routing entry, distance to the center of the other node) pairs of subtrees
+        which can contain an object close enough to the other node
+        """
+        # distance between the center of the other node and each entry is at least |d_node - parent distance|
+        candidates = [entry for entry in node._entries
+                      if abs(d_node - entry.parent_dist) - entry.r - other.r <= self.r]
+        self.stats.pruned_parent_dist += len(node._entries) - len(candidates)
+        reachable = []
+        for entry, d in zip(candidates, self.dist_function.one_to_many(other.data,
+                                                                       [entry.data for entry in candidates])):
+            if d - entry.r - other.r > self.r:
+                self.stats.pruned_radius += 1
+                continue
+            reachable.append((entry, d))
+        return reachable
+
+    def _join_nodes(self, node_a, node_b, d_ab):
+        """
+        Pairs subtrees of two different non-leaf nodes
+        """
+        entries_a = [entry for entry in node_a._entries
+                     if abs(d_ab - entry.parent_dist) - entry.r - node_b.r <= self.r]
+        entries_b = [entry for entry in node_b._entries
+                     if abs(d_ab - entry.parent_dist) - entry.r - node_a.r <= self.r]
+        self.stats.pruned_parent_dist += len(node_a._entries) - len(entries_a) + \
+            len(node_b._entries) - len(entries_b)
+        if len(entries_a) == 0 or len(entries_b) == 0:
+            return
+        matrix = self.dist_function.many_to_many([entry.data for entry in entries_a],
+                                                 [entry.data for entry in entries_b])
+        for entry_a, distances in zip(entries_a, matrix):
+            for entry_b, d in zip(entries_b, distances):
+                if d - entry_a.r - entry_b.r > self.r:
+                    self.stats.pruned_radius += 1
+                    continue
+                self.join(entry_a.node, entry_b.node, d)
+
+    def _join_node_itself(self, node):
+        """
+        Pairs subtrees of a single non-leaf node (each subtree with itself and with the subtrees after it)
+        """
+        entries = node._entries
+        for i, entry in enumerate(entries):
+            self.join(entry.node, entry.node, 0)
+            # both entries store distances to the same center
+            others = [other for other in entries[i + 1:]
+                      if abs(entry.parent_dist - other.parent_dist) - entry.r - other.r <= self.r]
+            self.stats.pruned_parent_dist += len(entries) - i - 1 - len(others)
+            for other, d in zip(others, self.dist_function.one_to_many(entry.data,
+                                                                       [other.data for other in others])):
+                if d - entry.r - other.r > self.r:
+                    self.stats.pruned_radius += 1
+                    continue
+                self.join(entry.node, other.node, d)
+
+    def _join_leafs(self, leaf_a, leaf_b, d_ab):
+        """
+        Pairs objects of two different leafs
+        """
+        objects_a = [i for i, parent_dist in enumerate(leaf_a._dists) if abs(d_ab - parent_dist) - leaf_b.r <= self.r]
+        objects_b = [j for j, parent_dist in enumerate(leaf_b._dists) if abs(d_ab - parent_dist) - leaf_a.r <= self.r]
+        self.stats.pruned_parent_dist += len(leaf_a) - len(objects_a) + len(leaf_b) - len(objects_b)
+        if len(objects_a) == 0 or len(objects_b) == 0:
+            return
+        matrix = self.dist_function.many_to_many([leaf_a._data[i] for i in objects_a],
+                                                 [leaf_b._data[j] for j in objects_b])
+        for i, distances in zip(objects_a, matrix):
+            for j, d in zip(objects_b, distances):
+                if d > self.r:
+                    continue
+                first, second = _found(leaf_a, i, d), _found(leaf_b, j, d)
+                # pairs of self-join are ordered by the object ids
+                if self.same and second.oid < first.oid:
+                    first, second = second, first
+                self.pairs.append(SimilarPair(first=first, second=second, d=d))
+
+    def _join_leaf_itself(self, leaf):
+        """
+        Pairs objects of a single leaf (each object with the objects after it)
+        """
+        dists = leaf._dists
+        for i in range(len(leaf)):
+            # both objects store distances to the same center
+            others = [j for j in range(i + 1, len(leaf)) if abs(dists[i] - dists[j]) <= self.r]
+            self.stats.pruned_parent_dist += len(leaf) - i - 1 - len(others)
+            for j, d in zip(others, self.dist_function.one_to_many(leaf._data[i], [leaf._data[j] for j in others])):
+                if d <= self.r:
+                    # lower object id goes first
+                    first, second = (i, j) if leaf._oids[i] <= leaf._oids[j] else (j, i)
+                    self.pairs.append(SimilarPair(first=_found(leaf, first, d), second=_found(leaf, second, d), d=d))
+
+
+def knn_graph(root, k, dist_function, stats) -> dict:
+    """
+    Finds k nearest neighbours of each object of the tree (the object itself excluded)
+    Objects of each leaf are searched together, a subtree is only searched when it can improve the k-th distance
+    of some object of the leaf (bounded using the distance between the centers and the parent distances of the objects)
+    :param root: root of the tree
+    :param k: number of neighbours
+    :param dist_function: distance function of the tree
+    :param stats: stats of the search
+    :return: dictionary of object id -> sorted list of the nearest objects
+    """
+    graph = {}
+    for leaf in _leafs(root):
+        collectors = [NearestCollector(k, stats=stats) for _ in range(len(leaf))]
+        pending = PendingQueue()
+        d = dist_function(leaf.data, root.data)
+        pending.push(max(d - leaf.r - root.r, 0), root, d)
+        # always expand the subtree with the lowest distance bound first (the leaf itself goes among the first)
+        while len(pending) > 0:
+            d_min, node, d = pending.pop()
+            bound = max(collector.radius for collector in collectors)
+            # remaining subtrees are too far for any object of the leaf
+            if d_min > bound:
+                stats.pruned_radius += len(pending) + 1
+                break
+            # radii of the objects might have shrunk since the subtree was enqueued
+            if _lower_bound(leaf, collectors, d, node.r) is None:
+                stats.pruned_radius += 1
+                continue
+            stats.nodes_visited += 1
+            if isinstance(node, Leaf):
+                _nearest_in_leaf(leaf, node, d, collectors, dist_function, stats)
+                continue
+            # distance between the center of the leaf and each entry is at least |d - parent distance|
+            candidates = [entry for entry in node._entries
+                          if abs(d - entry.parent_dist) - entry.r - leaf.r <= bound]
+            stats.pruned_parent_dist += len(node._entries) - len(candidates)
+            for entry, d_entry in zip(candidates, dist_function.one_to_many(leaf.data,
+                                                                           [entry.data for entry in candidates])):
+                d_min = _lower_bound(leaf, collectors, d_entry, entry.r)
+                if d_min is None:
+                    stats.pruned_radius += 1
+                    continue
+                pending.push(d_min, entry.node, d_entry)
+        for i, collector in enumerate(collectors):
+            graph[leaf._oids[i]] = collector.result()
+    stats.queries = len(graph)
+    return graph
+
+
+def _lower_bound(leaf, collectors, d, r):
+    """
+    :param leaf: leaf whose objects are searched for
+    :param collectors: collectors of the objects of the leaf
+    :param d: distance between the center of the leaf and the center of a subtree
+    :param r: covering radius of the subtree
+    :return: lowest distance bound between any object of the leaf and any object of the subtree,
+    None when the subtree can't improve the result of any object of the leaf
+    """
+    d_min = None
+    for parent_dist, collector in zip(leaf._dists, collectors):
+        # distance between the object and the center of the subtree is at least |d - parent distance|
+        d_object = max(abs(d - parent_dist) - r, 0)
+        if d_object <= collector.radius and (d_min is None or d_object < d_min):
+            d_min = d_object
+    return d_min
+
+
+def _nearest_in_leaf(leaf, other, d_leafs, collectors, dist_function, stats):
+    """
+    Offers objects of the other leaf to the collectors of the objects of the leaf
+    :param leaf: leaf whose objects are searched for
+    :param other: leaf whose objects are offered (can be the same one)
+    :param d_leafs: distance between the centers of the leafs
+    :param collectors: collectors of the objects of the leaf
+    """
+    for i, collector in enumerate(collectors):
+        # distance between the object and the center of the other leaf is at least |d_leafs - parent distance|
+        if abs(d_leafs - leaf._dists[i]) - other.r > collector.radius:
+            stats.pruned_parent_dist += len(other)
+            continue
+        # actual distance to the center prunes the objects of the other leaf by their parent distances
+        d = leaf._dists[i] if other is leaf else dist_function(leaf._data[i], other.data)
+        radius = collector.radius
+        if d - other.r > radius:
+            stats.pruned_radius += len(other)
+            continue
+        candidates = [j for j, parent_dist in enumerate(other._dists)
+                      if abs(d - parent_dist) <= radius and not (other is leaf and j == i)]
+        stats.pruned_parent_dist += len(other) - len(candidates)
+        for j, d in zip(candidates, dist_function.one_to_many(leaf._data[i], [other._data[j] for j in candidates])):
+            other._offer(collector, j, d)
+
+
+def _leafs(node):
+    """
+    :return: generator of all the leafs of the subtree
+    """
+    if isinstance(node, Leaf):
+        yield node
+        return
+    for entry in node._entries:
+        yield from _leafs(entry.node)
+
+
+def _found(leaf, i: int, d) -> SortableData:
+    """
+    :return: i-th object of the leaf along with the distance
+    """
+    return SortableData(data=leaf._data[i], d=d, oid=leaf._oids[i],
+                        payload=None if leaf._payloads is None else leaf._payloads[i])
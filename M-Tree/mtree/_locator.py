@@ -0,0 +1,49 @@
+"""
+    Index of leafs the objects are stored in, used for targeted deletion
+"""
+
+from mtree._entries import GroundEntry
+
+
+class Locator:
+    """
+    Maps object ids of all objects to the leafs storing them, keeps back-pointers of nodes to their parents
+
+    Nodes report every entry they receive (see _Node.attach()), so the map follows insertions, splits and
+    rebalancing after deletions
+    """
+
+    def __init__(self):
+        # object id -> leaf
+        self._leafs = {}
+
+    def __len__(self):
+        return len(self._leafs)
+
+    def __contains__(self, oid):
+        return oid in self._leafs
+
+    def attach(self, node, entry):
+        """
+        Records that the entry is stored in the node
+        :param node: node the entry has been stored in
+        :param entry: ground entry or routing entry (its subtree gets the node as its parent)
+        """
+        if isinstance(entry, GroundEntry):
+            self._leafs[entry.oid] = node
+        else:
+            entry.node.parent = node
+
+    def leaf_of(self, oid):
+        """
+        :param oid: object id of an object
+        :return: leaf storing the object (None when there is no such object)
+        """
+        return self._leafs.get(oid)
+
+    def discard(self, oid):
+        """
+        Forgets the object (when it's deleted)
+        :param oid: object id of the object
+        """
+        self._leafs.pop(oid, None)
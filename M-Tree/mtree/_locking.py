@@ -0,0 +1,136 @@
+"""
+    Reader/writer lock of a tree, any number of queries run together, modifications run alone
+"""
+
+import functools
+import threading
+
+
+class ReadWriteLock:
+    """
+    Shared lock for reading, exclusive lock for writing
+
+    Waiting writers go before new readers (writers are not starved by a steady stream of queries)
+    Both locks are reentrant, the writer can read too, a reader can't start writing (RuntimeError is raised,
+    it would wait for itself forever)
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition(threading.Lock())
+        # number of threads reading
+        self._readers = 0
+        # thread writing, number of its nested writes
+        self._writer = None
+        self._writes = 0
+        # number of threads waiting to write
+        self._waiting = 0
+        # reads held by the current thread
+        self._local = threading.local()
+        # number of writes so far (changes whenever the tree might have changed)
+        self.version = 0
+
+    def acquire_read(self):
+        """
+        Waits until there is no writer (running or waiting)
+        """
+        held = getattr(self._local, 'reads', 0)
+        if held > 0:
+            # nested read never waits (a waiting writer would wait for this thread)
+            self._local.reads = held + 1
+            return
+        if self._writer == threading.get_ident():
+            # the writer reads what it has written, not counted as a reader
+            self._local.reads, self._local.shared = 1, False
+            return
+        with self._condition:
+            while self._writer is not None or self._waiting > 0:
+                self._condition.wait()
+            self._readers += 1
+        self._local.reads, self._local.shared = 1, True
+
+    def release_read(self):
+        self._local.reads -= 1
+        if self._local.reads > 0 or not self._local.shared:
+            return
+        with self._condition:
+            self._readers -= 1
+            if self._readers == 0:
+                self._condition.notify_all()
+
+    def acquire_write(self):
+        """
+        Waits until all the readers and the other writer finish
+        """
+        me = threading.get_ident()
+        if self._writer == me:
+            self._writes += 1
+            return
+        if getattr(self._local, 'reads', 0) > 0:
+            raise RuntimeError('M-Tree can not be modified by a thread reading it')
+        with self._condition:
+            self._waiting += 1
+            while self._writer is not None or self._readers > 0:
+                self._condition.wait()
+            self._waiting -= 1
+            self._writer, self._writes = me, 1
+            self.version += 1
+
+    def release_write(self):
+        self._writes -= 1
+        if self._writes > 0:
+            return
+        with self._condition:
+            self._writer = None
+            self._condition.notify_all()
+
+    def reading(self):
+        """
+        :return: context manager holding the lock for reading
+        """
+        return _Held(self.acquire_read, self.release_read)
+
+    def writing(self):
+        """
+        :return: context manager holding the lock for writing
+        """
+        return _Held(self.acquire_write, self.release_write)
+
+
+class _Held:
+    """
+    Holds a lock within a with statement
+    """
+
+    __slots__ = ('_acquire', '_release')
+
+    def __init__(self, acquire, release):
+        self._acquire = acquire
+        self._release = release
+
+    def __enter__(self):
+        self._acquire()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._release()
+
+
+def read_locked(method):
+    """
+    Runs the method of the tree holding its lock for reading
+    """
+    @functools.wraps(method)
+    def locked(self, *args, **kwargs):
+        with self._lock.reading():
+            return method(self, *args, **kwargs)
+    return locked
+
+
+def write_locked(method):
+    """
+    Runs the method of the tree holding its lock for writing
+    """
+    @functools.wraps(method)
+    def locked(self, *args, **kwargs):
+        with self._lock.writing():
+            return method(self, *args, **kwargs)
+    return locked
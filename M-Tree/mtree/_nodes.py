@@ -2,9 +2,11 @@
     Definitions of M-Tree nodes
 """
 
+from array import array
+
 from mtree._entries import GroundEntry, RoutingEntry
+from mtree._vectorized import np, as_matrix
 from mtree.heuristics import *
-from heapq import merge
 
 
 class _Node:
@@ -13,15 +15,19 @@ class _Node:
 
     Abstract metric space object, contains set of other metric space objects (entries)
     """
+    __slots__ = ('dist_function', 'data', 'split_function', 'r', 'capacity', 'locator', 'parent', 'epoch', 'stored_at')
 
-    def __init__(self, entries, data, dist_function, split_function, r=0, capacity=CAPACITY_DFLT):
+    def __init__(self, entries, data, dist_function, split_function, r=0, capacity=CAPACITY_DFLT, locator=None,
+                 epoch: int = 0):
         """
-        :param entries: dictionary of entries the node stores (can be None or empty)
+        :param entries: list of entries the node stores (can be None or empty)
         :param data: data defining node's position in the metric space
         :type dist_function: determines distance between two data objects
         :type split_function: function used to split the node in half in case of overflow
         :param r: range (radius)
         :param capacity: maximal number of entries the node can store
+        :param locator: index of leafs storing the objects (optional)
+        :param epoch: snapshot epoch of the tree the node was created in (see MTree.snapshot())
         """
         self.dist_function = dist_function
         self._entries = entries
@@ -29,13 +35,28 @@ class _Node:
         self.split_function = split_function
         self.r = r
         self.capacity = capacity
+        self.locator = locator
+        # parent node (only kept up to date when there is a locator)
+        self.parent = None
+        # nodes of older epochs than the tree are shared with snapshots, they must not be modified
+        self.epoch = epoch
+        # position of the node in the store file of a durable tree, None until the node is checkpointed
+        self.stored_at = None
+        if entries:
+            self.attach(entries)
+
+    def __len__(self):
+        """
+        :return: number of entries stored in the node
+        """
+        return len(self._entries)
 
     def __str__(self):
         """
         :return: Returns printable representation of the node
         """
         s = f'Node({len(self._entries)}): <'
-        for i, e in enumerate(self._entries.values()):
+        for i, e in enumerate(self._entries):
             s += f'{i}: {e} '
         s += '>'
         return s
@@ -45,34 +66,89 @@ class _Node:
         :param max_capacity: maximal number of records the node can contain
         :return: True when number of objects is higher than the capacity of the node, otherwise False
         """
-        return len(self._entries) > max_capacity
+        return len(self) > max_capacity
 
     def is_underflowed(self, min_capacity: int = 2):
         """
         :param min_capacity: minimal number of records the node must contain
         :return: Returns true when there is less than two objects in the node, otherwise False
         """
-        return len(self._entries) < min_capacity
+        return len(self) < min_capacity
 
     def get_split_data(self) -> (DataPartition, DataPartition):
         """
         :return: Two new partitions which together contain all the routing entries of the caller node
         """
-        # split the routing objects into two partitions
-        return self.split_function(self._entries)
+        # split the routing objects into two partitions, using the same metrics as the tree does
+        return self.split_function(self._entries, self.dist_function)
+
+    def attach(self, entries):
+        """
+        Reports entries stored in the node to the locator (when there is one)
+        :param entries: entries just stored in the node
+        """
+        if self.locator is not None:
+            for entry in entries:
+                self.locator.attach(self, entry)
+
+    def adopt(self, entries: list):
+        """
+        Moves entries of another node into this one, updates their parent distances and the radius
+        :param entries: entries to be moved (already removed from their original node)
+        """
+        distances = self.dist_function.one_to_many(self.data, [entry.data for entry in entries])
+        for entry, d in zip(entries, distances):
+            entry.parent_dist = d
+            self._entries.append(entry)
+            # whole subtree of the entry has to fit into the node
+            self.r = max(self.r, d + entry.r)
+        self.attach(entries)
+
+    def detach(self, entry):
+        """
+        Removes the entry from the node (without releasing its subtree)
+        :param entry: entry to be removed
+        :return: removed entry
+        """
+        self._entries.remove(entry)
+        return entry
+
+    def shrink(self):
+        """
+        Tightens the radius so it just covers the entries (and their subtrees)
+        """
+        self.r = max((entry.parent_dist + entry.r for entry in self._entries), default=0)
+
+    def copy(self, epoch: int):
+        """
+        :param epoch: epoch of the copy
+        :return: copy of the node with copies of the routing entries (the subtrees are shared)
+        """
+        return type(self)(entries=[RoutingEntry(subtree=entry.node, data=entry.data, r=entry.r,
+                                                parent_dist=entry.parent_dist) for entry in self._entries],
+                          data=self.data,
+                          dist_function=self.dist_function,
+                          split_function=self.split_function,
+                          r=self.r,
+                          capacity=self.capacity,
+                          locator=self.locator,
+                          epoch=epoch)
 
 
 class _NodeInternal(_Node):
     """
     Non-trivial node (Not a leaf, either root or router)
     """
+    # leafs keep their entries in columns instead (see Leaf._entries)
+    __slots__ = ('_entries',)
 
-    def add(self, data) -> bool:
+    def add(self, ground: GroundEntry) -> bool:
         """
         Picks best routing object, adds data into its subtree
-        :param data: data to be added
+        :param ground: ground entry of the data to be added
         :return: success
         """
+        data = ground.data
         # pick routing object data fits into the best
         best = None
         # distance from the best node
@@ -80,63 +156,151 @@ class _NodeInternal(_Node):
         # range the best node has to be adjusted to
         adjust = INFINITY
 
+        # calculate distances to all routing objects at once
+        distances = self.dist_function.one_to_many(data, [entry.data for entry in self._entries])
         # go through all routing objects
-        for entry_key in self._entries:
-            # calculate distance
-            d = self.dist_function(data, entry_key)
+        for entry, d in zip(self._entries, distances):
             # calculate distance from routing entry's border
-            if d - self._entries[entry_key].r > 0:
+            if d - entry.r > 0:
                 # data object doesn't fit into current routing entry
                 if best is None or (d < adjust and from_best == INFINITY):
-                    best = self._entries[entry_key]
+                    best = entry
                     adjust = d
             else:
                 # data object fits into current routing entry
                 if best is None or d < from_best:
-                    best = self._entries[entry_key]
+                    best = entry
                     from_best = d
 
         # best entry is now saved in 'best', no matter whether the data object fits into any routing entry or not
+        node = self.own(best)
         if from_best == INFINITY:
             # data object doesn't fit, update r of the best node first
-            best.node.r = adjust
+            node.r = adjust
             best.r = adjust
         # add to the best node found
-        success = best.node.add(data)
+        success = node.add(ground)
         # check node capacity
-        if best.node.is_overflowed(self.capacity):
+        if node.is_overflowed(self.capacity):
             # split node into two
             self.balance_subtree_overflowed(best)
         return success
 
-    def search(self, data, d_parent, r, k=INFINITY) -> list:
+    def search(self, data, d_parent, collector):
         """
         Searches all routing objects & find all objects with defined similarity to the data
         :param data: query data
-        :param r: range (dissimilarity)
         :param d_parent: distance between the data and the parent node (self)
-        :param k: maximum number of elements to search for
-        :return: sorted list of all r-similar objects in this node with max size of k
-        """
-        in_range = []
-        # go through all rooting objects
-        for entry_key in self._entries:
-            # try to avoid counting the distance by triangular comparison of distances to the parent
-            d_diff = abs(self._entries[entry_key].parent_dist - d_parent)
-            r_sum = r + self._entries[entry_key].r
-            if d_diff <= r_sum:
-                # count actual distance
-                d = self.dist_function(data, entry_key)
+        :param collector: collector of found objects, its radius defines the dissimilarity
+        """
+        stats = collector.stats
+        stats.nodes_visited += 1
+        # try to avoid counting the distances by triangular comparison of distances to the parent
+        candidates = [entry for entry in self._entries
+                      if abs(entry.parent_dist - d_parent) <= collector.radius + entry.r]
+        stats.pruned_parent_dist += len(self._entries) - len(candidates)
+        # count actual distances of all remaining routing objects at once
+        for entry, d in zip(candidates, self.dist_function.one_to_many(data, [entry.data for entry in candidates])):
+            # check whether the subtree intersects with the query or not
+            # (radius might shrink while searching when the number of objects is limited)
+            if d > collector.radius + entry.r:
+                stats.pruned_radius += 1
+                continue
+            # collect data from the subtree when it fits
+            entry.node.search(data, d, collector)
+
+    def search_nearest(self, data, d_parent, pending, nearest):
+        """
+        Enqueues all subtrees which can still contain some of the k nearest objects
+        :param data: query data
+        :param d_parent: distance between the data and the parent node (self)
+        :param pending: priority queue of subtrees waiting to be searched
+        :param nearest: collector of the nearest objects found so far
+        """
+        stats = nearest.stats
+        stats.nodes_visited += 1
+        # try to avoid counting the distances by triangular comparison of distances to the parent
+        # (approximate search prunes with a smaller bound than the search radius)
+        candidates = []
+        for entry in self._entries:
+            d_min = abs(entry.parent_dist - d_parent) - entry.r
+            if d_min > nearest.bound:
+                nearest.skip(d_min)
+                stats.pruned_parent_dist += 1
+            else:
+                candidates.append(entry)
+        # count actual distances of all remaining routing objects at once
+        for entry, d in zip(candidates, self.dist_function.one_to_many(data, [entry.data for entry in candidates])):
+            # lower bound of distance to any object in the subtree
+            d_min = max(d - entry.r, 0)
+            if d_min > nearest.bound:
+                nearest.skip(d_min)
+                stats.pruned_radius += 1
+                continue
+            pending.push(d_min, entry.node, d)
+
+    def browse(self, d_parent, queue, stats):
+        """
+        Enqueues all routing entries, ordered by the lower bound of their distance given by the parent distance
+        (no distance is counted until the entry gets to the front of the queue)
+        :param d_parent: distance between the query data and the parent node (self)
+        :param queue: distance browsing queue
+        :param stats: stats of the query
+        """
+        stats.nodes_visited += 1
+        for entry in self._entries:
+            queue.push_routing(max(abs(entry.parent_dist - d_parent) - entry.r, 0), entry)
+
+    def search_many(self, queries, collectors):
+        """
+        Searches all routing objects for many queries at once, queries are dropped from pruned subtrees
+        :param queries: list of (query index, query data, distance between the data and the parent node) triples
+        :param collectors: collectors of found objects, one per query index
+        """
+        entries = self._entries
+        keys = [entry.data for entry in entries]
+        # distances between all the queries and all the routing objects at once
+        matrix = None
+        if self.dist_function.batched:
+            matrix = self.dist_function.many_to_many([data for _, data, _ in queries], keys)
+        # (1) find queries which can't be pruned by triangular comparison of distances to the parent
+        reaching = [[] for _ in keys]
+        for i, (idx, data, d_parent) in enumerate(queries):
+            stats = collectors[idx].stats
+            stats.nodes_visited += 1
+            for j, entry in enumerate(entries):
+                if abs(entry.parent_dist - d_parent) > collectors[idx].radius + entry.r:
+                    stats.pruned_parent_dist += 1
+                    continue
+                d = self.dist_function(data, keys[j]) if matrix is None else matrix[i][j]
+                reaching[j].append((idx, data, d))
+        # (2) search subtrees, the most promising ones first (radius of limited queries shrinks meanwhile)
+        order = sorted((j for j in range(len(keys)) if reaching[j]),
+                       key=lambda j: min(d for _, _, d in reaching[j]) - entries[j].r)
+        for j in order:
+            subset = []
+            for idx, data, d in reaching[j]:
                 # check whether the subtree intersects with the query or not
-                if d <= r_sum:
-                    # add data from the subtree when it fits
-                    dataset = self._entries[entry_key].node.search(data, d, r, k)
-                    in_range = list(merge(in_range, dataset, key=lambda x: x.d))
-        # filter unnecessary objects
-        if len(in_range) > k:
-            return in_range[:k]
-
-        return in_range
+                if d > collectors[idx].radius + entries[j].r:
+                    collectors[idx].stats.pruned_radius += 1
+                    continue
+                subset.append((idx, data, d))
+            if len(subset) > 0:
+                entries[j].node.search_many(subset, collectors)
+
+    def own(self, entry: RoutingEntry):
+        """
+        Copies subtree node of the entry when it is shared with a snapshot, the copy replaces it in the node (self),
+        which has to be owned by the tree already (nodes are owned from the root down)
+        :param entry: routing entry of the node (self)
+        :return: subtree node which can be modified
+        """
+        node = entry.node
+        if node.epoch < self.epoch:
+            node = node.copy(self.epoch)
+            entry.node = node
+            self.attach((entry,))
+        return node
 
     def balance_subtree_overflowed(self, ro: RoutingEntry):
         """
@@ -159,80 +323,147 @@ class _NodeInternal(_Node):
         ro.subtree_ptr = ro.node
         """
         # delete old entry
-        del self._entries[ro.data]
+        self._entries.remove(ro)
         # create two new entries
         # (1)
         router_1 = ro.node.get_split_node(entries=partitions[0].entries,
                                           r=partitions[0].r,
                                           data=partitions[0].center)
-        routing_entry_1 = RoutingEntry(subtree=router_1,
+        routing_entry_1 = ro.new_entry(subtree=router_1,
                                        data=partitions[0].center,
                                        r=partitions[0].r,
                                        parent_dist=self.dist_function(self.data, partitions[0].center))
-        # update entries dictionary
-        self._entries[partitions[0].center] = routing_entry_1
+        # update entries list
+        self._entries.append(routing_entry_1)
         # (2)
         router_2 = ro.node.get_split_node(entries=partitions[1].entries,
                                           r=partitions[1].r,
                                           data=partitions[1].center)
-        routing_entry_2 = RoutingEntry(subtree=router_2,
+        routing_entry_2 = ro.new_entry(subtree=router_2,
                                        data=partitions[1].center,
                                        r=partitions[1].r,
                                        parent_dist=self.dist_function(self.data, partitions[1].center))
-        # update entries dictionary
-        self._entries[partitions[1].center] = routing_entry_2
+        # update entries list
+        self._entries.append(routing_entry_2)
+        self.attach((routing_entry_1, routing_entry_2))
+        # old node is not a part of the tree anymore
+        ro.release()
+
+    def delete(self, data, d_parent, min_capacity: int = 2, oid=None):
+        """
+        Deletes the data from the subtree it is stored in, rebalances the subtree when it underflows
+        :param data: data to be removed
+        :param d_parent: distance between the data and the node (self)
+        :param min_capacity: minimal number of entries of non-root nodes
+        :param oid: object id of the object to be removed, any object with equal data by default
+        :return: removed ground entry (None when there is no such object)
+        """
+        # go through routing objects, stop at the first subtree the data is deleted from
+        for entry in list(self._entries):
+            # try to delete only when the data object has any chance to fit into the subtree
+            if abs(d_parent - entry.parent_dist) > entry.r:
+                continue
+            # count data object distance to current node, only remove from the subtree when the data fits
+            d = self.dist_function(data, entry.data)
+            if d <= entry.r:
+                deleted = self.own(entry).delete(data, d, min_capacity, oid)
+                if deleted is not None:
+                    self.subtree_deleted(entry, min_capacity)
+                    return deleted
+        return None
+
+    def subtree_deleted(self, ro: RoutingEntry, min_capacity: int):
+        """
+        Updates the node after some data was deleted from the subtree
+        :param ro: routing object (entry) pointing to the subtree the data was deleted from
+        :param min_capacity: minimal number of entries of non-root nodes
+        """
+        # radius of the subtree might have shrunk
+        ro.r = ro.node.r
+        if ro.node.is_underflowed(min_capacity):
+            self.balance_subtree_underflowed(ro, min_capacity)
+        self.shrink()
+
+    def balance_subtree_underflowed(self, ro: RoutingEntry, min_capacity: int):
+        """
+        Merges the underflowed node into the closest sibling node when they fit into one node together,
+        otherwise moves the closest entries of the sibling into the node
+        :param ro: routing object (entry) pointing to the subtree which we want to balance
+        :param min_capacity: minimal number of entries of non-root nodes
+        """
+        node = ro.node
+        siblings = [entry for entry in self._entries if entry is not ro]
+        if len(siblings) == 0:
+            # nothing to balance with, only the root can have a single subtree, drop it when it's empty
+            if len(node) == 0:
+                self._entries.remove(ro)
+                ro.release()
+            return
+        # pick the closest sibling
+        distances = self.dist_function.one_to_many(ro.data, [entry.data for entry in siblings])
+        sibling = siblings[min(range(len(siblings)), key=lambda i: distances[i])]
+        sibling_node = self.own(sibling)
+        if len(node) + len(sibling_node) <= self.capacity:
+            # (1) merge, entries of the underflowed node become orphans adopted by the sibling
+            sibling_node.adopt([node.detach(entry) for entry in list(node._entries)])
+            sibling.r = sibling_node.r
+            self._entries.remove(ro)
+            ro.release()
+            return
+        # (2) donation, the sibling gives away its entries closest to the node (while it has enough of them)
+        offered = list(sibling_node._entries)
+        donated = max(min(min_capacity - len(node), len(offered) - min_capacity), 0)
+        distances = self.dist_function.one_to_many(node.data, [entry.data for entry in offered])
+        by_distance = sorted(range(len(offered)), key=lambda i: distances[i])
+        node.adopt([sibling_node.detach(offered[i]) for i in by_distance[:donated]])
+        sibling_node.shrink()
+        sibling.r = sibling_node.r
+        ro.r = node.r
 
 
 class Root(_NodeInternal):
     """
     Represents root node of an M-Tree
     """
+    __slots__ = ()
 
-    def delete(self, data) -> bool:
+    def delete(self, data, min_capacity: int = 2, oid=None):
         """
-        Tries to delete the data from all subtrees the data would fit into
+        Deletes the data from the subtree it is stored in, rebalances the tree
         :param data: data to be removed
-        :return: Success
+        :param min_capacity: minimal number of entries of non-root nodes
+        :param oid: object id of the object to be removed, any object with equal data by default
+        :return: removed ground entry (None when there is no such object)
         """
-        deleted = False
         # calculate distance
         d_root = self.dist_function(data, self.data)
-        # try to delete the data from all subtrees
-        for ro in self._entries:
-            if self._entries[ro].node.delete(data, d_root):
-                # deletion successful
-                deleted = True
+        deleted = super(Root, self).delete(data, d_root, min_capacity, oid)
+        if deleted is not None:
+            self.collapse()
         return deleted
 
-    # todo: handle 'donating'
+    def collapse(self):
+        """
+        Removes one level of the tree while the root has a single router
+        """
+        while len(self._entries) == 1:
+            ro = self._entries[0]
+            if not isinstance(ro.node, Router):
+                break
+            # entries of the router already store distances to its center, which becomes the new center
+            router = self.own(ro)
+            self.data = router.data
+            self.r = router.r
+            self._entries = list(router._entries)
+            self.attach(self._entries)
+            ro.release()
 
 
 class Router(_NodeInternal):
     """
     Represents routing node of an M-Tree
     """
-
-    def delete(self, data, d_parent) -> bool:
-        """
-        Tries to delete the data from all subtrees the data would fit into
-        :param data: data to be removed
-        :param d_parent: distance between data and the parent node
-        :return: Success
-        """
-        deleted = False
-        # go through routing objects, try to delete from all subtrees
-        for ro in self._entries:
-            # calculate distance-to-root difference
-            d_diff = abs(d_parent - self._entries[ro].parent_dist)
-            # try to delete only when the data object has any chance to fit into the subtree
-            if d_diff <= self._entries[ro].r:
-                # count data object distance to current node
-                d = self.dist_function(data, self._entries[ro].data)
-                # check whether it actually fits in ot not, only remove from the subtree when it does
-                if d <= self._entries[ro].r and self._entries[ro].node.delete(data, d):
-                    # deletion successful
-                    deleted = True
-        return deleted
+    __slots__ = ()
 
     def get_split_node(self, entries, r, data):
         """
@@ -243,85 +474,326 @@ class Router(_NodeInternal):
                       dist_function=self.dist_function,
                       split_function=self.split_function,
                       capacity=self.capacity,
-                      r=r)
-
-    # todo: handle 'donating'
+                      r=r,
+                      locator=self.locator,
+                      epoch=self.epoch)
 
 
 class Leaf(_Node):
     """
     Represents leaf node of an M-Tree
+
+    Ground entries are not kept as objects, their fields are stored in parallel columns (data list,
+    object id & parent distance arrays, payload list only when there are any payloads) to save memory,
+    ground entry objects are only created when the entries leave the node (splits, deletion, saving)
     """
+    # columns of the entries: data, object ids, parent distances, payloads (None while there are no payloads),
+    # the entries property below builds ground entries of them
+    __slots__ = ('_data', '_oids', '_dists', '_payloads')
+
+    @property
+    def _entries(self) -> list:
+        """
+        :return: new list of ground entries stored in the node
+        """
+        return [self._ground(i) for i in range(len(self._data))]
+
+    @_entries.setter
+    def _entries(self, entries):
+        # columns are filled from the ground entries, the objects themselves are not kept
+        self._data = []
+        self._oids = array('q')
+        self._dists = array('d')
+        self._payloads = None
+        for entry in entries or ():
+            self._append(entry)
+
+    def __len__(self):
+        """
+        :return: number of ground entries stored in the node
+        """
+        return len(self._data)
 
-    def add(self, data) -> bool:
+    def add(self, ground: GroundEntry) -> bool:
         """
-        Adds data to the node
-        :param data: data to be added
+        Adds data to the node (duplicate data are allowed, objects are told apart by their ids)
+        :param ground: ground entry of the data to be added
         :return: Success
         """
-        # don't add the data if it's already there
-        if data in self._entries:
-            return False
         # count distance between the data and the node
-        d = self.dist_function(data, self.data)
+        d = self.dist_function(ground.data, self.data)
         # add data
-        self._entries[data] = GroundEntry(oid=0, data=data, parent_dist=d)
+        ground.parent_dist = d
+        self._append(ground)
+        self.attach((ground,))
         # update node range if necessary
         if d > self.r:
             self.r = d
         return True
 
-    def delete(self, data, parent_dist) -> bool:
+    def delete(self, data, parent_dist, min_capacity: int = 2, oid=None):
         """
-        Deletes data from the node
+        Deletes data from the node, underflow is handled by the parent node
         :param parent_dist: distance to parent
         :param data: data to be removed
-        :return: Success
-        """
-        # check
-        if data not in self._entries:
-            return False
+        :param min_capacity: minimal number of entries (unused, see _NodeInternal.balance_subtree_underflowed())
+        :param oid: object id of the object to be removed, any object with equal data by default
+        :return: removed ground entry (None when there is no such object)
+        """
+        # find the object
+        if oid is not None:
+            found = next((i for i in range(len(self._data)) if self._oids[i] == oid), None)
+        else:
+            found = next((i for i in range(len(self._data)) if _equal(self._data[i], data)), None)
+        if found is None:
+            return None
         # delete
-        del self._entries[data]
-        return True
+        deleted = self._pop(found)
+        if self.locator is not None:
+            self.locator.discard(deleted.oid)
+        # radius might shrink
+        self.shrink()
+        return deleted
 
-    def search(self, data, d_parent, r, k) -> list:
+    def adopt(self, entries: list):
+        """
+        Moves entries of another node into this one, updates their parent distances and the radius
+        :param entries: ground entries to be moved (already removed from their original node)
+        """
+        distances = self.dist_function.one_to_many(self.data, [entry.data for entry in entries])
+        for entry, d in zip(entries, distances):
+            entry.parent_dist = d
+            self._append(entry)
+            self.r = max(self.r, d)
+        self.attach(entries)
+
+    def detach(self, entry):
+        """
+        Removes the entry from the node
+        :param entry: ground entry to be removed (created by the node, it shares the data object)
+        :return: removed entry
+        """
+        i = next(i for i in range(len(self._data)) if self._data[i] is entry.data and self._oids[i] == entry.oid)
+        self._pop(i)
+        return entry
+
+    def shrink(self):
+        """
+        Tightens the radius so it just covers the ground entries
+        """
+        self.r = max(self._dists, default=0)
+
+    def copy(self, epoch: int):
+        """
+        :param epoch: epoch of the copy
+        :return: copy of the leaf (data objects & payloads are shared)
         """
-        Searches all ground entries, looks for data with 'r' or lower dissimilarity
+        return type(self)(entries=self._entries,
+                          data=self.data,
+                          dist_function=self.dist_function,
+                          split_function=self.split_function,
+                          r=self.r,
+                          capacity=self.capacity,
+                          locator=self.locator,
+                          epoch=epoch)
+
+    def search(self, data, d_parent, collector):
+        """
+        Searches all ground entries, looks for data with defined similarity to the data
+        :param data: query data
+        :param d_parent: distance between the data and the parent node (self)
+        :param collector: collector of found objects, its radius defines the dissimilarity
+        """
+        collector.stats.nodes_visited += 1
+        # try to avoid counting the distances by triangular comparison of distances to the parent
+        radius = collector.radius
+        candidates = [i for i, parent_dist in enumerate(self._dists) if abs(parent_dist - d_parent) <= radius]
+        # count actual distances at once, the collector decides whether the objects fit into the query or not
+        distances = self.dist_function.one_to_many(data, [self._data[i] for i in candidates])
+        for i, d in zip(candidates, distances):
+            self._offer(collector, i, d)
+
+    def search_nearest(self, data, d_parent, pending, nearest):
+        """
+        Offers all ground entries which can still be some of the k nearest objects to the collector
         :param data: query data
-        :param r: range (dissimilarity)
-        :param k: maximum number of elements to search for
         :param d_parent: distance between the data and the parent node (self)
-        :return: sorted list of all r-similar objects in this node with max size of k
-        """
-        in_range = []
-        # go through all ground objects
-        for entry_key in self._entries:
-            # try to avoid counting the distance by triangular comparison of distances to the parent
-            d_diff = abs(self._entries[entry_key].parent_dist - d_parent)
-            if d_diff <= r:
-                # count actual distance
-                d = self.dist_function(data, entry_key)
-                # check whether the go fits into the query or not
-                if d <= r:
-                    # append when it fits
-                    in_range.append(SortableData(data=entry_key, d=d))
-        # sort the list first
-        in_range.sort(key=lambda x: x.d)
-        # filter unnecessary data when k is specified
-        if len(in_range) > k:
-            return in_range[:k]
-        return in_range
+        :param pending: priority queue of subtrees waiting to be searched (unused, leafs have no subtrees)
+        :param nearest: collector of the nearest objects found so far
+        """
+        self.search(data, d_parent, nearest)
+
+    def browse(self, d_parent, queue, stats):
+        """
+        Enqueues all ground entries, ordered by the lower bound of their distance given by the parent distance
+        (no distance is counted until the entry gets to the front of the queue)
+        :param d_parent: distance between the query data and the parent node (self)
+        :param queue: distance browsing queue
+        :param stats: stats of the query
+        """
+        stats.nodes_visited += 1
+        for i, parent_dist in enumerate(self._dists):
+            queue.push_ground(abs(parent_dist - d_parent),
+                              (self._data[i], self._oids[i], None if self._payloads is None else self._payloads[i]))
+
+    def search_many(self, queries, collectors):
+        """
+        Searches all ground entries for many queries at once
+        :param queries: list of (query index, query data, distance between the data and the parent node) triples
+        :param collectors: collectors of found objects, one per query index
+        """
+        # there is no gain without batch interface, search query after query
+        if not self.dist_function.batched:
+            for idx, data, d_parent in queries:
+                self.search(data, d_parent, collectors[idx])
+            return
+        # distances between all the queries and all the ground entries at once
+        matrix = self.dist_function.many_to_many([data for _, data, _ in queries], self._data)
+        for (idx, _, _), distances in zip(queries, matrix):
+            collectors[idx].stats.nodes_visited += 1
+            for i, d in enumerate(distances):
+                self._offer(collectors[idx], i, d)
 
     def get_split_node(self, entries, r, data):
         """
-        :return: Returns new leaf node with given parameters
+        :return: Returns new leaf node (of the same type) with given parameters
+        """
+        return type(self)(entries=entries,
+                          data=data,
+                          dist_function=self.dist_function,
+                          split_function=self.split_function,
+                          capacity=self.capacity,
+                          r=r,
+                          locator=self.locator,
+                          epoch=self.epoch)
+
+    def _append(self, entry: GroundEntry):
+        """
+        Stores fields of the ground entry to the columns
         """
-        return Leaf(entries=entries,
-                    data=data,
-                    dist_function=self.dist_function,
-                    split_function=self.split_function,
-                    capacity=self.capacity,
-                    r=r)
+        self._data.append(entry.data)
+        self._oids.append(entry.oid)
+        self._dists.append(entry.parent_dist)
+        if entry.payload is not None and self._payloads is None:
+            # first payload of the node, the column is created only now
+            self._payloads = [None] * (len(self._data) - 1)
+        if self._payloads is not None:
+            self._payloads.append(entry.payload)
 
-    # todo: handle 'donating'
+    def _pop(self, i: int) -> GroundEntry:
+        """
+        Removes i-th ground entry from the columns
+        :return: removed ground entry
+        """
+        entry = self._ground(i)
+        del self._data[i]
+        del self._oids[i]
+        del self._dists[i]
+        if self._payloads is not None:
+            del self._payloads[i]
+        return entry
+
+    def _ground(self, i: int) -> GroundEntry:
+        """
+        :return: new ground entry made of the i-th fields of the columns
+        """
+        return GroundEntry(oid=self._oids[i],
+                           data=self._data[i],
+                           parent_dist=self._dists[i],
+                           payload=None if self._payloads is None else self._payloads[i])
+
+    def _offer(self, collector, i: int, d):
+        """
+        Offers i-th ground entry to the collector
+        """
+        collector.add(self._data[i], d, self._oids[i], None if self._payloads is None else self._payloads[i])
+
+
+class ArrayLeaf(Leaf):
+    """
+    Represents leaf node of an M-Tree, searched in vectorized operations (requires NumPy)
+
+    Data of the ground entries is also kept in a contiguous matrix (follows the order of the data column)
+    Only suitable for vectors of numbers
+    """
+    __slots__ = ('_matrix',)
+
+    def __init__(self, entries, data, dist_function, split_function, r=0, capacity=CAPACITY_DFLT, locator=None,
+                 epoch: int = 0):
+        # matrix is (re)built lazily, None when out of date
+        self._matrix = None
+        super(ArrayLeaf, self).__init__(entries, data, dist_function, split_function, r, capacity, locator, epoch)
+
+    def _append(self, entry: GroundEntry):
+        """
+        Stores fields of the ground entry to the columns
+        """
+        self._matrix = None
+        super(ArrayLeaf, self)._append(entry)
+
+    def _pop(self, i: int) -> GroundEntry:
+        """
+        Removes i-th ground entry from the columns
+        :return: removed ground entry
+        """
+        self._matrix = None
+        return super(ArrayLeaf, self)._pop(i)
+
+    def search(self, data, d_parent, collector):
+        """
+        Searches all ground entries at once, looks for data with defined similarity to the data
+        :param data: query data
+        :param d_parent: distance between the data and the parent node (self)
+        :param collector: collector of found objects, its radius defines the dissimilarity
+        """
+        # metric can't be vectorized, search entries one by one
+        if not self.dist_function.batched:
+            super(ArrayLeaf, self).search(data, d_parent, collector)
+            return
+        collector.stats.nodes_visited += 1
+        if len(self._data) == 0:
+            return
+        if self._matrix is None:
+            self._matrix = as_matrix(self._data)
+        # filter entries by triangular comparison of distances to the parent
+        # (view of the parent distances column, it must not outlive the search as the column can't grow meanwhile)
+        candidates = np.flatnonzero(np.abs(np.frombuffer(self._dists) - d_parent) <= collector.radius)
+        if len(candidates) == 0:
+            return
+        # count distances of all remaining entries at once
+        distances = np.asarray(self.dist_function.one_to_many(data, self._matrix[candidates]))
+        # only objects within the current radius are offered to the collector
+        within = np.flatnonzero(distances <= collector.radius)
+        for i, d in zip(candidates[within], distances[within]):
+            self._offer(collector, i, float(d))
+
+    def search_many(self, queries, collectors):
+        """
+        Searches all ground entries for many queries at once
+        :param queries: list of (query index, query data, distance between the data and the parent node) triples
+        :param collectors: collectors of found objects, one per query index
+        """
+        # metric can't be vectorized, search query after query
+        if not self.dist_function.batched:
+            super(ArrayLeaf, self).search_many(queries, collectors)
+            return
+        if len(self._data) == 0:
+            for idx, _, _ in queries:
+                collectors[idx].stats.nodes_visited += 1
+            return
+        if self._matrix is None:
+            self._matrix = as_matrix(self._data)
+        # distances between all the queries and all the ground entries in one block
+        matrix = self.dist_function.many_to_many([data for _, data, _ in queries], self._matrix)
+        for (idx, _, _), distances in zip(queries, matrix):
+            collectors[idx].stats.nodes_visited += 1
+            for i in np.flatnonzero(distances <= collectors[idx].radius):
+                self._offer(collectors[idx], i, float(distances[i]))
+
+
+def _equal(a, b) -> bool:
+    """
+    :return: True when the data are equal (works for NumPy arrays too)
+    """
+    equal = a == b
+    return equal if isinstance(equal, bool) else bool(np.all(equal))
@@ -0,0 +1,208 @@
+"""
+    Helper structures used while querying an M-Tree
+"""
+
+import heapq
+import itertools
+
+from mtree.heuristics import INFINITY, SortableData
+from mtree.stats import QueryStats
+
+
+class RangeCollector:
+    """
+    Collects all objects within a fixed range from the queried one
+
+    Unsorted accumulator, the objects are sorted only once when the result is requested
+    """
+
+    def __init__(self, r, stats=None):
+        """
+        :param r: search radius
+        :param stats: stats of the query (new ones are created by default)
+        """
+        self.radius = r
+        self.stats = QueryStats() if stats is None else stats
+        self._found = []
+
+    def add(self, data, d, oid=None, payload=None):
+        """
+        Offers new object to the collector, keeps it when it fits into the search radius
+        :param data: object data
+        :param d: distance between the object and the queried one
+        :param oid: object id
+        :param payload: payload of the object
+        """
+        if d <= self.radius:
+            self._found.append(SortableData(data=data, d=d, oid=oid, payload=payload))
+
+    def result(self) -> list:
+        """
+        :return: sorted list of collected objects
+        """
+        self._found.sort(key=lambda x: x.d)
+        return self._found
+
+
+class NearestCollector:
+    """
+    Collects k objects closest to the queried one
+
+    Bounded max-heap, distance of the k-th nearest object found so far is used as a (shrinking) search radius
+    """
+
+    def __init__(self, k, r=INFINITY, stats=None, epsilon: float = 0):
+        """
+        :param k: maximum number of objects to be collected
+        :param r: initial search radius
+        :param stats: stats of the query (new ones are created by default)
+        :param epsilon: allowed relative error of approximate search (see NearestCollector.bound)
+        """
+        self.k = k
+        self.epsilon = epsilon
+        # lowest distance bound of the subtrees skipped only thanks to the allowed error
+        self.skipped = INFINITY
+        self._r = r
+        self.stats = QueryStats() if stats is None else stats
+        # heap of (-distance, tie breaker, data, object id, payload) tuples, farthest object is on the top
+        # (result objects are only created for the objects which stay in the heap until the end)
+        self._heap = []
+        self._counter = itertools.count()
+
+    @property
+    def radius(self):
+        """
+        :return: current search radius, only objects within this distance can still become a part of the result
+        """
+        if len(self._heap) < self.k:
+            return self._r
+        return min(self._r, -self._heap[0][0])
+
+    @property
+    def bound(self):
+        """
+        :return: radius subtrees are pruned with, subtrees farther than this can't improve the k-th distance
+        by more than (1 + epsilon) times (same as the search radius for exact search)
+        """
+        return self.radius / (1 + self.epsilon)
+
+    def skip(self, d_min):
+        """
+        Records a subtree skipped by the search, only the subtrees within the search radius matter
+        (the ones which could have improved the result if the search was exact)
+        :param d_min: lower bound of distance between the queried object and any object in the subtree
+        """
+        if d_min <= self.radius:
+            self.skipped = min(self.skipped, d_min)
+
+    def add(self, data, d, oid=None, payload=None):
+        """
+        Offers new object to the collector, keeps it only when it is one of the k nearest ones
+        :param data: object data
+        :param d: distance between the object and the queried one
+        :param oid: object id
+        :param payload: payload of the object
+        """
+        if d > self.radius:
+            return
+        item = (-d, next(self._counter), data, oid, payload)
+        if len(self._heap) < self.k:
+            heapq.heappush(self._heap, item)
+        else:
+            # replace the farthest object
+            heapq.heapreplace(self._heap, item)
+
+    def result(self) -> list:
+        """
+        :return: sorted list of collected objects
+        """
+        return [SortableData(data=data, d=-d, oid=oid, payload=payload)
+                for d, _, data, oid, payload in sorted(self._heap, key=lambda x: (-x[0], x[1]))]
+
+
+class PendingQueue:
+    """
+    Priority queue of subtrees waiting to be searched
+
+    Subtrees are ordered by the lower bound of their distance to the queried object
+    """
+
+    def __init__(self):
+        # heap of (lower bound, distance to node's center, tie breaker, node) quadruples
+        # (subtrees with the same bound are ordered by the distance to their center, the closest one goes first)
+        self._heap = []
+        self._counter = itertools.count()
+
+    def __len__(self):
+        return len(self._heap)
+
+    def push(self, d_min, node, d):
+        """
+        :param d_min: lower bound of distance between the queried object and any object in the subtree
+        :param node: root node of the subtree
+        :param d: distance between the queried object and center of the node
+        """
+        heapq.heappush(self._heap, (d_min, d, next(self._counter), node))
+
+    def pop(self):
+        """
+        :return: lower bound, node and distance to node's center of the most promising subtree
+        """
+        d_min, d, _, node = heapq.heappop(self._heap)
+        return d_min, node, d
+
+
+class BrowsingQueue:
+    """
+    Priority queue of distance browsing (objects are reported one by one in increasing distance)
+
+    Holds objects with known distances to the queried one, subtrees ordered by the lower bound of their distance
+    and entries whose distance is not counted yet, ordered by the lower bound derived from their parent distance
+    (distance of an entry is only counted when nothing closer is left in the queue)
+    """
+    # kinds of the queued items, objects go first when the keys are equal
+    OBJECT, GROUND, SUBTREE, ROUTING = range(4)
+
+    def __init__(self):
+        # heap of (key, kind, tie breaker, item, distance) tuples
+        self._heap = []
+        self._counter = itertools.count()
+
+    def __len__(self):
+        return len(self._heap)
+
+    def push_object(self, d, found):
+        """
+        :param d: distance between the queried object and the object
+        :param found: (data, object id, payload) triple of the object
+        """
+        heapq.heappush(self._heap, (d, self.OBJECT, next(self._counter), found, d))
+
+    def push_ground(self, d_min, found):
+        """
+        :param d_min: lower bound of distance between the queried object and the object
+        :param found: (data, object id, payload) triple of the object
+        """
+        heapq.heappush(self._heap, (d_min, self.GROUND, next(self._counter), found, None))
+
+    def push_subtree(self, d_min, node, d):
+        """
+        :param d_min: lower bound of distance between the queried object and any object in the subtree
+        :param node: root node of the subtree
+        :param d: distance between the queried object and center of the node
+        """
+        heapq.heappush(self._heap, (d_min, self.SUBTREE, next(self._counter), node, d))
+
+    def push_routing(self, d_min, entry):
+        """
+        :param d_min: lower bound of distance between the queried object and any object in the subtree of the entry
+        :param entry: routing entry
+        """
+        heapq.heappush(self._heap, (d_min, self.ROUTING, next(self._counter), entry, None))
+
+    def pop(self):
+        """
+        :return: kind, item and distance (None when unknown) of the closest item
+        """
+        _, kind, _, item, d = heapq.heappop(self._heap)
+        return kind, item, d
@@ -0,0 +1,226 @@
+"""
+    Compact binary format of an M-Tree
+
+    Node topology, radii and parent distances are stored in flat arrays, data of all entries in one contiguous block
+    (only suitable for vectors of numbers, all of the same dimension, payloads of the objects are not stored)
+
+    Layout (little endian, each array starts at a multiple of 8 bytes):
+        header
+        node kinds, node radii, indices of nodes' first entries
+        entry radii, entry parent distances, entry subtree indices (object ids of ground entries)
+        vectors (one per entry, root center is stored as the last one)
+"""
+
+import struct
+import sys
+from array import array
+from collections import namedtuple
+
+from mtree._entries import GroundEntry, RoutingEntry
+from mtree._nodes import Root, Router, Leaf
+
+# file format identification
+MAGIC = b'MTREEBIN'
+VERSION = 3
+# magic, version, vector type code, dimension, capacity, vectorized leafs flag, number of nodes, number of entries
+_HEADER = struct.Struct('<8sHcIIBQQ')
+Header = namedtuple('Header', 'magic version type_code dim capacity vectorized nodes_num entries_num')
+# position of one array in the file
+ArrayLayout = namedtuple('ArrayLayout', 'type_code offset length')
+# arrays in order of appearance
+ARRAYS = ('kinds', 'node_rs', 'starts', 'entry_rs', 'parent_dists', 'subtrees', 'vectors')
+# arrays alignment
+_ALIGNMENT = 8
+
+# node kinds
+KIND_ROOT = 0
+KIND_ROUTER = 1
+KIND_LEAF = 2
+
+
+def dump(mtree, f):
+    """
+    Writes the M-Tree into a binary file
+    :param mtree: M-Tree to be written
+    :param f: file opened for binary writing
+    """
+    # list nodes level by level, entries of each node are stored together
+    nodes = [] if mtree._root is None else [mtree._root]
+    kinds, node_rs, starts = array('b'), array('d'), array('q')
+    entry_rs, parent_dists, subtrees = array('d'), array('d'), array('q')
+    vectors = []
+    for node in nodes:
+        kinds.append(KIND_ROOT if node is mtree._root else KIND_ROUTER if isinstance(node, Router) else KIND_LEAF)
+        node_rs.append(node.r)
+        starts.append(len(entry_rs))
+        for entry in node._entries:
+            entry_rs.append(entry.r)
+            parent_dists.append(entry.parent_dist)
+            vectors.append(entry.data)
+            if isinstance(entry, RoutingEntry):
+                # subtree will be listed later
+                subtrees.append(len(nodes))
+                nodes.append(entry.node)
+            else:
+                subtrees.append(entry.oid)
+    starts.append(len(entry_rs))
+    if mtree._root is not None:
+        vectors.append(mtree._root.data)
+
+    # all the vectors in one block
+    dim = len(vectors[0]) if len(vectors) > 0 else 0
+    if any(len(vector) != dim for vector in vectors):
+        raise ValueError('only vectors of the same dimension can be stored')
+    type_code = 'q' if all(isinstance(v, int) for vector in vectors for v in vector) else 'd'
+    block = array(type_code, (v for vector in vectors for v in vector))
+
+    header = Header(MAGIC, VERSION, type_code, dim, mtree.capacity_max, mtree._leaf_type is not Leaf,
+                    len(kinds), len(entry_rs))
+    f.write(_HEADER.pack(*header._replace(type_code=type_code.encode())))
+    position = _HEADER.size
+    for arr, layout in zip((kinds, node_rs, starts, entry_rs, parent_dists, subtrees, block), layout_of(header)):
+        # pad the file up to the array's offset
+        f.write(bytes(layout.offset - position))
+        _write_array(f, arr)
+        position = layout.offset + len(arr) * arr.itemsize
+
+
+def load(f, mtree_type, dist_function, split_function, vectorized=None, locate=False):
+    """
+    Reads an M-Tree from a binary file
+    :param f: file opened for binary reading
+    :param mtree_type: M-Tree class
+    :param dist_function: metrics of the tree (functions are not stored in the file)
+    :param split_function: split heuristics function of the tree
+    :param vectorized: use vectorized leafs, same as the stored tree by default
+    :param locate: keep index of leafs storing the objects
+    :return: loaded M-Tree
+    """
+    header = read_header(f.read(_HEADER.size))
+    _, _, type_code, dim, capacity, stored_vectorized, nodes_num, entries_num = header
+
+    arrays = {}
+    for name, layout in zip(ARRAYS, layout_of(header)):
+        f.seek(layout.offset)
+        arrays[name] = _read_array(f, layout.type_code, layout.length)
+    kinds, node_rs, starts = arrays['kinds'], arrays['node_rs'], arrays['starts']
+    entry_rs, parent_dists, subtrees = arrays['entry_rs'], arrays['parent_dists'], arrays['subtrees']
+    block = arrays['vectors']
+    vectors_num = entries_num + 1 if nodes_num > 0 else 0
+    # cut the block into tuples (zipping the same iterator dim times)
+    vectors = list(zip(*[iter(block)] * dim)) if dim > 0 else [()] * vectors_num
+
+    mtree = mtree_type(capacity_max=capacity,
+                       dist_function=dist_function,
+                       split_function=split_function,
+                       vectorized=bool(stored_vectorized) if vectorized is None else vectorized,
+                       locate=locate)
+    if nodes_num == 0:
+        return mtree
+    # centers of nodes are data of their routing entries
+    centers = [vectors[-1]] + [None] * (nodes_num - 1)
+    for n in range(nodes_num):
+        if kinds[n] != KIND_LEAF:
+            for i in range(starts[n], starts[n + 1]):
+                centers[subtrees[i]] = vectors[i]
+    # create nodes bottom-up, subtrees are always listed after their parents
+    nodes = [None] * nodes_num
+    for n in reversed(range(nodes_num)):
+        entries = []
+        for i in range(starts[n], starts[n + 1]):
+            if kinds[n] != KIND_LEAF:
+                entries.append(RoutingEntry(subtree=nodes[subtrees[i]],
+                                            data=vectors[i],
+                                            r=entry_rs[i],
+                                            parent_dist=parent_dists[i]))
+            else:
+                entries.append(GroundEntry(oid=subtrees[i],
+                                           data=vectors[i],
+                                           parent_dist=parent_dists[i]))
+                mtree._next_oid = max(mtree._next_oid, entries[-1].oid + 1)
+        node_type = Root if kinds[n] == KIND_ROOT else Router if kinds[n] == KIND_ROUTER else mtree._leaf_type
+        nodes[n] = node_type(entries=entries,
+                             data=centers[n],
+                             dist_function=mtree._dist_function,
+                             split_function=mtree.split_function,
+                             capacity=capacity,
+                             r=node_rs[n],
+                             locator=mtree._locator)
+    mtree._root = nodes[0]
+    return mtree
+
+
+def read_header(buffer) -> Header:
+    """
+    Parses and checks the file header
+    :param buffer: bytes-like object starting with the header
+    :return: parsed header
+    """
+    if len(buffer) < _HEADER.size:
+        raise ValueError('not an M-Tree file')
+    header = Header(*_HEADER.unpack_from(buffer))
+    if header.magic != MAGIC:
+        raise ValueError('not an M-Tree file')
+    if header.version != VERSION:
+        raise ValueError(f'unsupported M-Tree file version: {header.version}')
+    return header._replace(type_code=header.type_code.decode())
+
+
+def layout_of(header: Header) -> list:
+    """
+    :param header: parsed file header
+    :return: list of ArrayLayout, one for each of ARRAYS
+    """
+    vectors_num = header.entries_num + 1 if header.nodes_num > 0 else 0
+    arrays = (('b', header.nodes_num), ('d', header.nodes_num), ('q', header.nodes_num + 1),
+              ('d', header.entries_num), ('d', header.entries_num), ('q', header.entries_num),
+              (header.type_code, vectors_num * header.dim))
+    layouts = []
+    offset = _HEADER.size
+    for type_code, length in arrays:
+        offset += -offset % _ALIGNMENT
+        layouts.append(ArrayLayout(type_code, offset, length))
+        offset += length * itemsize(type_code)
+    return layouts
+
+
+def itemsize(type_code: str) -> int:
+    """
+    :return: size of one array item in bytes
+    """
+    return array(type_code).itemsize
+
+
+def read_array_from(buffer, layout: ArrayLayout) -> array:
+    """
+    Copies one array from a bytes-like object containing the whole file
+    :param buffer: contents of the file
+    :param layout: position of the array
+    :return: the array (in native byte order)
+    """
+    arr = array(layout.type_code)
+    arr.frombytes(buffer[layout.offset:layout.offset + layout.length * arr.itemsize])
+    if sys.byteorder == 'big':
+        arr.byteswap()
+    return arr
+
+
+def _write_array(f, arr: array):
+    """
+    Writes the array in little endian byte order
+    """
+    if sys.byteorder == 'big':
+        arr = array(arr.typecode, arr)
+        arr.byteswap()
+    f.write(arr.tobytes())
+
+
+def _read_array(f, type_code: str, length: int) -> array:
+    """
+    Reads the array stored in little endian byte order, using one read
+    """
+    arr = array(type_code)
+    arr.frombytes(f.read(length * arr.itemsize))
+    if sys.byteorder == 'big':
+        arr.byteswap()
+    return arr
@@ -0,0 +1,51 @@
+"""
+    Vectorized (NumPy) distance computations
+
+    NumPy is an optional dependency, the functions can only be used when it is installed
+"""
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+def as_matrix(data_all):
+    """
+    :param data_all: sequence of data objects (vectors of numbers) or a NumPy matrix
+    :return: NumPy matrix, one data object per row
+    """
+    return np.asarray(data_all, dtype=float).reshape(len(data_all), -1)
+
+
+def euclidean_many(a, b):
+    """
+    :return: matrix of euclidean distances between each row of a and each row of b
+    """
+    return np.sqrt(((a[:, np.newaxis, :] - b[np.newaxis, :, :]) ** 2).sum(axis=2))
+
+
+def manhattan_many(a, b):
+    """
+    :return: matrix of manhattan distances between each row of a and each row of b
+    """
+    return np.abs(a[:, np.newaxis, :] - b[np.newaxis, :, :]).sum(axis=2)
+
+
+def chebyshev_many(a, b):
+    """
+    :return: matrix of chebyshev distances between each row of a and each row of b
+    """
+    return np.abs(a[:, np.newaxis, :] - b[np.newaxis, :, :]).max(axis=2)
+
+
+def cosine_many(a, b):
+    """
+    :return: matrix of cosine distances between each row of a and each row of b
+    """
+    # zero vectors are orthogonal to everything
+    norms_a = np.linalg.norm(a, axis=1)
+    norms_b = np.linalg.norm(b, axis=1)
+    norms_a[norms_a == 0] = 1
+    norms_b[norms_b == 0] = 1
+    return 1 - (a @ b.T) / np.outer(norms_a, norms_b)
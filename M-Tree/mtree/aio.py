@@ -0,0 +1,145 @@
+"""
+    Asyncio front-end of an M-Tree, queries arriving close together are run as one batched traversal
+
+    Queries never block the event loop, the batches run on an executor, each caller gets its own result
+"""
+
+import asyncio
+import concurrent.futures as futures
+import functools
+
+# time the first query of a batch waits for more queries to arrive (seconds)
+WINDOW_DFLT = 0.002
+# batch is started right away when it gets this many queries
+MAX_BATCH_DFLT = 256
+
+# kinds of batched queries
+_RANGE = 'range'
+_KNN = 'knn'
+
+
+class AsyncMTree:
+    """
+    Represents awaitable M-Tree queries, coalesced into batches (see MTree.range_query_many())
+
+    Queries with the same parameters (range & limit, or k) which arrive within the window share one traversal,
+    a batch waits at most the window or until it's full, so the latency added by coalescing stays bounded
+    """
+
+    def __init__(self, tree, window: float = WINDOW_DFLT, max_batch: int = MAX_BATCH_DFLT, executor=None):
+        """
+        :param tree: M-Tree to be queried (anything with range_query_many() & knn_query_many(), e.g. QueryExecutor)
+        :param window: time the first query of a batch waits for more queries (seconds)
+        :param max_batch: maximal number of queries of a batch
+        :param executor: executor running the batches, a single thread by default (batches share the CPU anyway)
+        """
+        self.tree = tree
+        self.window = window
+        self.max_batch = max_batch
+        self._executor = futures.ThreadPoolExecutor(max_workers=1) if executor is None else executor
+        self._own_executor = executor is None
+        # batch parameters -> list of (query data, future of the caller) pairs waiting for the batch
+        self._pending = {}
+        # batch parameters -> timer starting the waiting batch
+        self._timers = {}
+        # tasks of the batches which are running
+        self._running = set()
+        # number of batches run so far
+        self.batches = 0
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    async def range_query(self, data, r, k=None):
+        """
+        Finds all object within the range from the data object (in a batch with other queries)
+        :param data: query object data
+        :param r: query range
+        :param k: maximum number of objects to be found (closest ones are kept), unlimited by default
+        :return: list of r-similar objects
+        """
+        return await self._submit((_RANGE, r, k), data)
+
+    async def knn_query(self, data, k):
+        """
+        Finds k objects closest to the queried one (in a batch with other queries)
+        :param data: query object data
+        :param k: number of closest neighbours to be found
+        :return: list of k (or less, in case there is not enough objects) most similar objects
+        """
+        return await self._submit((_KNN, k), data)
+
+    async def close(self):
+        """
+        Starts the waiting batches, waits until all the batches finish, stops the default executor
+        """
+        for key in list(self._pending):
+            self._flush(key)
+        if len(self._running) > 0:
+            await asyncio.gather(*self._running, return_exceptions=True)
+        if self._own_executor:
+            self._executor.shutdown()
+
+    def _submit(self, key, data) -> asyncio.Future:
+        """
+        Adds the query to the waiting batch of the same parameters
+        :param key: parameters of the batch
+        :param data: query object data
+        :return: future of the query result
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        batch = self._pending.setdefault(key, [])
+        batch.append((data, future))
+        if len(batch) >= self.max_batch:
+            self._flush(key)
+        elif len(batch) == 1:
+            # the first query of the batch waits for the others at most the window
+            self._timers[key] = loop.call_later(self.window, self._flush, key)
+        return future
+
+    def _flush(self, key):
+        """
+        Starts the waiting batch
+        :param key: parameters of the batch
+        """
+        timer = self._timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        batch = self._pending.pop(key, None)
+        if batch is None:
+            return
+        task = asyncio.ensure_future(self._run(key, batch))
+        self._running.add(task)
+        task.add_done_callback(self._running.discard)
+
+    async def _run(self, key, batch: list):
+        """
+        Runs the batch on the executor, resolves the futures of the callers
+        :param key: parameters of the batch
+        :param batch: list of (query data, future of the caller) pairs
+        """
+        # callers which don't wait anymore (cancelled) are dropped
+        batch = [(data, future) for data, future in batch if not future.done()]
+        if len(batch) == 0:
+            return
+        queries = [data for data, _ in batch]
+        if key[0] == _RANGE:
+            call = functools.partial(self.tree.range_query_many, queries, key[1], key[2])
+        else:
+            call = functools.partial(self.tree.knn_query_many, queries, key[1])
+        self.batches += 1
+        try:
+            results = await asyncio.get_running_loop().run_in_executor(self._executor, call)
+        except Exception as e:
+            # every caller of the batch gets the error
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
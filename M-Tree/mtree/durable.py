@@ -0,0 +1,421 @@
+"""
+    In-memory M-Tree made durable by a write-ahead log and incremental checkpoints
+
+    Each insertion and deletion is appended to the log (path + '.wal') before it's applied to the tree,
+    checkpoints append just the nodes changed since the previous checkpoint to the store file (path),
+    unchanged nodes are referenced where they were stored before
+    Recovery loads the latest complete checkpoint and replays the log on top of it, so the cost of durability
+    follows the rate of changes, not the size of the tree
+    Store file grows with each checkpoint, it is rewritten with the current nodes only (compacted) when it doubles
+
+    Store layout (little endian, only suitable for vectors of numbers, all of the same dimension):
+        header (magic, version, vector type code, dimension, capacity, vectorized leafs flag)
+        records (length & CRC-32 of the body, body), either of:
+            node (kind, number of entries, radius, center vector, entries: vector, radius, parent distance,
+                  offset of the subtree record or object id of ground entries), subtrees go before their parents
+            checkpoint (offset of the root record or 0 for empty tree, next object id, last logged operation)
+    Log layout:
+        records (length & CRC-32 of the body, body: operation, sequence number, object id, vector)
+    Torn records at the end of either file (crash while writing) are dropped by the recovery
+"""
+
+import os
+import struct
+import zlib
+
+from mtree._entries import GroundEntry, RoutingEntry
+from mtree._locking import write_locked
+from mtree._nodes import Root, Router, Leaf, _equal
+from mtree._queries import RangeCollector
+from mtree.heuristics import *
+from mtree.mtree import MTree
+
+# file format identification
+MAGIC = b'MTREEDUR'
+VERSION = 1
+# magic, version, vector type code, dimension, capacity, vectorized leafs flag
+_HEADER = struct.Struct('<8sHcIIB')
+# length & CRC-32 of the record body
+_RECORD = struct.Struct('<II')
+# record kind, node kind, number of entries, radius
+_NODE = struct.Struct('<BBId')
+# record kind, offset of the root record, next object id, sequence number of the last logged operation
+_CHECKPOINT = struct.Struct('<BQQQ')
+# operation, sequence number, object id
+_OPERATION = struct.Struct('<BQq')
+# number of logged operations between checkpoints by default
+CHECKPOINT_EVERY_DFLT = 10000
+
+# record kinds
+RECORD_NODE = 0
+RECORD_CHECKPOINT = 1
+
+# node kinds
+KIND_ROOT = 0
+KIND_ROUTER = 1
+KIND_LEAF = 2
+
+# logged operations
+OP_ADD = 0
+OP_DELETE = 1
+
+
+class DurableMTree(MTree):
+    """
+    Represents M-Tree kept in memory, all the changes are logged and checkpointed to files
+
+    Opening the files recovers the tree as it was after the last logged operation
+    Payloads can't be stored (like in the other files of the M-Tree), objects only keep their ids
+    """
+
+    def __init__(self, path, dim: int = None, capacity_max: int = 9, dist_function=dist_euclidean,
+                 split_function=split_data_random, vectorized: bool = False, type_code: str = 'd',
+                 locate: bool = False, checkpoint_every: int = CHECKPOINT_EVERY_DFLT, sync: bool = False):
+        """
+        Opens the tree stored in the files (recovers it), creates new empty one when the store file doesn't exist
+        :param path: path to the store file, the log is next to it
+        :param dim: dimension of the vectors (new files only)
+        :param capacity_max: maximal number of objects any node can store (new files only)
+        :param dist_function: metrics of the tree (functions are not stored in the files)
+        :param split_function: split heuristics function
+        :param vectorized: keep data of leafs in NumPy arrays (requires NumPy)
+        :param type_code: array type code of vector values, 'd' for floats or 'q' for integers (new files only)
+        :param locate: keep index of leafs storing the objects
+        :param checkpoint_every: number of logged operations which triggers a checkpoint, never automatically when None
+        :param sync: force each logged operation and checkpoint to the disk (survives power loss, much slower),
+        otherwise the writes are only handed to the operating system (survives crash of the process)
+        """
+        if os.path.exists(path):
+            self._store = open(path, mode='r+b')
+            magic, version, type_code, dim, capacity_max, _ = _HEADER.unpack(self._store.read(_HEADER.size))
+            if magic != MAGIC:
+                raise ValueError('not a durable M-Tree file')
+            if version != VERSION:
+                raise ValueError(f'unsupported durable M-Tree file version: {version}')
+            type_code = type_code.decode()
+        else:
+            if dim is None:
+                raise ValueError('dimension of the vectors is required to create new file')
+            self._store = open(path, mode='w+b')
+            self._store.write(_HEADER.pack(MAGIC, VERSION, type_code.encode(), dim, capacity_max, vectorized))
+        super(DurableMTree, self).__init__(capacity_max=capacity_max,
+                                           dist_function=dist_function,
+                                           split_function=split_function,
+                                           vectorized=vectorized,
+                                           locate=locate)
+        self.path = path
+        self.checkpoint_every = checkpoint_every
+        self.sync = sync
+        self._dim = dim
+        self._type_code = type_code
+        self._vector = struct.Struct('<' + type_code * dim)
+        # object ids are signed 64-bit integers in all the files of the M-Tree
+        self._entry = struct.Struct('<' + type_code * dim + 'ddq')
+        # sequence number of the last logged operation, number of operations logged since the last checkpoint
+        self._lsn = 0
+        self._logged = 0
+        self._recover()
+        # store file is compacted when it grows twice as big
+        self._compacted_size = self._store.seek(0, os.SEEK_END)
+        self._log = open(path + '.wal', mode='ab')
+
+    @classmethod
+    def bulk_load(cls, path, data_it, capacity_max: int = 9, dist_function=dist_euclidean,
+                  split_function=split_data_random, vectorized: bool = False, type_code: str = 'd',
+                  locate: bool = False, checkpoint_every: int = CHECKPOINT_EVERY_DFLT, sync: bool = False):
+        """
+        Builds new durable M-Tree from a whole dataset at once (see MTree.bulk_load())
+        :param path: path to the store file (the files are overwritten when they exist)
+        :param data_it: iterable of data to be inserted, object ids are assigned in the order of the data
+        :return: new durable M-Tree containing all the data (checkpointed)
+        """
+        dataset = list(data_it)
+        for existing in (path, path + '.wal'):
+            if os.path.exists(existing):
+                os.remove(existing)
+        mtree = cls(path, dim=len(dataset[0]) if len(dataset) > 0 else 0, capacity_max=capacity_max,
+                    dist_function=dist_function, split_function=split_function, vectorized=vectorized,
+                    type_code=type_code, locate=locate, checkpoint_every=checkpoint_every, sync=sync)
+        if len(dataset) > 0:
+            mtree._bulk_build(mtree._ground_entries(dataset))
+        mtree.compact()
+        return mtree
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @write_locked
+    def add(self, data, oid: int = None, payload=None):
+        """
+        Logs new data, then adds it into the M-Tree (see MTree.add())
+        :param data: data to be inserted
+        :param oid: integer object id, ids are assigned in the order of insertion by default
+        :param payload: not supported, only object ids are stored (ValueError is raised for any payload)
+        :return: success
+        """
+        if payload is not None:
+            raise ValueError('durable M-Tree can not store payloads')
+        if oid is None:
+            oid = self._next_oid
+        # the object is already there
+        if self._locator is not None and oid in self._locator:
+            return False
+        return self._apply(OP_ADD, oid, data, lambda: super(DurableMTree, self).add(data, oid))
+
+    @write_locked
+    def checkpoint(self):
+        """
+        Appends the nodes changed since the last checkpoint to the store file, clears the log
+        (the whole store file is rewritten instead when it has doubled since it was last compacted)
+        """
+        if self._store.seek(0, os.SEEK_END) > 2 * self._compacted_size:
+            self.compact()
+            return
+        written = []
+        root = 0 if self._root is None else self._write_node(self._root, self._store, False, written)
+        _write_record(self._store, _CHECKPOINT.pack(RECORD_CHECKPOINT, root, self._next_oid, self._lsn))
+        self._store.flush()
+        if self.sync:
+            os.fsync(self._store.fileno())
+        self._checkpointed(written)
+
+    @write_locked
+    def compact(self):
+        """
+        Rewrites the store file with the current nodes only (nodes of the older checkpoints are dropped), clears the log
+        """
+        # the new file replaces the old one only when it is complete
+        path = self.path + '.tmp'
+        with open(path, mode='w+b') as f:
+            f.write(_HEADER.pack(MAGIC, VERSION, self._type_code.encode(), self._dim, self.capacity_max,
+                                 self._leaf_type is not Leaf))
+            written = []
+            root = 0 if self._root is None else self._write_node(self._root, f, True, written)
+            _write_record(f, _CHECKPOINT.pack(RECORD_CHECKPOINT, root, self._next_oid, self._lsn))
+            f.flush()
+            if self.sync:
+                os.fsync(f.fileno())
+        self._store.close()
+        os.replace(path, self.path)
+        self._store = open(self.path, mode='r+b')
+        self._compacted_size = self._store.seek(0, os.SEEK_END)
+        self._checkpointed(written)
+
+    @write_locked
+    def close(self):
+        """
+        Checkpoints the changes and closes the files, the tree can't be used anymore
+        """
+        if not self._store.closed:
+            if self._logged > 0:
+                self.checkpoint()
+            self._log.close()
+            self._store.close()
+
+    def _delete(self, data, oid):
+        """
+        Logs the removal, then removes an object from the M-Tree
+        :param data: data of the object to be removed
+        :param oid: object id of the object to be removed, any object with equal data when None
+        :return: ground entry of the removed object (None when there is no such object)
+        """
+        # the object id of the removed object is logged, the replay removes exactly the same object
+        if oid is None:
+            oid = self._find(data)
+            if oid is None:
+                return None
+        return self._apply(OP_DELETE, oid, data, lambda: super(DurableMTree, self)._delete(data, oid))
+
+    def _find(self, data):
+        """
+        :param data: data of the object
+        :return: object id of any object with equal data (None when there is no such object)
+        """
+        # tree might be empty
+        if self._root is None:
+            return None
+        collector = RangeCollector(0)
+        self._root.search(data=data, d_parent=self._dist_function(data, self._root.data), collector=collector)
+        return next((found.oid for found in collector.result() if _equal(found.data, data)), None)
+
+    def _apply(self, operation: int, oid: int, data, change):
+        """
+        Appends the operation to the log, then applies it to the tree (write-ahead),
+        checkpoints when enough operations were logged
+        :param operation: OP_ADD or OP_DELETE
+        :param oid: object id of the object
+        :param data: data of the object
+        :param change: function changing the tree, returns what the operation returns (nothing happened when falsy)
+        :return: result of the change
+        """
+        # data which can't be stored is refused before anything is logged
+        record = _OPERATION.pack(operation, self._lsn + 1, oid) + self._vector.pack(*data)
+        start = self._log.seek(0, os.SEEK_END)
+        _write_record(self._log, record)
+        self._log.flush()
+        if self.sync:
+            os.fsync(self._log.fileno())
+        try:
+            result = change()
+        except Exception:
+            self._unlog(start)
+            raise
+        if not result:
+            # nothing changed, the operation must not be replayed
+            self._unlog(start)
+            return result
+        self._lsn += 1
+        self._logged += 1
+        if self.checkpoint_every is not None and self._logged >= self.checkpoint_every:
+            self.checkpoint()
+        return result
+
+    def _unlog(self, start: int):
+        """
+        Drops the last record of the log (its operation didn't happen)
+        :param start: offset of the record
+        """
+        self._log.truncate(start)
+        if self.sync:
+            os.fsync(self._log.fileno())
+
+    def _checkpointed(self, written: list):
+        """
+        Finishes a checkpoint (its records are in the store file already)
+        :param written: list of (node, offset) pairs of the nodes written by the checkpoint
+        """
+        for node, offset in written:
+            node.stored_at = offset
+        # every logged operation is checkpointed now
+        self._log.truncate(0)
+        self._logged = 0
+        # stored nodes must not change anymore, modifications copy them from now on (see MTree.snapshot())
+        self._epoch += 1
+
+    def _write_node(self, node, f, full: bool, written: list) -> int:
+        """
+        Appends record of the node to the file, records of its subtrees go first
+        :param node: node to be written
+        :param f: store file
+        :param full: write the whole subtree, otherwise only the nodes which aren't stored already
+        :param written: list of (node, offset) pairs of the written nodes to be extended
+        :return: offset of the record of the node
+        """
+        # unchanged nodes are stored with their whole subtrees (changes copy the nodes from the root down)
+        if not full and node.stored_at is not None:
+            return node.stored_at
+        if isinstance(node, Leaf):
+            kind, entries, references = KIND_LEAF, node._entries, None
+        else:
+            kind = KIND_ROOT if node is self._root else KIND_ROUTER
+            entries = node._entries
+            references = [self._write_node(entry.node, f, full, written) for entry in entries]
+        body = bytearray(_NODE.pack(RECORD_NODE, kind, len(entries), node.r))
+        body += self._vector.pack(*node.data)
+        for i, entry in enumerate(entries):
+            # routing entries point to the record of their subtree, ground entries keep the object id
+            reference = entry.oid if references is None else references[i]
+            body += self._entry.pack(*entry.data, entry.r, entry.parent_dist, reference)
+        offset = f.seek(0, os.SEEK_END)
+        _write_record(f, body)
+        written.append((node, offset))
+        return offset
+
+    def _recover(self):
+        """
+        Loads the latest complete checkpoint, replays the log on top of it
+        """
+        # (1) find the latest checkpoint, drop records of a checkpoint which didn't finish
+        self._store.seek(0)
+        buffer = memoryview(self._store.read())
+        checkpoint, end = None, _HEADER.size
+        for offset, body in _records(buffer, _HEADER.size):
+            if body[0] == RECORD_CHECKPOINT:
+                checkpoint, end = body, offset + _RECORD.size + len(body)
+        self._store.truncate(end)
+        if checkpoint is not None:
+            _, root, self._next_oid, self._lsn = _CHECKPOINT.unpack(checkpoint)
+            if root != 0:
+                self._root = self._load_node(buffer, root)
+        buffer.release()
+        # loaded nodes are stored already, modifications copy them
+        self._epoch += 1
+        # (2) replay the operations logged after the checkpoint, drop a torn record at the end
+        log_path = self.path + '.wal'
+        if not os.path.exists(log_path):
+            return
+        with open(log_path, mode='r+b') as log:
+            buffer = memoryview(log.read())
+            end = 0
+            for offset, body in _records(buffer, 0):
+                end = offset + _RECORD.size + len(body)
+                operation, lsn, oid = _OPERATION.unpack_from(body)
+                # operations up to the checkpoint are in the store already
+                if lsn <= self._lsn:
+                    continue
+                data = self._vector.unpack_from(body, _OPERATION.size)
+                # replayed operations stay in the log until the next checkpoint
+                if operation == OP_ADD:
+                    MTree.add(self, data, oid)
+                else:
+                    MTree._delete(self, data, oid)
+                self._lsn = lsn
+                self._logged += 1
+            buffer.release()
+            log.truncate(end)
+
+    def _load_node(self, buffer, offset: int):
+        """
+        Loads the node and its whole subtree
+        :param buffer: content of the store file
+        :param offset: offset of the record of the node
+        :return: loaded node
+        """
+        length, _ = _RECORD.unpack_from(buffer, offset)
+        body = buffer[offset + _RECORD.size:offset + _RECORD.size + length]
+        _, kind, count, r = _NODE.unpack_from(body)
+        data = self._vector.unpack_from(body, _NODE.size)
+        entries = []
+        for values in self._entry.iter_unpack(body[_NODE.size + self._vector.size:]):
+            entry_data, entry_r, parent_dist, reference = values[:-3], values[-3], values[-2], values[-1]
+            if kind == KIND_LEAF:
+                entries.append(GroundEntry(oid=reference, data=entry_data, parent_dist=parent_dist))
+            else:
+                entries.append(RoutingEntry(subtree=self._load_node(buffer, reference), data=entry_data, r=entry_r,
+                                            parent_dist=parent_dist))
+        node_type = Root if kind == KIND_ROOT else Router if kind == KIND_ROUTER else self._leaf_type
+        node = node_type(entries=entries,
+                         data=data,
+                         dist_function=self._dist_function,
+                         split_function=self.split_function,
+                         capacity=self.capacity_max,
+                         r=r,
+                         locator=self._locator,
+                         epoch=self._epoch)
+        node.stored_at = offset
+        return node
+
+
+def _write_record(f, body: bytes):
+    """
+    Appends the record to the file
+    """
+    f.write(_RECORD.pack(len(body), zlib.crc32(body)) + body)
+
+
+def _records(buffer, offset: int):
+    """
+    :param buffer: content of a file
+    :param offset: offset of the first record
+    :return: generator of (offset, body) pairs of the complete records, stops at the first torn or damaged one
+    """
+    while offset + _RECORD.size <= len(buffer):
+        length, crc = _RECORD.unpack_from(buffer, offset)
+        body = buffer[offset + _RECORD.size:offset + _RECORD.size + length]
+        if len(body) < length or zlib.crc32(body) != crc:
+            return
+        yield offset, body
+        offset += _RECORD.size + length
@@ -0,0 +1,192 @@
+"""
+    Read-only M-Tree served directly from a memory-mapped file
+"""
+
+import mmap
+import sys
+
+from mtree import _storage
+from mtree._queries import RangeCollector, NearestCollector, PendingQueue
+from mtree._vectorized import np
+from mtree.heuristics import dist_euclidean
+from mtree.stats import DistanceCounter, QueryStats
+
+
+class FrozenMTree:
+    """
+    Represents read-only M-Tree saved by MTree.save()
+
+    Queries run directly on memory-mapped arrays of the file, no node or entry objects are created
+    Opening is nearly instant and processes opening the same file share one physical copy through the page cache
+    """
+
+    def __init__(self, path, dist_function=dist_euclidean):
+        """
+        :param path: path to the file saved by MTree.save()
+        :param dist_function: metrics of the saved tree (functions are not saved)
+        """
+        self._dist_function = DistanceCounter(dist_function)
+        # cumulative stats of all queries
+        self.stats = QueryStats()
+        with open(path, mode='br') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        header = _storage.read_header(self._mmap)
+        self.capacity_max = header.capacity
+        self._dim = header.dim
+        self._entries_num = header.entries_num
+        self._empty = header.nodes_num == 0
+        # typed views of all the arrays
+        self._views = []
+        buffer = memoryview(self._mmap)
+        for name, layout in zip(_storage.ARRAYS, _storage.layout_of(header)):
+            setattr(self, '_' + name, self._view(buffer, layout))
+        # vectors as NumPy matrix (shares the memory too), used by metrics with batch interface
+        self._matrix = None
+        if np is not None and self._dist_function.batched and not self._empty:
+            layout = _storage.layout_of(header)[-1]
+            dtype = np.dtype('<i8' if layout.type_code == 'q' else '<f8')
+            self._matrix = np.frombuffer(self._mmap, dtype=dtype, count=layout.length,
+                                         offset=layout.offset).reshape(-1, self._dim)
+        buffer.release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        """
+        Releases the memory-mapped file, the tree can't be queried anymore
+        """
+        self._matrix = None
+        for view in self._views:
+            view.release()
+        self._views = []
+        self._mmap.close()
+
+    def range_query(self, data, r, k=None, with_stats=False):
+        """
+        Finds all object within the range from the data object
+        :param data: query object data
+        :param r: query range
+        :param k: maximum number of objects to be found (closest ones are kept), unlimited by default
+        :param with_stats: return stats of the query too
+        :return: list of r-similar objects (and QueryStats when with_stats is set)
+        """
+        # unsorted accumulator is enough when the number of objects is not limited
+        collector = RangeCollector(r) if k is None else NearestCollector(k, r)
+        dist_calls = self._dist_function.count
+        # tree might be empty
+        if not self._empty:
+            # count distance to the root, search nodes depth first
+            stack = [(0, self._dist_function(data, self._vector(self._entries_num)))]
+            while len(stack) > 0:
+                node, d = stack.pop()
+                stack.extend((subtree, d_subtree) for subtree, d_subtree, _ in
+                             self._search_node(node, data, d, collector))
+        return self._finish_query(collector, dist_calls, with_stats)
+
+    def knn_query(self, data, k, with_stats=False):
+        """
+        Finds k objects closest to the queried one
+        :param data: query object data
+        :param k: number of closest neighbours to be found
+        :param with_stats: return stats of the query too
+        :return: list of k (or less, in case there is not enough objects) most similar objects
+        (and QueryStats when with_stats is set)
+        """
+        nearest = NearestCollector(k)
+        dist_calls = self._dist_function.count
+        # tree might be empty
+        if not self._empty and k > 0:
+            pending = PendingQueue()
+            # count distance to the root, start with the root
+            pending.push(0, 0, self._dist_function(data, self._vector(self._entries_num)))
+            # always expand the subtree with the lowest distance bound first
+            while len(pending) > 0:
+                d_min, node, d = pending.pop()
+                # remaining subtrees are too far, k-th nearest object can not be improved anymore
+                if d_min > nearest.radius:
+                    nearest.stats.pruned_radius += len(pending) + 1
+                    break
+                for subtree, d_subtree, d_subtree_min in self._search_node(node, data, d, nearest):
+                    pending.push(d_subtree_min, subtree, d_subtree)
+        return self._finish_query(nearest, dist_calls, with_stats)
+
+    def _search_node(self, node, data, d_parent, collector) -> list:
+        """
+        Searches entries of one node, offers its ground entries to the collector
+        :param node: index of the node
+        :param data: query data
+        :param d_parent: distance between the data and center of the node
+        :param collector: collector of found objects, its radius defines the dissimilarity
+        :return: list of (node index, distance to its center, lower bound of distance) of subtrees to be searched
+        """
+        stats = collector.stats
+        stats.nodes_visited += 1
+        first, last = self._starts[node], self._starts[node + 1]
+        is_leaf = self._kinds[node] == _storage.KIND_LEAF
+        # try to avoid counting the distances by triangular comparison of distances to the parent
+        candidates = [i for i in range(first, last)
+                      if abs(self._parent_dists[i] - d_parent) - self._entry_rs[i] <= collector.radius]
+        distances = self._distances(data, candidates)
+        if is_leaf:
+            for i, d in zip(candidates, distances):
+                # only create result data for objects which fit into the query
+                if d <= collector.radius:
+                    collector.add(self._vector(i), float(d), self._subtrees[i])
+            return []
+        stats.pruned_parent_dist += last - first - len(candidates)
+        subtrees = []
+        for i, d in zip(candidates, distances):
+            # lower bound of distance to any object in the subtree
+            d_min = max(d - self._entry_rs[i], 0)
+            if d_min > collector.radius:
+                stats.pruned_radius += 1
+                continue
+            subtrees.append((self._subtrees[i], d, d_min))
+        return subtrees
+
+    def _distances(self, data, indices: list):
+        """
+        :return: distances between the data and vectors of entries with given indices
+        """
+        if len(indices) == 0:
+            return []
+        if self._matrix is not None:
+            # count distances in one block
+            return self._dist_function.one_to_many(data, self._matrix[indices])
+        return [self._dist_function(data, self._vector(i)) for i in indices]
+
+    def _vector(self, i) -> tuple:
+        """
+        :return: data of entry with given index
+        """
+        return tuple(self._vectors[i * self._dim:(i + 1) * self._dim])
+
+    def _view(self, buffer, layout):
+        """
+        :return: typed read-only view of one array of the file (copy on big endian platforms)
+        """
+        if sys.byteorder == 'big':
+            return _storage.read_array_from(buffer, layout)
+        size = layout.length * _storage.itemsize(layout.type_code)
+        view = buffer[layout.offset:layout.offset + size].cast(layout.type_code)
+        self._views.append(view)
+        return view
+
+    def _finish_query(self, collector, dist_calls, with_stats):
+        """
+        Completes stats of a finished query, adds them to the cumulative stats
+        :param collector: collector of the query
+        :param dist_calls: number of distance function calls before the query started
+        :param with_stats: return stats of the query too
+        :return: query result (and QueryStats when with_stats is set)
+        """
+        stats = collector.stats
+        stats.queries = 1
+        stats.dist_calls = self._dist_function.count - dist_calls
+        self.stats += stats
+        result = collector.result()
+        return (result, stats) if with_stats else result
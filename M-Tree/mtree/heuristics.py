@@ -10,49 +10,52 @@ import random
 INFINITY = float('inf')
 # default capacity of all nodes
 CAPACITY_DFLT = 100
+# default number of sampled pivot pairs for sampled promotion policies
+SPLIT_SAMPLES_DFLT = 10
 
 # used for initialization of algorithms
 DataPartition = namedtuple("DataPartition", "center r entries")
 # represents data and its distance to queried object
-# (so the data can be sorted by the distance)
-SortableData = namedtuple('SortableData', 'data d')
+# (so the data can be sorted by the distance), along with the object id and payload of the object
+SortableData = namedtuple('SortableData', 'data d oid payload', defaults=(None, None))
+# pair of objects found by a similarity join (first object comes from the joined tree, second one from the other tree)
+SimilarPair = namedtuple('SimilarPair', 'first second d')
 
 
-def split_data_random(dataset: dict) -> (DataPartition, DataPartition):
+def split_data_random(dataset: list, dist_function=None) -> (DataPartition, DataPartition):
     """
-    Randomly splits data stored in dictionary into two parts
-    :param dataset: dictionary of routing objects to be split
+    Randomly splits entries stored in list into two parts
+    :param dataset: list of entries to be split
+    :param dist_function: metrics of the tree, default is euclidean distance
     :return: two new partitions
     """
     assert len(dataset) >= 4
+    dist_function = dist_function or dist_euclidean
 
-    # shuffle keys
-    keys = list(dataset.keys())
-    random.shuffle(keys)
+    # shuffle entries
+    shuffled = list(dataset)
+    random.shuffle(shuffled)
     # split data in half
     mid_idx = len(dataset) // 2
-    entries = (dict(list(dataset.items())[:mid_idx]), dict(list(dataset.items())[mid_idx:]))
+    entries = (shuffled[:mid_idx], shuffled[mid_idx:])
     # get center for each partition
     centers = _get_center_basic(entries[0], entries[1])
     # get radius for each partition
-    rs = _get_rs(centers, entries)
-
-    # update parent distances
-    _update_parent_dist_all(centers[0], entries[0])
-    _update_parent_dist_all(centers[1], entries[1])
+    rs = _get_rs(centers, entries, dist_function)
 
     # create the partitions
     return DataPartition(centers[0], rs[0], entries[0]), DataPartition(centers[1], rs[1], entries[1])
 
 
-def _update_parent_dist_all(center, to_update: dict):
+def _update_parent_dist_all(center, to_update: list, dist_function):
     """
     Updates parent distances of all elements in a ball
     :param center: new center of the ball
-    :param center: all elements in the ball
+    :param to_update: all elements in the ball
+    :param dist_function: metrics of the tree
     """
-    for key in to_update:
-        to_update[key].parent_dist = dist_euclidean(key, center)
+    for entry, d in zip(to_update, _dist_one_to_many(dist_function, center, [entry.data for entry in to_update])):
+        entry.parent_dist = d
 
 
 def _get_center_basic(*datasets):
@@ -62,11 +65,11 @@ def _get_center_basic(*datasets):
     centers = []
     for dataset in datasets:
         # simply mark the first element as center
-        centers.append(list(dataset.keys())[0])
+        centers.append(dataset[0].data)
     return tuple(centers)
 
 
-def _get_rs(centers, entries):
+def _get_rs(centers, entries, dist_function):
     """
     :return: radius for each center & partition entries pair
     """
@@ -75,60 +78,63 @@ def _get_rs(centers, entries):
     rs = []
     # count radius pair after pair
     for center, entries in zip(centers, entries):
-        rs.append(_calc_radius(center, entries))
+        rs.append(_calc_radius(center, entries, dist_function))
     return tuple(rs)
 
 
-def _calc_radius(center, others):
+def _calc_radius(center, others, dist_function):
     """
-    Calculates radius of a partition
+    Calculates radius of a partition, updates parent distances of all its entries
     :param center: center of the ball
     :param others: all entries of the ball
+    :param dist_function: metrics of the tree
     :return: calculated distance
     """
     r = 0
     # go through all entries
-    for rt_data in others:
+    for entry, d in zip(others, _dist_one_to_many(dist_function, center, [entry.data for entry in others])):
         # adjust radius if necessary
-        d = dist_euclidean(center, rt_data)
-        r = max(r, d + others[rt_data].r)
-        others[rt_data].parent_dist = d
+        r = max(r, d + entry.r)
+        entry.parent_dist = d
     return r
 
 
-def split_data_perfect(dataset: dict) -> (DataPartition, DataPartition):
+def split_data_perfect(dataset: list, dist_function=None) -> (DataPartition, DataPartition):
     """
     Compares all the data, find smallest overlap of new data balls
     best precision, worst speed
-    :param dataset: dictionary of routing objects to be split
+    :param dataset: list of entries to be split
+    :param dist_function: metrics of the tree, default is euclidean distance
     :return: two new partitions
     """
     assert len(dataset) >= 4
+    dist_function = dist_function or dist_euclidean
 
     best = None
     intersect_min = INFINITY
     # go through all possible splits
-    for partitions in _generate_splits(dataset):
+    for partitions in _generate_splits(dataset, dist_function):
         # quick fix
         if abs(len(partitions[0]) - len(partitions[1])) > 1:
             continue
-        intersect_curr = _count_intersect_simple(*partitions)
+        intersect_curr = _count_intersect_simple(*partitions, dist_function)
         # update best
         if intersect_curr < intersect_min:
             intersect_min = intersect_curr
             best = partitions
 
     # update parent distances
-    _update_parent_dist_all(best[0].center, best[0].entries)
-    _update_parent_dist_all(best[1].center, best[1].entries)
+    _update_parent_dist_all(best[0].center, best[0].entries, dist_function)
+    _update_parent_dist_all(best[1].center, best[1].entries, dist_function)
 
     return best
 
 
-def _generate_splits(dataset: dict) -> (DataPartition, DataPartition):
+def _generate_splits(dataset: list, dist_function) -> (DataPartition, DataPartition):
     """
     Generates all data splits into two partitions
-    :param dataset: data dictionary
+    :param dataset: list of entries
+    :param dist_function: metrics of the tree
     :return: yields all data split combinations (lexicographically)
     """
     # go through all combinations
@@ -137,20 +143,19 @@ def _generate_splits(dataset: dict) -> (DataPartition, DataPartition):
         if abs(len(entries[0]) - len(entries[1])) > 1:
             continue
         # count center and radius for both partitions
-        center_1, r_1 = _find_best_center(list(entries[0].keys()))
-        center_2, r_2 = _find_best_center(list(entries[1].keys()))
+        center_1, r_1 = _find_best_center(entries[0], dist_function)
+        center_2, r_2 = _find_best_center(entries[1], dist_function)
         # yield new partitions
         yield DataPartition(center_1, r_1, entries[0]),  DataPartition(center_2, r_2, entries[1])
 
 
-def _gen_comb_lex(dataset: dict):
+def _gen_comb_lex(dataset: list):
     """
     Generates all combinations of splits into two parts
-    :param dataset: dictionary of entries
-    :return: yields pair of dictionaries containing the entries
+    :param dataset: list of entries
+    :return: yields pair of lists containing the entries
     """
-    # convert to list
-    as_list = list(dataset.items())
+    as_list = list(dataset)
     # count number of combinations to be yielded
     # (there are 2^n combinations, we count symmetric pairs as 1 -> 2^n-1 combinations)
     combinations_num = 2 ** (len(as_list) - 1)
@@ -160,65 +165,63 @@ def _gen_comb_lex(dataset: dict):
         if counter >= combinations_num:
             break
         else:
-            # create the pair of dictionaries
-            split_pair = dict([data for tf, data in zip(pattern, as_list) if tf]), \
-                         dict([data for tf, data in zip(pattern, as_list) if not tf])
+            # create the pair of lists
+            split_pair = [entry for tf, entry in zip(pattern, as_list) if tf], \
+                         [entry for tf, entry in zip(pattern, as_list) if not tf]
             # there have to be at least two elements in each part
             if len(split_pair[0]) >= 2 and len(split_pair[1]) >= 2:
                 yield split_pair
 
 
-def _find_best_center(dataset: list):
+def _find_best_center(dataset: list, dist_function):
     """
     Finds best entry to represent the center of a nested ball
-    :param dataset: data list
-    :return: center entry, radius of the ball
+    :param dataset: list of entries
+    :param dist_function: metrics of the tree
+    :return: center data, radius of the ball (covering radii of the entries included)
     """
-    # distances between two data parts that are already known
+    # distances between two entries that are already known (by their indices)
     distances = {}
-    # init the dictionary
-    for data in dataset:
-        distances[data] = {}
 
     best = None
     r_min = INFINITY
     # go through data
-    for data in dataset:
+    for i, entry in enumerate(dataset):
         r_curr = -INFINITY
         # compare to all data
-        for child in dataset:
+        for j, child in enumerate(dataset):
             # don't count distance second time
-            if data in distances and child in distances[data]:
-                d = distances[data][child]
+            if (i, j) in distances:
+                d = distances[i, j]
             else:
                 # count distance
-                d = dist_euclidean(data, child)
+                d = dist_function(entry.data, child.data)
                 # memoize it
-                distances[data][child] = d
-                distances[child][data] = d
-            # update r
-            if data != child:
-                r_curr = max(r_curr, d)
+                distances[i, j] = d
+                distances[j, i] = d
+            # update r, the ball has to cover whole ball of the child
+            r_curr = max(r_curr, d + child.r)
         # update best
         if r_curr < r_min:
             r_min = r_curr
-            best = data
+            best = entry.data
     # ideal center is now in best
     return best, r_min
 
 
-def _count_intersect_simple(a: DataPartition, b: DataPartition) -> float:
+def _count_intersect_simple(a: DataPartition, b: DataPartition, dist_function) -> float:
     """
     Counts are of intersection of two circles
     Simplified heuristics for N-sphere intersection, works just as good
     :param a: first circle
     :param b: second circle
+    :param dist_function: metrics of the tree
     :return: area of intersection
     """
     # source: https://www.xarg.org/2016/07/calculate-the-intersection-area-of-two-circles/
 
     # count distance between the centers
-    d = dist_euclidean(a.center, b.center)
+    d = dist_function(a.center, b.center)
     # check if they intersect
     if d >= abs(a.r + b.r) or a.r == 0 or b.r == 0:
         # they don't
@@ -257,63 +260,238 @@ def _asin_safe(x):
     return pi_2 if x > 1 else -pi_2
 
 
-def split_data_smart(dataset: dict) -> (DataPartition, DataPartition):
+def split_data_smart(dataset: list, dist_function=None) -> (DataPartition, DataPartition):
     """
     Picks two anchors, then adds each data from the dataset to the closer one
     compromise between the speed and the complexity (keeps complexity = O(n))
     Resulting data partitions can be under-flowed
-    :param dataset: dictionary of routing objects to be split
+    :param dataset: list of entries to be split
+    :param dist_function: metrics of the tree, default is euclidean distance
     :return: two new partitions
     """
     assert len(dataset) >= 4
+    dist_function = dist_function or dist_euclidean
 
     # pick anchors
-    center_min, center_max = _find_centers_opposite(dataset)
+    center_min, center_max = _find_centers_opposite(dataset, dist_function)
     # distribute data between the anchors
-    entries_min, entries_max = {}, {}
+    entries_min, entries_max = [], []
     r_min, r_max = 0, 0
-    for data in dataset:
-        d_min = dist_euclidean(center_min, data)
-        d_max = dist_euclidean(center_max, data)
+    keys = [entry.data for entry in dataset]
+    distances_min = _dist_one_to_many(dist_function, center_min, keys)
+    distances_max = _dist_one_to_many(dist_function, center_max, keys)
+    for entry, d_min, d_max in zip(dataset, distances_min, distances_max):
         # pick closer anchor
         if d_min < d_max:
-            # update radius, add entry
-            r_min = max(r_min, d_min)
-            entries_min[data] = dataset[data]
-            entries_min[data].parent_dist = d_min
+            # update radius (has to cover whole ball of the entry), add entry
+            r_min = max(r_min, d_min + entry.r)
+            entries_min.append(entry)
+            entry.parent_dist = d_min
         else:
-            # update radius, add entry
-            r_max = max(r_max, d_max)
-            entries_max[data] = dataset[data]
-            entries_max[data].parent_dist = d_max
+            # update radius (has to cover whole ball of the entry), add entry
+            r_max = max(r_max, d_max + entry.r)
+            entries_max.append(entry)
+            entry.parent_dist = d_max
 
-    # update parent distances
-    _update_parent_dist_all(center_max, entries_max)
-    _update_parent_dist_all(center_min, entries_min)
     # create data partition for each anchor
     return DataPartition(center_min, r_min, entries_min), DataPartition(center_max, r_max, entries_max)
 
 
-def _find_centers_opposite(dataset: dict) -> tuple:
+def _find_centers_opposite(dataset: list, dist_function) -> tuple:
+    """
+    Finds two (approximately) most distant elements in the data, keeps complexity = O(n)
+    :param dataset: list of entries
+    :param dist_function: metrics of the tree
+    :return: data of the pair of the distant elements
+    """
+    # start with any element, find the farthest one from it
+    center_a = _find_farthest(dataset[0].data, dataset, dist_function)
+    # the farthest element from the farthest one is the second anchor
+    center_b = _find_farthest(center_a, dataset, dist_function)
+    return center_a, center_b
+
+
+def _find_farthest(center, dataset: list, dist_function):
+    """
+    :return: data of the element of the dataset farthest from the center
+    """
+    keys = [entry.data for entry in dataset]
+    distances = _dist_one_to_many(dist_function, center, keys)
+    return keys[max(range(len(keys)), key=lambda i: distances[i])]
+
+
+def split_data_m_rad(dataset: list, dist_function=None, samples: int = None) -> (DataPartition, DataPartition):
+    """
+    m_RAD promotion policy, promotes pair of entries with minimal sum of resulting covering radii
+    Entries are distributed to the closer promoted entry (generalized hyperplane)
+    :param dataset: list of entries to be split
+    :param dist_function: metrics of the tree, default is euclidean distance
+    :param samples: number of randomly sampled pairs to be tried, all pairs are tried by default
+    (fewer samples = faster split, but worse nodes)
+    :return: two new partitions
+    """
+    return _split_data_promote(dataset, dist_function, samples, lambda r_1, r_2: r_1 + r_2)
+
+
+def split_data_mm_rad(dataset: list, dist_function=None, samples: int = None) -> (DataPartition, DataPartition):
+    """
+    mM_RAD promotion policy, promotes pair of entries with minimal maximum of resulting covering radii
+    Entries are distributed to the closer promoted entry (generalized hyperplane)
+    :param dataset: list of entries to be split
+    :param dist_function: metrics of the tree, default is euclidean distance
+    :param samples: number of randomly sampled pairs to be tried, all pairs are tried by default
+    (fewer samples = faster split, but worse nodes)
+    :return: two new partitions
+    """
+    return _split_data_promote(dataset, dist_function, samples, max)
+
+
+def split_data_m_rad_sampled(dataset: list, dist_function=None) -> (DataPartition, DataPartition):
+    """
+    m_RAD promotion policy, only tries SPLIT_SAMPLES_DFLT randomly sampled pairs
+    :param dataset: list of entries to be split
+    :param dist_function: metrics of the tree, default is euclidean distance
+    :return: two new partitions
+    """
+    return split_data_m_rad(dataset, dist_function, samples=SPLIT_SAMPLES_DFLT)
+
+
+def split_data_mm_rad_sampled(dataset: list, dist_function=None) -> (DataPartition, DataPartition):
+    """
+    mM_RAD promotion policy, only tries SPLIT_SAMPLES_DFLT randomly sampled pairs
+    :param dataset: list of entries to be split
+    :param dist_function: metrics of the tree, default is euclidean distance
+    :return: two new partitions
+    """
+    return split_data_mm_rad(dataset, dist_function, samples=SPLIT_SAMPLES_DFLT)
+
+
+def split_data_m_lb_dist(dataset: list, dist_function=None) -> (DataPartition, DataPartition):
+    """
+    M_LB_DIST promotion policy, keeps the current center and promotes the entry farthest from it
+    Only uses stored parent distances to pick the pair, fastest promotion policy
+    :param dataset: list of entries to be split
+    :param dist_function: metrics of the tree, default is euclidean distance
+    :return: two new partitions
+    """
+    assert len(dataset) >= 4
+    dist_function = dist_function or dist_euclidean
+
+    keys = [entry.data for entry in dataset]
+    # current center has zero distance to the parent, the farthest entry has maximal one
+    idx_1 = min(range(len(keys)), key=lambda i: dataset[i].parent_dist)
+    idx_2 = max(range(len(keys)), key=lambda i: dataset[i].parent_dist)
+    if idx_1 == idx_2:
+        # all parent distances are equal, they don't tell anything
+        idx_2 = (idx_1 + 1) % len(keys)
+    # only distances to the promoted entries are needed
+    rows = _dist_rows(keys, {idx_1, idx_2}, dist_function)
+    return _distribute(dataset, keys, rows[idx_1], rows[idx_2], idx_1, idx_2)
+
+
+def _split_data_promote(dataset: list, dist_function, samples, criterion) -> (DataPartition, DataPartition):
+    """
+    Tries pairs of entries to be promoted, picks the best pair according to the criterion
+    :param dataset: list of entries to be split
+    :param dist_function: metrics of the tree, default is euclidean distance
+    :param samples: number of randomly sampled pairs to be tried, all pairs are tried when None
+    :param criterion: function taking two covering radii, returns value to be minimized
+    :return: two new partitions
+    """
+    assert len(dataset) >= 4
+    dist_function = dist_function or dist_euclidean
+
+    keys = [entry.data for entry in dataset]
+    pairs = list(itertools.combinations(range(len(keys)), 2))
+    if samples is not None and samples < len(pairs):
+        pairs = random.sample(pairs, max(samples, 1))
+    # distances between the entries, each one counted only once
+    rows = _dist_rows(keys, {idx for pair in pairs for idx in pair}, dist_function)
+
+    best = None
+    value_min = INFINITY
+    # go through all the pairs
+    for idx_1, idx_2 in pairs:
+        r_1, r_2 = 0, 0
+        # distribute the entries, count resulting radii
+        for i, entry in enumerate(dataset):
+            d_1, d_2 = rows[idx_1][i], rows[idx_2][i]
+            if d_1 <= d_2:
+                r_1 = max(r_1, d_1 + entry.r)
+            else:
+                r_2 = max(r_2, d_2 + entry.r)
+        # update best
+        value = criterion(r_1, r_2)
+        if value < value_min:
+            value_min = value
+            best = idx_1, idx_2
+
+    return _distribute(dataset, keys, rows[best[0]], rows[best[1]], *best)
+
+
+def _dist_rows(keys: list, indices: set, dist_function) -> dict:
     """
-    Finds centers with lowest / highest summary of elements in the data
-    :param dataset: data dictionary
-    :return: lowest, highest
+    Counts distance matrix rows for selected entries
+    :param keys: list of data of all entries
+    :param indices: indices of the entries the rows are counted for
+    :param dist_function: metrics of the tree
+    :return: dictionary of rows (index -> list of distances to all entries)
     """
-    sum_min, sum_max = INFINITY, -INFINITY
-    center_min, center_max = None, None
-    # go through dataset
-    for data in dataset:
-        sum_data = sum(data)
-        # update min & max
-        if sum_data < sum_min:
-            sum_min = sum_data
-            center_min = data
-        if sum_data > sum_max:
-            sum_max = sum_data
-            center_max = data
+    if getattr(dist_function, 'batched', False):
+        # count all the rows at once
+        indices = list(indices)
+        return dict(zip(indices, dist_function.many_to_many([keys[idx] for idx in indices], keys)))
+    rows = {}
+    for idx in indices:
+        row = []
+        for i, key in enumerate(keys):
+            if i == idx:
+                row.append(0)
+            elif i in rows:
+                # matrix is symmetric, reuse already known distance
+                row.append(rows[i][idx])
+            else:
+                row.append(dist_function(keys[idx], key))
+        rows[idx] = row
+    return rows
 
-    return center_min, center_max
+
+def _distribute(dataset: list, keys: list, row_1: list, row_2: list, idx_1: int, idx_2: int) \
+        -> (DataPartition, DataPartition):
+    """
+    Distributes entries to the closer of two promoted entries (generalized hyperplane)
+    :param dataset: list of entries to be split
+    :param keys: list of data of all entries
+    :param row_1: distances of all entries to the first promoted entry
+    :param row_2: distances of all entries to the second promoted entry
+    :param idx_1: index of the first promoted entry
+    :param idx_2: index of the second promoted entry
+    :return: two new partitions
+    """
+    entries_1, entries_2 = [], []
+    r_1, r_2 = 0, 0
+    for i, entry in enumerate(dataset):
+        # promoted entries always stay in their own partition
+        if i != idx_2 and (i == idx_1 or row_1[i] <= row_2[i]):
+            entries_1.append(entry)
+            entry.parent_dist = row_1[i]
+            r_1 = max(r_1, row_1[i] + entry.r)
+        else:
+            entries_2.append(entry)
+            entry.parent_dist = row_2[i]
+            r_2 = max(r_2, row_2[i] + entry.r)
+    return DataPartition(keys[idx_1], r_1, entries_1), DataPartition(keys[idx_2], r_2, entries_2)
+
+
+def _dist_one_to_many(dist_function, data, others: list):
+    """
+    Counts distances between the data and each of the others
+    Uses batch interface of the distance function when it provides one (see mtree.metrics)
+    :return: sequence of distances
+    """
+    if getattr(dist_function, 'batched', False):
+        return dist_function.one_to_many(data, others)
+    return [dist_function(data, other) for other in others]
 
 
 def dist_euclidean(a, b):
@@ -0,0 +1,120 @@
+"""
+    Distance functions with batch interface
+
+    Any distance function may optionally provide the batch interface:
+        batched = True
+        one_to_many(data, others) - distances between the data and each of the others
+        many_to_many(data_all, others) - matrix of distances between each of data_all and each of the others
+    M-Tree counts distances in batches when the distance function provides the interface, one by one otherwise
+
+    Batch distances of functions defined here are counted by NumPy when it is installed (one by one otherwise)
+"""
+
+import math
+
+from mtree import _vectorized
+from mtree._vectorized import np
+
+
+class _BatchMetric:
+    """
+    Distance function of two vectors of numbers with batch interface
+    """
+
+    batched = True
+
+    def __call__(self, a, b):
+        """
+        :return: distance between two objects a & b
+        """
+        raise NotImplementedError
+
+    def one_to_many(self, data, others):
+        """
+        :param data: data object
+        :param others: sequence of data objects (or NumPy matrix, one data object per row)
+        :return: distances between the data and each of the others
+        """
+        if np is None or len(others) == 0:
+            return [self(data, other) for other in others]
+        return self._many_to_many(_vectorized.as_matrix([data]), _vectorized.as_matrix(others))[0]
+
+    def many_to_many(self, data_all, others):
+        """
+        :param data_all: sequence of data objects (or NumPy matrix, one data object per row)
+        :param others: sequence of data objects (or NumPy matrix, one data object per row)
+        :return: matrix of distances, one row for each of data_all, one column for each of the others
+        """
+        if np is None or len(data_all) == 0 or len(others) == 0:
+            return [[self(data, other) for other in others] for data in data_all]
+        return self._many_to_many(_vectorized.as_matrix(data_all), _vectorized.as_matrix(others))
+
+    def _many_to_many(self, a, b):
+        """
+        :return: NumPy matrix of distances between each row of a and each row of b
+        """
+        raise NotImplementedError
+
+
+class Euclidean(_BatchMetric):
+    """
+    Euclidean distance
+    """
+
+    def __call__(self, a, b):
+        assert len(a) == len(b)
+        return math.sqrt(sum((v1 - v2) ** 2 for v1, v2 in zip(a, b)))
+
+    def _many_to_many(self, a, b):
+        return _vectorized.euclidean_many(a, b)
+
+
+class Manhattan(_BatchMetric):
+    """
+    Manhattan (city block) distance
+    """
+
+    def __call__(self, a, b):
+        assert len(a) == len(b)
+        return sum(abs(v1 - v2) for v1, v2 in zip(a, b))
+
+    def _many_to_many(self, a, b):
+        return _vectorized.manhattan_many(a, b)
+
+
+class Chebyshev(_BatchMetric):
+    """
+    Chebyshev (maximum) distance
+    """
+
+    def __call__(self, a, b):
+        assert len(a) == len(b)
+        return max(abs(v1 - v2) for v1, v2 in zip(a, b))
+
+    def _many_to_many(self, a, b):
+        return _vectorized.chebyshev_many(a, b)
+
+
+class Cosine(_BatchMetric):
+    """
+    Cosine distance (1 - cosine similarity)
+
+    Doesn't satisfy the triangle inequality, queries using it may miss some objects
+    """
+
+    def __call__(self, a, b):
+        assert len(a) == len(b)
+        norms = math.sqrt(sum(v ** 2 for v in a)) * math.sqrt(sum(v ** 2 for v in b))
+        # zero vectors are orthogonal to everything
+        if norms == 0:
+            return 1
+        return 1 - sum(v1 * v2 for v1, v2 in zip(a, b)) / norms
+
+    def _many_to_many(self, a, b):
+        return _vectorized.cosine_many(a, b)
+
+
+euclidean = Euclidean()
+manhattan = Manhattan()
+chebyshev = Chebyshev()
+cosine = Cosine()
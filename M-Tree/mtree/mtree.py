@@ -1,45 +1,185 @@
+import itertools
+import math
+import random
+import threading
+
+from mtree import _storage
+from mtree._joins import SimilarityJoin, knn_graph
+from mtree._locking import ReadWriteLock, read_locked, write_locked
 from mtree._entries import RoutingEntry, GroundEntry
-from mtree._nodes import Root, Leaf, Router
+from mtree._locator import Locator
+from mtree._nodes import Root, Leaf, Router, ArrayLeaf
+from mtree._vectorized import np
+from mtree.metrics import euclidean
+from mtree._queries import RangeCollector, NearestCollector, PendingQueue, BrowsingQueue
+from mtree.stats import DistanceCounter, QueryStats
 from mtree.heuristics import *
+from mtree.heuristics import _calc_radius
 
 
 class MTree:
     """
     Represents M-Tree data structure
+
+    Trees can be shared by threads: queries run together, modifications wait until the running queries finish
+    and run alone (one reader/writer lock per tree), each thread counts its own distances, so queries running
+    at the same time report their own stats
     """
 
-    def __init__(self, capacity_max: int = 9, dist_function=dist_euclidean, split_function=split_data_random):
+    def __init__(self, capacity_max: int = 9, dist_function=dist_euclidean, split_function=split_data_random,
+                 vectorized: bool = False, capacity_min: int = None, locate: bool = False):
         """
         :param capacity_max: maximal number of objects any node can store
         :param dist_function: metrics used to determine distance of 2 data objects, default is euclidean distance
-        has to take two parameters (data) and return distance between them
+        has to take two data objects (e.g. sequences of numbers) and return distance between them
         :param split_function: split heuristics function, default split heuristics is random split
-        has to take dictionary and return two data partitions
+        has to take list of entries and the distance function of the tree and return two data partitions
+        :param vectorized: keep data of leafs in NumPy arrays and search them in vectorized operations,
+        only suitable for vectors of numbers and distance functions with batch interface (requires NumPy)
+        :param capacity_min: minimal number of objects non-root nodes keep after deletions,
+        nodes with less objects are merged with or borrow objects from their closest sibling
+        (40 % by default, at most half of the maximal capacity)
+        :param locate: keep index of leafs storing the objects, deletions go directly to the leaf then
+        (in-memory trees only)
         """
+        if vectorized and np is None:
+            raise ImportError('NumPy is required for vectorized leafs')
+        if vectorized and dist_function is dist_euclidean:
+            # same metrics, with batch interface
+            dist_function = euclidean
         self._root = None
-        self.capacity_min = 2
+        self._leaf_type = ArrayLeaf if vectorized else Leaf
+        if capacity_min is None:
+            capacity_min = min(max(2, capacity_max * 2 // 5), capacity_max // 2)
+        # two nodes which underflow together have to fit into one (merge), a node has to be able to give away
+        # entries without underflowing itself (donation)
+        if capacity_min > capacity_max // 2:
+            raise ValueError(f'minimal capacity can be at most half of the maximal capacity: {capacity_min}')
+        self.capacity_min = capacity_min
         self.capacity_max = capacity_max
         self.split_function = split_function
-        self._dist_function = dist_function
+        # leafs of all the objects, nodes keep back-pointers to their parents then
+        self._locator = Locator() if locate else None
+        # object id assigned to the next object added without one
+        self._next_oid = 0
+        # nodes of older epochs are shared with snapshots, they are copied before being modified
+        self._epoch = 0
+        # count all distance computations
+        self._dist_function = DistanceCounter(dist_function)
+        # cumulative stats of all queries
+        self.stats = QueryStats()
+        self._stats_lock = threading.Lock()
+        # queries read the tree together, modifications write it alone
+        self._lock = ReadWriteLock()
+
+    def __getstate__(self):
+        # locks can't be pickled
+        state = self.__dict__.copy()
+        del state['_lock'], state['_stats_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._stats_lock = threading.Lock()
+        self._lock = ReadWriteLock()
+
+    @classmethod
+    def bulk_load(cls, data_it, capacity_max: int = 9, dist_function=dist_euclidean,
+                  split_function=split_data_random, vectorized: bool = False, locate: bool = False, payloads=None):
+        """
+        Builds new M-Tree from a whole dataset at once (fewer distance calls than adding the data one by one,
+        the tree is better clustered, so the queries are cheaper too)
+        Samples pivots, partitions the data around them recursively and builds the tree bottom-up
+        :param data_it: iterable of data to be inserted, objects get ids 0, 1, 2... in the order of the data
+        :param capacity_max: maximal number of objects any node can store
+        :param dist_function: metrics used to determine distance of 2 data objects, default is euclidean distance
+        :param split_function: split heuristics function used by later insertions, default is random split
+        :param vectorized: keep data of leafs in NumPy arrays (requires NumPy)
+        :param locate: keep index of leafs storing the objects
+        :param payloads: iterable of payloads of the data (in the same order), no payloads by default
+        :return: new M-Tree containing all the data
+        """
+        mtree = cls(capacity_max=capacity_max, dist_function=dist_function, split_function=split_function,
+                    vectorized=vectorized, locate=locate)
+        grounds = mtree._ground_entries(data_it, payloads)
+        if len(grounds) > 0:
+            mtree._bulk_build(grounds)
+        return mtree
+
+    @classmethod
+    def load(cls, path, dist_function=dist_euclidean, split_function=split_data_random, vectorized=None,
+             locate: bool = False):
+        """
+        Loads M-Tree saved by MTree.save()
+        :param path: path to the file
+        :param dist_function: metrics of the saved tree (functions are not saved)
+        :param split_function: split heuristics function to be used by later insertions
+        :param vectorized: keep data of leafs in NumPy arrays, same as the saved tree by default
+        :param locate: keep index of leafs storing the objects
+        :return: loaded M-Tree
+        """
+        with open(path, mode='br') as f:
+            return _storage.load(f, cls, dist_function, split_function, vectorized, locate)
+
+    @read_locked
+    def save(self, path):
+        """
+        Saves the M-Tree to a compact binary file (only vectors of numbers of the same dimension can be saved)
+        Distance & split functions are not saved, they have to be passed to MTree.load() again
+        :param path: path to the file (creates new one if it doesnt exist)
+        """
+        with open(path, mode='bw') as f:
+            _storage.dump(self, f)
 
     def __str__(self):
         # just display the root
         return f'M-Tree: < {self._root} >'
 
-    def add(self, data):
+    @write_locked
+    def snapshot(self):
         """
-        Adds new data into the M-Tree
+        Creates immutable point-in-time view of the tree, sharing all the nodes with it (nothing is copied now)
+        Nodes are copied when the tree modifies them for the first time after the snapshot (only the nodes on the path
+        of an insertion or deletion), so snapshots are never changed and never block the modifications of the tree
+        :return: read-only M-Tree (MTreeSnapshot)
+        """
+        snapshot = MTreeSnapshot(capacity_max=self.capacity_max, split_function=self.split_function,
+                                 capacity_min=self.capacity_min)
+        snapshot._root = self._root
+        snapshot._leaf_type = self._leaf_type
+        snapshot._next_oid = self._next_oid
+        # nodes count their distances by the counter of the tree
+        snapshot._dist_function = self._dist_function
+        # current nodes belong to the snapshot from now on
+        self._epoch += 1
+        return snapshot
+
+    @write_locked
+    def add(self, data, oid: int = None, payload=None):
+        """
+        Adds new data into the M-Tree, the same data can be added more times (as different objects)
         :param data: data to be inserted
+        :param oid: integer object id (64-bit), ids are assigned in the order of insertion by default
+        (ids are expected to be unique, only trees with locator check it)
+        :param payload: any object to be returned along with the data by queries (optional)
         :return: success
         """
+        if oid is None:
+            oid = self._next_oid
+        # the object is already there
+        if self._locator is not None and oid in self._locator:
+            return False
+        self._next_oid = max(self._next_oid, oid + 1)
+        ground = GroundEntry(oid=oid, data=data, payload=payload)
         # tree might be empty
         if self._root is None:
             # init the root with first entry
-            self._init_root(data)
+            self._init_root(ground)
             return True
         else:
             # try to add data to the existing root node
-            if self._root.add(data):
+            self._own_root()
+            if self._root.add(ground):
                 # check root capacity
                 if self._root.is_overflowed(max_capacity=self.capacity_max):
                     # add one level to the tree
@@ -48,77 +188,514 @@ class MTree:
             # couldn't add data
             return False
 
-    def delete(self, data):
+    @write_locked
+    def delete(self, data, oid: int = None):
         """
         Removes an object containing passed data from the M-Tree
         :param data: data to be removed
+        :param oid: object id of the object to be removed, any object with equal data by default
         :return: success
         """
-        # tree might be empty
-        if self._root is None:
-            return False
-        # try to delete the data
-        if self._root.delete(data):
-            if self._root.is_underflowed(min_capacity=1):
-                self._root = None
-            return True
-        # couldn't delete data
-        return False
+        return self._delete(data, oid) is not None
 
-    def range_query(self, data, r):
+    @write_locked
+    def update(self, data, new_data, oid: int = None):
+        """
+        Moves an object to new data (deletes it and inserts it again), keeps its object id and payload
+        :param data: current data of the object
+        :param new_data: new data of the object
+        :param oid: object id of the object to be moved, any object with equal data by default
+        :return: success
+        """
+        deleted = self._delete(data, oid)
+        return deleted is not None and self.add(new_data, deleted.oid, deleted.payload)
+
+    @read_locked
+    def range_query(self, data, r, k=None, with_stats=False):
         """
         Finds all object within the range from the data object
         :param data: query object data
         :param r: query range
-        :return: list of r-similar objects
+        :param k: maximum number of objects to be found (closest ones are kept), unlimited by default
+        :param with_stats: return stats of the query too
+        :return: list of r-similar objects (and QueryStats when with_stats is set)
         """
+        # unsorted accumulator is enough when the number of objects is not limited
+        collector = RangeCollector(r) if k is None else NearestCollector(k, r)
+        cost = self._cost()
         # tree might be empty
-        if self._root is None:
-            return []
-        # count distance to the root
-        d = self._dist_function(data, self._root.data)
-        # simply run search from the root
-        return self._root.search(data=data, d_parent=d, r=r)
+        if self._root is not None:
+            # count distance to the root
+            d = self._dist_function(data, self._root.data)
+            # simply run search from the root
+            self._root.search(data=data, d_parent=d, collector=collector)
+        return self._finish_query(collector, cost, with_stats)
 
-    def knn_query(self, data, k):
+    @read_locked
+    def knn_query(self, data, k, with_stats=False, epsilon: float = 0, max_leafs: int = None,
+                  max_dist_calls: int = None, patience: int = None):
         """
         Finds k objects closest to the queried one
+        The search is exact by default, any of the other parameters makes it approximate (cheaper),
+        the error bound actually achieved is reported in the stats (see QueryStats.error_bound)
         :param data: query object data
         :param k: number of closest neighbours to be found
+        :param with_stats: return stats of the query too
+        :param epsilon: allowed relative error, subtrees which can't improve the k-th distance
+        by more than (1 + epsilon) times are skipped
+        :param max_leafs: maximal number of leafs to be searched, unlimited by default
+        :param max_dist_calls: maximal number of distances to be counted (checked before each node), unlimited by default
+        :param patience: stop after searching this number of leafs in a row without improving the k-th distance
+        (early stop), never by default
         :return: list of k (or less, in case there is not enough objects) most similar objects
+        (and QueryStats when with_stats is set)
+        """
+        nearest = NearestCollector(k, epsilon=epsilon)
+        cost = self._cost()
+        # tree might be empty
+        if self._root is not None and k > 0:
+            pending = PendingQueue()
+            # count distance to the root, start with the root
+            pending.push(0, self._root, self._dist_function(data, self._root.data))
+            # leafs searched so far, leafs searched since the k-th distance improved
+            leafs, stale = 0, 0
+            # always expand the subtree with the lowest distance bound first
+            while len(pending) > 0:
+                d_min, node, d = pending.pop()
+                # remaining subtrees are too far, k-th nearest object can not be improved (enough) anymore
+                if d_min > nearest.bound:
+                    nearest.skip(d_min)
+                    nearest.stats.pruned_radius += len(pending) + 1
+                    break
+                # search budget is exhausted, remaining subtrees are never searched
+                if (max_leafs is not None and leafs >= max_leafs) or \
+                        (max_dist_calls is not None and self._cost_since(cost)[0] >= max_dist_calls) or \
+                        (patience is not None and stale >= patience):
+                    nearest.skip(d_min)
+                    break
+                radius = nearest.radius
+                node.search_nearest(data=data, d_parent=d, pending=pending, nearest=nearest)
+                if isinstance(node, Leaf):
+                    leafs += 1
+                    stale = stale + 1 if nearest.radius == radius else 0
+            # objects never reached are at least as far as the closest skipped subtree
+            nearest.stats.error_bound = _error_bound(nearest.radius, nearest.skipped)
+        return self._finish_query(nearest, cost, with_stats)
+
+    def iter_nearest(self, data):
+        """
+        Yields objects in the order of increasing distance from the queried one (distance browsing)
+        The tree is only searched as far as the objects are consumed, each next object costs just the work needed
+        to find it, the state of the search is kept between the objects
+        The tree is only locked while the next object is searched for, so it can be modified while the consumer
+        holds the generator, the next step raises RuntimeError then (like iteration of a changed dictionary)
+        Stats of the query are added to the cumulative stats when the iteration finishes (or the generator is closed)
+        :param data: query object data
+        :return: generator of objects sorted by their distance
+        """
+        stats = QueryStats()
+        stats.queries = 1
+        cost = self._cost()
+        queue = BrowsingQueue()
+        try:
+            with self._lock.reading():
+                # tree might be empty
+                if self._root is None:
+                    return
+                version = self._lock.version
+                queue.push_subtree(0, self._root, self._dist_function(data, self._root.data))
+            while True:
+                with self._lock.reading():
+                    if self._lock.version != version:
+                        raise RuntimeError('M-Tree changed during iteration')
+                    found = self._browse(data, queue, stats)
+                if found is None:
+                    break
+                # nothing closer is left in the queue, only the work done since the last object is counted
+                dist_calls, page_reads = self._cost_since(cost)
+                stats.dist_calls += dist_calls
+                stats.page_reads += page_reads
+                cost = None
+                yield found
+                cost = self._cost()
+        finally:
+            # the generator might be closed while waiting for the consumer
+            if cost is not None:
+                dist_calls, page_reads = self._cost_since(cost)
+                stats.dist_calls += dist_calls
+                stats.page_reads += page_reads
+            self._add_stats(stats)
+
+    @read_locked
+    def range_query_many(self, queries, r, k=None, with_stats=False):
+        """
+        Runs range query for each of the queried objects, all the queries traverse the tree together
+        :param queries: iterable of query object data
+        :param r: query range
+        :param k: maximum number of objects to be found per query (closest ones are kept), unlimited by default
+        :param with_stats: return summary stats of the queries too
+        :return: list of results, one list of r-similar objects per query (and QueryStats when with_stats is set)
+        """
+        queries = list(queries)
+        # unsorted accumulator is enough when the number of objects is not limited
+        collectors = [RangeCollector(r) if k is None else NearestCollector(k, r) for _ in queries]
+        return self._query_many(queries, collectors, with_stats)
+
+    @read_locked
+    def knn_query_many(self, queries, k, with_stats=False):
+        """
+        Runs knn query for each of the queried objects, all the queries traverse the tree together
+        :param queries: iterable of query object data
+        :param k: number of closest neighbours to be found
+        :param with_stats: return summary stats of the queries too
+        :return: list of results, one list of k most similar objects per query (and QueryStats when with_stats is set)
+        """
+        queries = list(queries)
+        collectors = [NearestCollector(k) for _ in queries]
+        # nothing to be found
+        if k <= 0:
+            queries = []
+        return self._query_many(queries, collectors, with_stats)
+
+    def similarity_join(self, other, r, with_stats=False):
+        """
+        Finds all pairs of objects within the range, traverses pairs of subtrees of both trees together
+        :param other: M-Tree to be joined with (using the same metrics), the tree itself for self-join
+        (each pair is reported once then, the object with lower id goes first, no object is paired with itself)
+        :param r: maximal distance of the objects of a pair
+        :param with_stats: return stats of the join too
+        :return: list of SimilarPair triples (object of this tree, object of the other tree, distance) sorted by
+        the distance (and QueryStats when with_stats is set)
+        """
+        stats = QueryStats()
+        cost = self._cost()
+        join = SimilarityJoin(r, self._dist_function, stats, same=other is self)
+        # both trees are read, always locked in the same order (two joins of the same trees can't wait for each other)
+        first, second = sorted((self, other), key=id)
+        with first._lock.reading(), second._lock.reading():
+            # either tree might be empty
+            if self._root is not None and other._root is not None:
+                join.join(self._root, other._root, self._dist_function(self._root.data, other._root.data))
+        join.pairs.sort(key=lambda pair: pair.d)
+        stats.queries = 1
+        stats.dist_calls, stats.page_reads = self._cost_since(cost)
+        self._add_stats(stats)
+        return (join.pairs, stats) if with_stats else join.pairs
+
+    @read_locked
+    def knn_graph(self, k, with_stats=False):
+        """
+        Finds k nearest neighbours of each object (the object itself excluded), objects of each leaf
+        are searched together
+        :param k: number of neighbours
+        :param with_stats: return summary stats of the search too
+        :return: dictionary of object id -> sorted list of k (or less) nearest objects
+        (and QueryStats when with_stats is set)
+        """
+        stats = QueryStats()
+        cost = self._cost()
+        graph = {}
+        # tree might be empty
+        if self._root is not None and k > 0:
+            graph = knn_graph(self._root, k, self._dist_function, stats)
+        stats.dist_calls, stats.page_reads = self._cost_since(cost)
+        self._add_stats(stats)
+        return (graph, stats) if with_stats else graph
+
+    def reset_stats(self):
+        """
+        Resets cumulative stats of all queries
+        """
+        self.stats = QueryStats()
+
+    def _browse(self, data, queue, stats):
+        """
+        Expands the browsing queue until the closest of the remaining objects is known
+        :param data: query object data
+        :param queue: browsing queue of the query
+        :param stats: stats of the query
+        :return: the closest remaining object (None when there is none left)
+        """
+        while len(queue) > 0:
+            kind, item, d = queue.pop()
+            if kind == BrowsingQueue.OBJECT:
+                found_data, oid, payload = item
+                return SortableData(data=found_data, d=d, oid=oid, payload=payload)
+            elif kind == BrowsingQueue.GROUND:
+                # distance of the object is needed now
+                queue.push_object(self._dist_function(data, item[0]), item)
+            elif kind == BrowsingQueue.ROUTING:
+                # distance to the center of the subtree is needed now
+                d = self._dist_function(data, item.data)
+                queue.push_subtree(max(d - item.r, 0), item.node, d)
+            else:
+                item.browse(d, queue, stats)
+        return None
+
+    def _query_many(self, queries, collectors, with_stats):
+        """
+        Pushes all the queries down the tree together
+        :param queries: list of query object data
+        :param collectors: collectors of found objects, one per query
+        :param with_stats: return summary stats of the queries too
+        :return: list of query results (and QueryStats when with_stats is set)
+        """
+        cost = self._cost()
+        # tree might be empty
+        if self._root is not None and len(queries) > 0:
+            # count distances to the root, run search from the root
+            d_root = self._dist_function.one_to_many(self._root.data, queries)
+            self._root.search_many([(idx, data, d) for idx, (data, d) in enumerate(zip(queries, d_root))],
+                                   collectors)
+        # summarize stats of all the queries
+        stats = QueryStats()
+        for collector in collectors:
+            stats += collector.stats
+        stats.queries = len(collectors)
+        stats.dist_calls, stats.page_reads = self._cost_since(cost)
+        self._add_stats(stats)
+        results = [collector.result() for collector in collectors]
+        return (results, stats) if with_stats else results
+
+    def _add_stats(self, stats):
+        """
+        Adds stats of finished queries to the cumulative stats (queries might finish at the same time)
+        """
+        with self._stats_lock:
+            self.stats += stats
+
+    def _cost(self) -> tuple:
+        """
+        :return: number of distance function calls and number of page reads of the current thread so far
+        """
+        return self._dist_function.count, 0
+
+    def _cost_since(self, cost) -> tuple:
+        """
+        :param cost: cost returned by _cost() before an operation started
+        :return: number of distance function calls and number of page reads since then
+        """
+        return tuple(now - before for now, before in zip(self._cost(), cost))
+
+    def _finish_query(self, collector, cost, with_stats):
+        """
+        Completes stats of a finished query, adds them to the cumulative stats
+        :param collector: collector of the query
+        :param cost: cost returned by _cost() before the query started
+        :param with_stats: return stats of the query too
+        :return: query result (and QueryStats when with_stats is set)
+        """
+        stats = collector.stats
+        stats.queries = 1
+        stats.dist_calls, stats.page_reads = self._cost_since(cost)
+        self._add_stats(stats)
+        result = collector.result()
+        return (result, stats) if with_stats else result
+
+    def _delete(self, data, oid):
+        """
+        Removes an object from the M-Tree
+        :param data: data to be removed
+        :param oid: object id of the object to be removed (optional)
+        :return: removed ground entry (None when there is no such object)
         """
         # tree might be empty
         if self._root is None:
-            return []
-        # count distance to the root
-        d = self._dist_function(data, self._root.data)
-        # simply run search from the root
-        return self._root.search(data=data, d_parent=d, r=INFINITY, k=k)
+            return None
+        if self._locator is not None and oid is not None:
+            # go directly to the leaf
+            leaf = self._locator.leaf_of(oid)
+            if leaf is None:
+                return None
+            deleted = self._delete_located(data, oid, leaf)
+        else:
+            # try to delete the data, rebalance nodes which underflow
+            self._own_root()
+            deleted = self._root.delete(data, self.capacity_min, oid)
+            if deleted is None:
+                # couldn't delete data
+                return None
+        if self._root.is_underflowed(min_capacity=1):
+            self._root = None
+        return deleted
 
-    def _init_root(self, data):
+    def _init_root(self, ground):
         """
         Initializes root of the M-Tree, creates nodes to store the first record
-        :param data: initial data
+        :param ground: ground entry of the initial data
         """
+        data = ground.data
         # (1) Leaf & its ground entry
-        # create ground object, add it to a dictionary
-        ground = {data: GroundEntry(data=data)}
         # create first leaf, add ground object(s) to it
-        leaf = Leaf(entries=ground,
-                    data=data,
-                    dist_function=self._dist_function,
-                    split_function=self.split_function,
-                    capacity=self.capacity_max)
+        leaf = self._leaf_type(entries=[ground],
+                               data=data,
+                               dist_function=self._dist_function,
+                               split_function=self.split_function,
+                               capacity=self.capacity_max,
+                               locator=self._locator,
+                               epoch=self._epoch)
         # (2) Router & its routing entry
-        # create routing object, add it to a dictionary
-        routing = {data: RoutingEntry(subtree=leaf, data=data)}
+        # create routing object, add it to a list
+        routing = [self._routing_entry(subtree=leaf, data=data)]
         # create root, add rooting object(s) to it
         self._root = Root(entries=routing,
                           data=data,
                           dist_function=self._dist_function,
                           split_function=self.split_function,
                           capacity=self.capacity_max,
-                          r=INFINITY)
+                          r=INFINITY,
+                          locator=self._locator,
+                          epoch=self._epoch)
+
+    def _ground_entries(self, data_it, payloads=None) -> list:
+        """
+        Creates ground entries of new objects, assigns them object ids
+        :param data_it: iterable of data
+        :param payloads: iterable of payloads of the data (in the same order), no payloads by default
+        :return: list of ground entries
+        """
+        payloads = itertools.repeat(None) if payloads is None else payloads
+        grounds = [GroundEntry(oid=oid, data=data, payload=payload)
+                   for oid, (data, payload) in enumerate(zip(data_it, payloads), start=self._next_oid)]
+        self._next_oid += len(grounds)
+        return grounds
+
+    def _bulk_build(self, grounds: list):
+        """
+        Builds the whole tree bottom-up, level after level
+        :param grounds: list of ground entries of all the data
+        """
+        # (1) leafs, one per cluster of data
+        nodes = [self._bulk_node(self._leaf_type, center, cluster)
+                 for center, cluster in self._bulk_cluster(grounds)]
+        # (2) routers, one per cluster of nodes from the level below
+        while len(nodes) > self.capacity_max:
+            nodes = [self._bulk_node(Router, center, [self._routing_entry(subtree=node, data=node.data, r=node.r)
+                                                      for node in cluster])
+                     for center, cluster in self._bulk_cluster(nodes)]
+        # (3) root, top level nodes fit into it
+        self._root = self._bulk_node(Root, nodes[0].data, [self._routing_entry(subtree=node,
+                                                                               data=node.data,
+                                                                               r=node.r)
+                                                           for node in nodes])
+
+    def _bulk_node(self, node_type, center, entries: list):
+        """
+        Creates new node of given type, counts its radius and parent distances of its entries
+        :param node_type: Root, Router or leaf type of the tree
+        :param center: data defining node's position in the metric space
+        :param entries: list of entries the node stores
+        :return: new node
+        """
+        return node_type(entries=entries,
+                         data=center,
+                         dist_function=self._dist_function,
+                         split_function=self.split_function,
+                         capacity=self.capacity_max,
+                         r=_calc_radius(center, entries, self._dist_function),
+                         locator=self._locator,
+                         epoch=self._epoch)
+
+    def _bulk_cluster(self, items: list, center=None) -> list:
+        """
+        Recursively partitions items into clusters which fit into a node, each cluster around a sampled pivot
+        :param items: ground entries or nodes to be partitioned (anything with data)
+        :param center: data of the pivot of the items (when there is one)
+        :return: list of (center, items of the cluster) pairs
+        """
+        # the items fit into a single node
+        if len(items) <= self.capacity_max:
+            return [(items[0].data if center is None else center, items)]
+        # sample pivots, roughly one for each node the items should fit into
+        pivots = [item.data for item in
+                  random.sample(items, min(self.capacity_max, math.ceil(len(items) / self.capacity_max)))]
+        # assign each item to the closest pivot
+        clusters = self._bulk_assign(items, pivots)
+        # all the items went to the same pivot (sampled pivots are duplicates), slice the items ordered by
+        # the distance to the pivot instead, otherwise the recursion wouldn't end
+        if any(len(cluster) == len(items) for cluster in clusters):
+            distances = self._dist_function.one_to_many(pivots[0], [item.data for item in items])
+            items = [items[i] for i in sorted(range(len(items)), key=lambda i: distances[i])]
+            return [(items[i].data, items[i:i + self.capacity_max])
+                    for i in range(0, len(items), self.capacity_max)]
+        # redistribute items of under-flowed clusters (only when there are at least two clusters left)
+        kept = [i for i in range(len(pivots)) if len(clusters[i]) >= self.capacity_min]
+        if len(kept) >= 2:
+            orphans = [item for i in range(len(pivots)) if i not in kept for item in clusters[i]]
+            for i, cluster in zip(kept, self._bulk_assign(orphans, [pivots[i] for i in kept])):
+                clusters[i].extend(cluster)
+            pivots, clusters = [pivots[i] for i in kept], [clusters[i] for i in kept]
+        # partition clusters which are still too large
+        result = []
+        for pivot, cluster in zip(pivots, clusters):
+            result.extend(self._bulk_cluster(cluster, pivot))
+        return result
+
+    def _bulk_assign(self, items: list, pivots: list) -> list:
+        """
+        :return: list of items closest to each of the pivots
+        """
+        clusters = [[] for _ in pivots]
+        if self._dist_function.batched:
+            # vectorized metrics compute all the distances of an item at once
+            for item in items:
+                distances = self._dist_function.one_to_many(item.data, pivots)
+                clusters[min(range(len(pivots)), key=lambda i: distances[i])].append(item)
+            return clusters
+        # pivot j can't be closer than the closest pivot b found so far when d(b, j) >= 2 * d(item, b)
+        # (triangle inequality), distances between the pivots are computed once for all the items
+        between = self._dist_function.many_to_many(pivots, pivots)
+        for item in items:
+            best, d_best = 0, self._dist_function(item.data, pivots[0])
+            for j in range(1, len(pivots)):
+                if between[best][j] >= 2 * d_best:
+                    continue
+                d = self._dist_function(item.data, pivots[j])
+                if d < d_best:
+                    best, d_best = j, d
+            clusters[best].append(item)
+        return clusters
+
+    def _delete_located(self, data, oid, leaf):
+        """
+        Deletes the object from the known leaf, rebalances the nodes on the path up to the root
+        :param data: data to be removed
+        :param oid: object id of the object to be removed
+        :param leaf: leaf storing the object
+        :return: removed ground entry
+        """
+        # leaf shared with a snapshot, copy the path from the root down to it
+        if leaf.epoch < self._epoch:
+            path = [leaf]
+            while path[-1].parent is not None:
+                path.append(path[-1].parent)
+            self._own_root()
+            leaf = self._root
+            for node in reversed(path[:-1]):
+                leaf = leaf.own(next(entry for entry in leaf._entries if entry.node is node))
+        # distance to the parent is only needed to find the data, the leaf is already known
+        deleted = leaf.delete(data, 0, self.capacity_min, oid)
+        node = leaf
+        while node.parent is not None:
+            parent = node.parent
+            ro = next(entry for entry in parent._entries if entry.node is node)
+            parent.subtree_deleted(ro, self.capacity_min)
+            node = parent
+        self._root.collapse()
+        return deleted
+
+    def _own_root(self):
+        """
+        Copies the root when it is shared with a snapshot (before the root is modified)
+        """
+        if self._root.epoch < self._epoch:
+            self._root = self._root.copy(self._epoch)
+
+    def _routing_entry(self, subtree, data, r: float = 0, parent_dist: float = 0):
+        """
+        :return: new routing entry pointing to the subtree node
+        """
+        return RoutingEntry(subtree=subtree, data=data, r=r, parent_dist=parent_dist)
 
     def _split_root(self):
         """
@@ -130,29 +707,33 @@ class MTree:
         partitions = self._root.get_split_data()
 
         # create new root with 2 new rooting entries
-        entries = {}
+        entries = []
         # (1) create first router and its routing entry
         router = Router(entries=partitions[0].entries,
                         data=partitions[0].center,
                         dist_function=self._dist_function,
                         split_function=self.split_function,
                         capacity=self.capacity_max,
-                        r=partitions[0].r)
-        entries[partitions[0].center] = RoutingEntry(subtree=router,
-                                                     data=partitions[0].center,
-                                                     r=partitions[0].r)
+                        r=partitions[0].r,
+                        locator=self._locator,
+                        epoch=self._epoch)
+        entries.append(self._routing_entry(subtree=router,
+                                           data=partitions[0].center,
+                                           r=partitions[0].r))
         # (2) create second router and its routing entry
         router = Router(entries=partitions[1].entries,
                         data=partitions[1].center,
                         dist_function=self._dist_function,
                         split_function=self.split_function,
                         capacity=self.capacity_max,
-                        r=partitions[1].r)
+                        r=partitions[1].r,
+                        locator=self._locator,
+                        epoch=self._epoch)
         parent_dist = self._dist_function(partitions[0].center, partitions[1].center)
-        entries[partitions[1].center] = RoutingEntry(subtree=router,
-                                                     data=partitions[1].center,
-                                                     r=partitions[1].r,
-                                                     parent_dist=parent_dist)
+        entries.append(self._routing_entry(subtree=router,
+                                           data=partitions[1].center,
+                                           r=partitions[1].r,
+                                           parent_dist=parent_dist))
         # count distance between centers
         d_centers = self._dist_function(partitions[0].center, partitions[1].center)
         # count root's new radius
@@ -162,4 +743,43 @@ class MTree:
                           data=partitions[0].center,
                           dist_function=self._dist_function,
                           split_function=self.split_function,
-                          r=root_r)
+                          capacity=self.capacity_max,
+                          r=root_r,
+                          locator=self._locator,
+                          epoch=self._epoch)
+
+
+class MTreeSnapshot(MTree):
+    """
+    Represents read-only point-in-time view of an M-Tree (see MTree.snapshot())
+
+    Queries, joins and saving work as on the tree itself, modifications raise TypeError
+    """
+
+    def add(self, data, oid: int = None, payload=None):
+        raise TypeError('M-Tree snapshot can not be modified')
+
+    def delete(self, data, oid: int = None):
+        raise TypeError('M-Tree snapshot can not be modified')
+
+    def update(self, data, new_data, oid: int = None):
+        raise TypeError('M-Tree snapshot can not be modified')
+
+    def snapshot(self):
+        """
+        :return: the snapshot itself (it never changes)
+        """
+        return self
+
+
+def _error_bound(d_kth, d_unexplored) -> float:
+    """
+    :param d_kth: distance of the k-th object found (infinity when less than k objects were found)
+    :param d_unexplored: lower bound of distance of any object which hasn't been found
+    :return: relative error the found objects are guaranteed to be within
+    """
+    if d_unexplored >= d_kth:
+        return 0
+    if d_unexplored <= 0:
+        return INFINITY
+    return d_kth / d_unexplored - 1
@@ -0,0 +1,395 @@
+"""
+    Disk-resident M-Tree, nodes are stored in fixed-size pages of a file and loaded on demand
+
+    Only the root is kept in memory, other nodes go through a buffer pool of limited size
+    (least recently used pages are evicted first, modified pages are written back when evicted or flushed)
+
+    Layout (little endian, only suitable for vectors of numbers, all of the same dimension):
+        page 0: metadata
+        page 1: root
+        other pages: routers, leafs or free pages (free pages are linked into a list)
+    Node page:
+        header (kind, number of entries, radius), center vector
+        entries (vector, radius, parent distance, page of the subtree or object id of ground entries)
+"""
+
+import os
+import struct
+import threading
+from collections import OrderedDict
+
+from mtree._entries import GroundEntry, PagedRoutingEntry
+from mtree._locking import write_locked
+from mtree._nodes import Root, Router, Leaf
+from mtree.heuristics import *
+from mtree.mtree import MTree
+
+# file format identification
+MAGIC = b'MTREEPGD'
+VERSION = 2
+# magic, version, page size, capacity, dimension, vector type code, vectorized leafs flag, root flag,
+# number of pages, first free page (0 when there is none), next object id (since version 2)
+_META = struct.Struct('<8sHIIIcBBQQQ')
+# node kind, number of entries (next free page for free pages), radius
+_NODE_HEADER = struct.Struct('<BId')
+# pages of the metadata and the root
+META_PAGE = 0
+ROOT_PAGE = 1
+# default number of pages kept in memory
+BUFFER_PAGES_DFLT = 64
+
+# page kinds
+KIND_ROOT = 0
+KIND_ROUTER = 1
+KIND_LEAF = 2
+KIND_FREE = 3
+
+
+class BufferPool:
+    """
+    Keeps limited number of recently used nodes in memory, loads the others from their pages on demand
+
+    Nodes are modified in place, so all the pages accessed during a write operation are pinned in memory
+    and marked as modified when the operation ends (see begin_write() and end_write())
+    Concurrent queries load pages one at a time (the cache & the file are shared)
+    """
+
+    def __init__(self, f, page_size: int, pages_num: int, free_head: int, encode, decode,
+                 capacity: int = BUFFER_PAGES_DFLT):
+        """
+        :param f: file opened for binary reading and writing
+        :param page_size: size of one page in bytes
+        :param pages_num: number of pages in the file
+        :param free_head: first page of the free pages list (0 when there is none)
+        :param encode: function converting node into bytes of a page
+        :param decode: function converting bytes of a page into node
+        :param capacity: maximal number of pages kept in memory (pinned pages can exceed it)
+        """
+        self._f = f
+        self.page_size = page_size
+        self.pages_num = pages_num
+        self.free_head = free_head
+        self._encode = encode
+        self._decode = decode
+        self.capacity = capacity
+        # page id -> node, least recently used first
+        self._cache = OrderedDict()
+        # pages modified since they were read
+        self._dirty = set()
+        # pages accessed by the running write operation, None outside of write operations
+        self._pinned = None
+        # number of pages read from and written to the file
+        self.reads = 0
+        self.writes = 0
+        # pages read by each thread (see local_reads)
+        self._local = threading.local()
+        # guards the cache & the file position, queries read pages concurrently
+        self._mutex = threading.Lock()
+
+    def get(self, page_id: int):
+        """
+        :param page_id: page of the node
+        :return: node stored in the page
+        """
+        with self._mutex:
+            node = self._cache.get(page_id)
+            if node is None:
+                node = self._decode(self._read(page_id))
+                self._cache[page_id] = node
+            else:
+                self._cache.move_to_end(page_id)
+            if self._pinned is not None:
+                self._pinned.add(page_id)
+            self._evict()
+            return node
+
+    def put(self, node) -> int:
+        """
+        Stores new node in a free page
+        :param node: node to be stored
+        :return: page of the node
+        """
+        # reuse freed pages first
+        if self.free_head != 0:
+            page_id = self.free_head
+            kind, self.free_head, _ = _NODE_HEADER.unpack_from(self._read(page_id))
+            assert kind == KIND_FREE
+        else:
+            page_id = self.pages_num
+            self.pages_num += 1
+        self._cache[page_id] = node
+        self._dirty.add(page_id)
+        if self._pinned is not None:
+            self._pinned.add(page_id)
+        self._evict()
+        return page_id
+
+    def free(self, page_id: int):
+        """
+        Drops the node stored in the page, adds the page to the free pages list
+        :param page_id: page of the node
+        """
+        self._cache.pop(page_id, None)
+        self._dirty.discard(page_id)
+        if self._pinned is not None:
+            self._pinned.discard(page_id)
+        page = bytearray(self.page_size)
+        _NODE_HEADER.pack_into(page, 0, KIND_FREE, self.free_head, 0)
+        self.write(page_id, page)
+        self.free_head = page_id
+
+    def begin_write(self):
+        """
+        Starts write operation, pages accessed from now on are kept in memory
+        """
+        self._pinned = set()
+
+    def end_write(self):
+        """
+        Ends write operation, all the pages accessed by it are considered modified
+        """
+        self._dirty |= self._pinned
+        self._pinned = None
+        self._evict()
+
+    def flush(self):
+        """
+        Writes all modified pages to the file
+        """
+        for page_id in sorted(self._dirty):
+            self.write(page_id, self._encode(self._cache[page_id]))
+        self._dirty.clear()
+
+    def write(self, page_id: int, page: bytes):
+        """
+        Writes one page to the file
+        """
+        self._f.seek(page_id * self.page_size)
+        self._f.write(page)
+        self.writes += 1
+
+    @property
+    def local_reads(self) -> int:
+        """
+        :return: number of pages read by the current thread so far (cost of its own queries)
+        """
+        return getattr(self._local, 'reads', 0)
+
+    def _read(self, page_id: int) -> bytes:
+        """
+        Reads one page from the file
+        """
+        self._f.seek(page_id * self.page_size)
+        self.reads += 1
+        self._local.reads = self.local_reads + 1
+        return self._f.read(self.page_size)
+
+    def _evict(self):
+        """
+        Drops least recently used pages which are not pinned, writes them back when modified
+        """
+        while len(self._cache) > self.capacity:
+            victim = next((page_id for page_id in self._cache
+                           if self._pinned is None or page_id not in self._pinned), None)
+            # everything is pinned, let the buffer grow until the write operation ends
+            if victim is None:
+                return
+            node = self._cache.pop(victim)
+            if victim in self._dirty:
+                self.write(victim, self._encode(node))
+                self._dirty.discard(victim)
+
+
+class PagedMTree(MTree):
+    """
+    Represents M-Tree stored in pages of a file, only the root and a limited number of nodes are kept in memory
+
+    Changes are written to the file when evicted from the buffer pool, by flush() and by close()
+    Query stats count pages read from the file next to the distance computations
+    Payloads can't be stored (like in the other files of the M-Tree), objects only keep their ids
+    Snapshots are not supported (see MTree.snapshot()), pages are rewritten in place
+    """
+
+    def __init__(self, path, dim: int = None, capacity_max: int = 9, dist_function=dist_euclidean,
+                 split_function=split_data_random, vectorized: bool = False,
+                 buffer_pages: int = BUFFER_PAGES_DFLT, type_code: str = 'd'):
+        """
+        Opens the tree stored in the file, creates new empty one when the file doesn't exist
+        :param path: path to the file
+        :param dim: dimension of the vectors (new files only)
+        :param capacity_max: maximal number of objects any node can store (new files only)
+        :param dist_function: metrics of the tree (functions are not stored in the file)
+        :param split_function: split heuristics function
+        :param vectorized: keep data of leafs in NumPy arrays (requires NumPy)
+        :param buffer_pages: maximal number of pages kept in memory
+        :param type_code: array type code of vector values, 'd' for floats or 'q' for integers (new files only)
+        """
+        if os.path.exists(path):
+            self._f = open(path, mode='r+b')
+            magic, version, page_size, capacity_max, dim, type_code, _, has_root, pages_num, free_head, next_oid = \
+                _META.unpack(self._f.read(_META.size))
+            if magic != MAGIC:
+                raise ValueError('not a paged M-Tree file')
+            if version != VERSION:
+                raise ValueError(f'unsupported paged M-Tree file version: {version}')
+            type_code = type_code.decode()
+        else:
+            if dim is None:
+                raise ValueError('dimension of the vectors is required to create new file')
+            self._f = open(path, mode='w+b')
+            # root page is reserved from the beginning
+            has_root, pages_num, free_head, next_oid = False, ROOT_PAGE + 1, 0, 0
+        super(PagedMTree, self).__init__(capacity_max=capacity_max,
+                                         dist_function=dist_function,
+                                         split_function=split_function,
+                                         vectorized=vectorized)
+        self._next_oid = next_oid
+        self._dim = dim
+        self._type_code = type_code
+        self._vector = struct.Struct('<' + type_code * dim)
+        # object ids are signed 64-bit integers in all the files of the M-Tree
+        self._entry = struct.Struct('<' + type_code * dim + 'ddq')
+        # overflowed node (one entry more) has to fit into a page, metadata too
+        page_size = max(_NODE_HEADER.size + self._vector.size + (capacity_max + 1) * self._entry.size, _META.size)
+        self._pool = BufferPool(self._f, page_size, pages_num, free_head, self._encode, self._decode, buffer_pages)
+        if has_root:
+            self._root = self._decode(self._pool._read(ROOT_PAGE))
+
+    @classmethod
+    def bulk_load(cls, path, data_it, capacity_max: int = 9, dist_function=dist_euclidean,
+                  split_function=split_data_random, vectorized: bool = False,
+                  buffer_pages: int = BUFFER_PAGES_DFLT, type_code: str = 'd'):
+        """
+        Builds new paged M-Tree from a whole dataset at once (see MTree.bulk_load())
+        :param path: path to the file (overwritten when it exists)
+        :param data_it: iterable of data to be inserted, object ids are assigned in the order of the data
+        :return: new paged M-Tree containing all the data (flushed to the file)
+        """
+        dataset = list(data_it)
+        if os.path.exists(path):
+            os.remove(path)
+        mtree = cls(path, dim=len(dataset[0]) if len(dataset) > 0 else 0, capacity_max=capacity_max,
+                    dist_function=dist_function, split_function=split_function, vectorized=vectorized,
+                    buffer_pages=buffer_pages, type_code=type_code)
+        # nodes are complete when they are put into the pool, so there is no need to pin them
+        if len(dataset) > 0:
+            mtree._bulk_build(mtree._ground_entries(dataset))
+        mtree.flush()
+        return mtree
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @write_locked
+    def add(self, data, oid: int = None, payload=None):
+        """
+        Adds new data into the M-Tree (see MTree.add())
+        :param data: data to be inserted
+        :param oid: integer object id, ids are assigned in the order of insertion by default
+        :param payload: not supported, only object ids are stored (ValueError is raised for any payload)
+        :return: success
+        """
+        if payload is not None:
+            raise ValueError('paged M-Tree can not store payloads')
+        self._pool.begin_write()
+        try:
+            return super(PagedMTree, self).add(data, oid)
+        finally:
+            self._pool.end_write()
+
+    def snapshot(self):
+        """
+        Snapshots are not supported, nodes are modified in place in their pages (TypeError is raised)
+        """
+        raise TypeError('paged trees do not support snapshots')
+
+    def _delete(self, data, oid):
+        """
+        Removes an object from the M-Tree, all pages accessed by the deletion are written back
+        :param data: data of the object to be removed
+        :param oid: object id of the object to be removed, any object with equal data when None
+        :return: ground entry of the removed object (None when there is no such object)
+        """
+        self._pool.begin_write()
+        try:
+            return super(PagedMTree, self)._delete(data, oid)
+        finally:
+            self._pool.end_write()
+
+    @write_locked
+    def flush(self):
+        """
+        Writes all the changes to the file
+        """
+        self._pool.flush()
+        if self._root is not None:
+            self._pool.write(ROOT_PAGE, self._encode(self._root))
+        self._pool.write(META_PAGE, _META.pack(MAGIC, VERSION, self._pool.page_size, self.capacity_max, self._dim,
+                                               self._type_code.encode(), self._leaf_type is not Leaf,
+                                               self._root is not None, self._pool.pages_num, self._pool.free_head,
+                                               self._next_oid))
+        self._f.flush()
+
+    @write_locked
+    def close(self):
+        """
+        Flushes the changes and closes the file, the tree can't be used anymore
+        """
+        if not self._f.closed:
+            self.flush()
+            self._f.close()
+
+    def _cost(self) -> tuple:
+        """
+        :return: number of distance function calls and number of page reads of the current thread so far
+        """
+        return self._dist_function.count, self._pool.local_reads
+
+    def _routing_entry(self, subtree, data, r: float = 0, parent_dist: float = 0):
+        """
+        :return: new routing entry pointing to the subtree node (stored to a new page)
+        """
+        return PagedRoutingEntry(self._pool, subtree=subtree, data=data, r=r, parent_dist=parent_dist)
+
+    def _encode(self, node) -> bytearray:
+        """
+        :return: page containing the node
+        """
+        kind = KIND_ROOT if isinstance(node, Root) else KIND_ROUTER if isinstance(node, Router) else KIND_LEAF
+        if len(node) > self.capacity_max + 1:
+            raise ValueError('node does not fit into a page')
+        page = bytearray(self._pool.page_size)
+        _NODE_HEADER.pack_into(page, 0, kind, len(node), node.r)
+        self._vector.pack_into(page, _NODE_HEADER.size, *node.data)
+        offset = _NODE_HEADER.size + self._vector.size
+        for entry in node._entries:
+            # routing entries point to the page of their subtree, ground entries keep the object id
+            reference = entry.oid if isinstance(entry, GroundEntry) else entry.page_id
+            self._entry.pack_into(page, offset, *entry.data, entry.r, entry.parent_dist, reference)
+            offset += self._entry.size
+        return page
+
+    def _decode(self, page: bytes):
+        """
+        :return: node stored in the page
+        """
+        kind, count, r = _NODE_HEADER.unpack_from(page)
+        data = self._vector.unpack_from(page, _NODE_HEADER.size)
+        entries = []
+        for values in self._entry.iter_unpack(page[_NODE_HEADER.size + self._vector.size:][:count * self._entry.size]):
+            entry_data, entry_r, parent_dist, reference = values[:-3], values[-3], values[-2], values[-1]
+            if kind == KIND_LEAF:
+                entries.append(GroundEntry(oid=reference, data=entry_data, parent_dist=parent_dist))
+            else:
+                entries.append(PagedRoutingEntry(self._pool, data=entry_data, r=entry_r,
+                                                 parent_dist=parent_dist, page_id=reference))
+        node_type = Root if kind == KIND_ROOT else Router if kind == KIND_ROUTER else self._leaf_type
+        return node_type(entries=entries,
+                         data=data,
+                         dist_function=self._dist_function,
+                         split_function=self.split_function,
+                         capacity=self.capacity_max,
+                         r=r)
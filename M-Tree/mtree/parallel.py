@@ -0,0 +1,145 @@
+"""
+    Parallel execution of query batches in a pool of worker processes
+
+    Workers don't get copies of the tree, each of them opens the same snapshot file as FrozenMTree,
+    so all the processes share one physical copy of the tree through the page cache
+"""
+
+import concurrent.futures as futures
+import math
+import os
+import tempfile
+
+from mtree.frozen import FrozenMTree
+from mtree.heuristics import dist_euclidean
+from mtree.stats import QueryStats
+
+# number of chunks each worker gets on average (more chunks balance the load better, fewer have less overhead)
+CHUNKS_PER_WORKER = 4
+
+# tree opened by the worker process
+_worker_tree = None
+
+
+class QueryExecutor:
+    """
+    Runs batches of range or knn queries in worker processes sharing one read-only snapshot of the tree
+
+    Queries are split into chunks, results are returned in the order of the queries
+    Snapshot reflects the tree at the time the executor was created, later changes of the tree are not seen
+    """
+
+    def __init__(self, tree, dist_function=dist_euclidean, workers: int = None):
+        """
+        :param tree: M-Tree to be queried (saved to a temporary snapshot file, see MTree.save()),
+        or path to a file already saved by MTree.save()
+        :param dist_function: metrics of the tree, has to be picklable (a module-level function or a metric object
+        of mtree.metrics), distance function of the tree is used when an M-Tree is passed
+        :param workers: number of worker processes, number of CPUs by default
+        """
+        self._snapshot = None
+        if isinstance(tree, (str, os.PathLike)):
+            path = tree
+        else:
+            # workers read the tree from a private snapshot, removed when the executor is closed
+            fd, path = tempfile.mkstemp(suffix='.mtree')
+            os.close(fd)
+            try:
+                tree.save(path)
+            except Exception:
+                # the tree can't be saved (e.g. not vectors of numbers), nothing is left behind
+                os.remove(path)
+                raise
+            self._snapshot = path
+            dist_function = tree._dist_function.dist_function
+        self.workers = os.cpu_count() if workers is None else workers
+        # cumulative stats of all queries (reported by the workers)
+        self.stats = QueryStats()
+        self._pool = futures.ProcessPoolExecutor(max_workers=self.workers, initializer=_open_tree,
+                                                 initargs=(path, dist_function))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        """
+        Stops the workers, removes the snapshot (when the executor created it)
+        """
+        self._pool.shutdown()
+        if self._snapshot is not None:
+            os.remove(self._snapshot)
+            self._snapshot = None
+
+    def range_query_many(self, queries, r, k=None, with_stats=False):
+        """
+        Runs range query for each of the queried objects in the worker processes
+        :param queries: iterable of query object data
+        :param r: query range
+        :param k: maximum number of objects to be found per query (closest ones are kept), unlimited by default
+        :param with_stats: return summary stats of the queries too
+        :return: list of results, one list of r-similar objects per query (and QueryStats when with_stats is set)
+        """
+        return self._run(queries, _range_queries, (r, k), with_stats)
+
+    def knn_query_many(self, queries, k, with_stats=False):
+        """
+        Runs knn query for each of the queried objects in the worker processes
+        :param queries: iterable of query object data
+        :param k: number of closest neighbours to be found
+        :param with_stats: return summary stats of the queries too
+        :return: list of results, one list of k most similar objects per query (and QueryStats when with_stats is set)
+        """
+        return self._run(queries, _knn_queries, (k,), with_stats)
+
+    def _run(self, queries, function, args, with_stats):
+        """
+        Splits the queries into chunks, runs the function on each chunk in a worker
+        :return: list of query results in the order of the queries (and QueryStats when with_stats is set)
+        """
+        queries = list(queries)
+        size = max(1, math.ceil(len(queries) / (self.workers * CHUNKS_PER_WORKER)))
+        chunks = [queries[i:i + size] for i in range(0, len(queries), size)]
+        results, stats = [], QueryStats()
+        # map keeps the order of the chunks
+        for chunk_results, chunk_stats in self._pool.map(function, chunks, *([arg] * len(chunks) for arg in args)):
+            results.extend(chunk_results)
+            stats += chunk_stats
+        self.stats += stats
+        return (results, stats) if with_stats else results
+
+
+def _open_tree(path, dist_function):
+    """
+    Initializes worker process, opens the snapshot
+    """
+    global _worker_tree
+    _worker_tree = FrozenMTree(path, dist_function)
+
+
+def _range_queries(queries, r, k):
+    """
+    :return: results of range queries of the chunk, summary stats of the chunk
+    """
+    stats = QueryStats()
+    results = []
+    for data in queries:
+        result, query_stats = _worker_tree.range_query(data, r, k, with_stats=True)
+        results.append(result)
+        stats += query_stats
+    return results, stats
+
+
+def _knn_queries(queries, k):
+    """
+    :return: results of knn queries of the chunk, summary stats of the chunk
+    """
+    stats = QueryStats()
+    results = []
+    for data in queries:
+        result, query_stats = _worker_tree.knn_query(data, k, with_stats=True)
+        results.append(result)
+        stats += query_stats
+    return results, stats
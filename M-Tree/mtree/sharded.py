@@ -0,0 +1,372 @@
+"""
+    Forest of independent M-Trees (shards), objects are partitioned between them
+
+    Each shard lives in its own worker process and is driven by messages over a pipe (stand-in for a remote call),
+    so the shards insert and search in parallel, results are merged by the forest
+"""
+
+import heapq
+import itertools
+import multiprocessing
+
+from mtree.mtree import MTree
+from mtree.heuristics import *
+from mtree.stats import DistanceCounter, QueryStats
+
+# partitioning of the objects between the shards
+# objects go to the shard of the closest pivot
+PARTITION_PIVOT = 'pivot'
+# objects go to the shards in turns by the hash of their object ids
+PARTITION_HASH = 'hash'
+
+
+class ShardedMTree:
+    """
+    Represents M-Tree partitioned into several shards, scatters the operations and gathers the results
+
+    Forest keeps center & covering radius of each shard (the radius never shrinks after deletions), shards which
+    can't contain any result of a query are skipped
+    Knn query searches the most promising shard first, the k-th distance found there bounds the search
+    of the other shards
+    """
+
+    def __init__(self, shards: int = 4, partitioning: str = PARTITION_PIVOT, processes: bool = True,
+                 capacity_max: int = 9, dist_function=dist_euclidean, split_function=split_data_random,
+                 vectorized: bool = False, pivots=None):
+        """
+        :param shards: number of shards
+        :param partitioning: PARTITION_PIVOT or PARTITION_HASH
+        :param processes: run each shard in a worker process (functions have to be picklable then),
+        shards are kept in this process otherwise
+        :param capacity_max: maximal number of objects any node of the shards can store
+        :param dist_function: metrics used to determine distance of 2 data objects
+        :param split_function: split heuristics function of the shards
+        :param vectorized: keep data of leafs of the shards in NumPy arrays (requires NumPy)
+        :param pivots: data of the pivots of the shards (pivot partitioning only),
+        first objects inserted into the forest become the pivots by default
+        """
+        if partitioning not in (PARTITION_PIVOT, PARTITION_HASH):
+            raise ValueError(f'unknown partitioning: {partitioning}')
+        if pivots is not None and len(pivots) != shards:
+            raise ValueError('there has to be one pivot per shard')
+        self.partitioning = partitioning
+        options = dict(capacity_max=capacity_max, dist_function=dist_function, split_function=split_function,
+                       vectorized=vectorized)
+        self._shards = [_ProcessShard(options) if processes else _LocalShard(options) for _ in range(shards)]
+        # center & covering radius of each shard (center is None until the shard gets its first object)
+        self._centers = [None] * shards if pivots is None else list(pivots)
+        self._radii = [0] * shards
+        self._next_oid = 0
+        # distances counted by the forest itself (routing to the shards & skipping them)
+        self._dist_function = DistanceCounter(dist_function)
+        # cumulative stats of all queries
+        self.stats = QueryStats()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        """
+        Stops worker processes of the shards
+        """
+        for shard in self._shards:
+            shard.close()
+
+    def add(self, data, oid: int = None, payload=None):
+        """
+        Adds new data into the shard it belongs to
+        :param data: data to be inserted
+        :param oid: integer object id, ids are assigned in the order of insertion by default
+        :param payload: any object to be returned along with the data by queries (optional)
+        :return: success
+        """
+        return self.add_many([data], None if payload is None else [payload], None if oid is None else [oid]) == 1
+
+    def add_many(self, data_it, payloads=None, oids=None):
+        """
+        Adds all the data, shards insert their parts in parallel
+        :param data_it: iterable of data to be inserted
+        :param payloads: iterable of payloads of the data (in the same order), no payloads by default
+        :param oids: iterable of object ids of the data (in the same order), assigned in the order of the data by default
+        :return: number of objects added
+        """
+        parts = [[] for _ in self._shards]
+        payloads = itertools.repeat(None) if payloads is None else payloads
+        oids = itertools.repeat(None) if oids is None else oids
+        for data, payload, oid in zip(data_it, payloads, oids):
+            if oid is None:
+                oid = self._next_oid
+            self._next_oid = max(self._next_oid, oid + 1)
+            parts[self._route(data, oid)].append((data, oid, payload))
+        # scatter, then gather
+        busy = [shard for shard, part in zip(self._shards, parts) if len(part) > 0]
+        for shard, part in zip(self._shards, parts):
+            if len(part) > 0:
+                shard.send('add_all', part)
+        return sum(_receive_all(busy))
+
+    def delete(self, data, oid: int = None):
+        """
+        Removes an object from the shard it is stored in
+        :param data: data to be removed
+        :param oid: object id of the object to be removed, any object with equal data by default
+        :return: success
+        """
+        if self.partitioning == PARTITION_PIVOT:
+            # equally close pivots (duplicate data) can all store the object
+            shards = [self._shards[i] for i in self._closest_pivots(data)]
+        elif oid is not None:
+            shards = [self._shards[hash(oid) % len(self._shards)]]
+        else:
+            # any shard can store the data
+            shards = self._shards
+        if oid is None:
+            # several shards might store equal data, only one object is removed, shards are tried one by one
+            for shard in shards:
+                shard.send('delete', data, oid)
+                if shard.receive():
+                    return True
+            return False
+        for shard in shards:
+            shard.send('delete', data, oid)
+        # every shard has to answer, even when the object was already found
+        return any(_receive_all(shards))
+
+    def range_query(self, data, r, k=None, with_stats=False):
+        """
+        Finds all object within the range from the data object, searches the shards in parallel
+        :param data: query object data
+        :param r: query range
+        :param k: maximum number of objects to be found (closest ones are kept), unlimited by default
+        :param with_stats: return stats of the query too
+        :return: list of r-similar objects (and QueryStats when with_stats is set)
+        """
+        stats = QueryStats()
+        dist_calls = self._dist_function.count
+        shards = [i for i, d_min in self._lower_bounds(data) if d_min <= r]
+        stats.pruned_radius += len(self._shards) - len(shards)
+        results = self._gather(shards, 'range_query', (data, r, k), stats)
+        return self._finish_query(results, k, stats, dist_calls, with_stats)
+
+    def knn_query(self, data, k, with_stats=False):
+        """
+        Finds k objects closest to the queried one
+        Searches the most promising shard first, then the other shards in parallel, within the k-th distance found
+        :param data: query object data
+        :param k: number of closest neighbours to be found
+        :param with_stats: return stats of the query too
+        :return: list of k (or less, in case there is not enough objects) most similar objects
+        (and QueryStats when with_stats is set)
+        """
+        stats = QueryStats()
+        dist_calls = self._dist_function.count
+        bounds = sorted(self._lower_bounds(data), key=lambda bound: bound[1])
+        results = []
+        if len(bounds) > 0 and k > 0:
+            # (1) the closest shard gives the first k-th distance bound
+            results += self._gather([bounds[0][0]], 'knn_query', (data, k), stats)
+            r = results[0][-1].d if len(results[0]) == k else INFINITY
+            # (2) other shards only search within the bound, shards outside of it are skipped
+            shards = [i for i, d_min in bounds[1:] if d_min <= r]
+            stats.pruned_radius += len(self._shards) - 1 - len(shards)
+            results += self._gather(shards, 'range_query', (data, r, k), stats)
+        return self._finish_query(results, k, stats, dist_calls, with_stats)
+
+    def _route(self, data, oid) -> int:
+        """
+        Picks shard of new object, updates center & radius of the shard
+        :return: index of the shard
+        """
+        if self.partitioning == PARTITION_PIVOT:
+            # first objects become the pivots
+            if None in self._centers:
+                i = self._centers.index(None)
+                self._centers[i] = data
+                return i
+            i, d = self._closest_pivot(data)
+        else:
+            i = hash(oid) % len(self._shards)
+            if self._centers[i] is None:
+                self._centers[i] = data
+                return i
+            d = self._dist_function(data, self._centers[i])
+        self._radii[i] = max(self._radii[i], d)
+        return i
+
+    def _closest_pivot(self, data) -> (int, float):
+        """
+        :return: index of the shard of the closest pivot, distance to the pivot
+        """
+        distances = self._dist_function.one_to_many(data, self._centers)
+        i = min(range(len(distances)), key=lambda j: distances[j])
+        return i, distances[i]
+
+    def _closest_pivots(self, data) -> list:
+        """
+        :return: indices of the shards of the closest pivots (more of them when the pivots are equally close),
+        only shards which got their pivot are considered
+        """
+        shards = [i for i, center in enumerate(self._centers) if center is not None]
+        distances = self._dist_function.one_to_many(data, [self._centers[i] for i in shards])
+        d_min = min(distances, default=None)
+        return [i for i, d in zip(shards, distances) if d == d_min]
+
+    def _lower_bounds(self, data) -> list:
+        """
+        :return: list of (index, lower bound of distance between the data and any object of the shard) pairs
+        of all non-empty shards
+        """
+        shards = [i for i, center in enumerate(self._centers) if center is not None]
+        distances = self._dist_function.one_to_many(data, [self._centers[i] for i in shards])
+        return [(i, max(d - self._radii[i], 0)) for i, d in zip(shards, distances)]
+
+    def _gather(self, shards, name, args, stats) -> list:
+        """
+        Runs the query on the shards in parallel
+        :return: list of sorted query results, one per shard
+        """
+        for i in shards:
+            self._shards[i].send(name, *args, with_stats=True)
+        results = []
+        for result, shard_stats in _receive_all([self._shards[i] for i in shards]):
+            results.append(result)
+            stats += shard_stats
+        return results
+
+    def _finish_query(self, results, k, stats, dist_calls, with_stats):
+        """
+        Merges sorted results of the shards, completes stats of the query
+        :return: query result (and QueryStats when with_stats is set)
+        """
+        merged = heapq.merge(*results, key=lambda found: found.d)
+        result = list(merged if k is None else itertools.islice(merged, k))
+        stats.queries = 1
+        stats.dist_calls += self._dist_function.count - dist_calls
+        self.stats += stats
+        return (result, stats) if with_stats else result
+
+
+class _LocalShard:
+    """
+    Shard kept in the same process, operations run one after another
+    """
+
+    def __init__(self, options):
+        """
+        :param options: parameters of the M-Tree of the shard
+        """
+        self._tree = MTree(**options)
+        self._result = None
+
+    def send(self, name, *args, **kwargs):
+        """
+        Runs operation of the shard, its error is raised by receive() (same as by a worker process)
+        :param name: name of the operation (method of the tree or 'add_all')
+        """
+        try:
+            self._result = (False, _call(self._tree, name, args, kwargs))
+        except Exception as e:
+            self._result = (True, e)
+
+    def receive(self):
+        """
+        :return: result of the last operation
+        """
+        failed, result = self._result
+        if failed:
+            raise result
+        return result
+
+    def close(self):
+        pass
+
+
+class _ProcessShard:
+    """
+    Shard served by a worker process, operations are sent over a pipe and run in the background
+    """
+
+    def __init__(self, options):
+        """
+        :param options: parameters of the M-Tree of the shard
+        """
+        self._conn, conn = multiprocessing.Pipe()
+        self._process = multiprocessing.Process(target=_serve, args=(conn, options), daemon=True)
+        self._process.start()
+        conn.close()
+
+    def send(self, name, *args, **kwargs):
+        """
+        Starts operation of the shard, doesn't wait for the result
+        :param name: name of the operation (method of the tree or 'add_all')
+        """
+        self._conn.send((name, args, kwargs))
+
+    def receive(self):
+        """
+        Waits for the result of the operation sent before
+        :return: result of the operation
+        """
+        failed, result = self._conn.recv()
+        if failed:
+            raise result
+        return result
+
+    def close(self):
+        """
+        Stops the worker process
+        """
+        if self._process.is_alive():
+            self._conn.send(None)
+            self._process.join()
+        self._conn.close()
+
+
+def _receive_all(shards) -> list:
+    """
+    Waits for the results of all the shards, even when some of them failed (no result is left in the pipes)
+    :param shards: shards the operation was sent to
+    :return: list of results, one per shard
+    :raise: the first error of the shards
+    """
+    results, error = [], None
+    for shard in shards:
+        try:
+            results.append(shard.receive())
+        except Exception as e:
+            if error is None:
+                error = e
+    if error is not None:
+        raise error
+    return results
+
+
+def _serve(conn, options):
+    """
+    Main loop of worker process of a shard, runs operations until None is received
+    """
+    tree = MTree(**options)
+    while True:
+        message = conn.recv()
+        if message is None:
+            break
+        name, args, kwargs = message
+        try:
+            conn.send((False, _call(tree, name, args, kwargs)))
+        except Exception as e:
+            conn.send((True, e))
+    conn.close()
+
+
+def _call(tree, name, args, kwargs):
+    """
+    Runs operation on the tree of a shard
+    :return: result of the operation
+    """
+    if name == 'add_all':
+        # (data, object id, payload) triples
+        return sum(tree.add(data, oid, payload) for data, oid, payload in args[0])
+    return getattr(tree, name)(*args, **kwargs)
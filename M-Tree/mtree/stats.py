@@ -0,0 +1,113 @@
+"""
+    Instrumentation of M-Tree operations (distance computations, visited & pruned nodes)
+"""
+
+import threading
+
+
+class DistanceCounter:
+    """
+    Wraps a distance function, counts how many times it was called
+
+    Provides batch interface (see mtree.metrics), batch distances are counted one by one
+    when the wrapped function doesn't provide it
+    Each thread has its own count, queries running together in several threads only see their own distances
+    """
+
+    def __init__(self, dist_function):
+        """
+        :param dist_function: distance function to be wrapped
+        """
+        self.dist_function = dist_function
+        self._local = threading.local()
+
+    def __getstate__(self):
+        # counts of the threads can't be pickled
+        return {'dist_function': self.dist_function}
+
+    def __setstate__(self, state):
+        self.__init__(state['dist_function'])
+
+    def __call__(self, a, b):
+        self._local.count = self.count + 1
+        return self.dist_function(a, b)
+
+    @property
+    def count(self) -> int:
+        """
+        :return: number of distances counted by the current thread so far
+        """
+        return getattr(self._local, 'count', 0)
+
+    @property
+    def batched(self) -> bool:
+        """
+        :return: True when the wrapped distance function provides batch interface
+        """
+        return getattr(self.dist_function, 'batched', False)
+
+    def one_to_many(self, data, others):
+        """
+        :param data: data object
+        :param others: sequence of data objects
+        :return: distances between the data and each of the others
+        """
+        self._local.count = self.count + len(others)
+        if self.batched:
+            return self.dist_function.one_to_many(data, others)
+        return [self.dist_function(data, other) for other in others]
+
+    def many_to_many(self, data_all, others):
+        """
+        :param data_all: sequence of data objects
+        :param others: sequence of data objects
+        :return: matrix of distances, one row for each of data_all, one column for each of the others
+        """
+        self._local.count = self.count + len(data_all) * len(others)
+        if self.batched:
+            return self.dist_function.many_to_many(data_all, others)
+        return [[self.dist_function(data, other) for other in others] for data in data_all]
+
+
+class QueryStats:
+    """
+    Cost of one or more queries
+
+    Number of distance computations is the standard cost metric of metric access methods
+    """
+
+    def __init__(self):
+        # number of queries the stats belong to
+        self.queries = 0
+        # number of distance function calls
+        self.dist_calls = 0
+        # number of pages read from the disk (paged trees only)
+        self.page_reads = 0
+        # number of nodes searched
+        self.nodes_visited = 0
+        # number of subtrees skipped thanks to the stored distance to the parent (no distance computed)
+        self.pruned_parent_dist = 0
+        # number of subtrees skipped because the query doesn't intersect their covering radius
+        self.pruned_radius = 0
+        # guaranteed relative error of approximate results (worst of the queries), 0 for exact results:
+        # distance of each found object is at most (1 + error_bound) times the distance of the exact one
+        self.error_bound = 0
+
+    def __iadd__(self, other):
+        """
+        Accumulates stats of other queries
+        """
+        self.queries += other.queries
+        self.dist_calls += other.dist_calls
+        self.page_reads += other.page_reads
+        self.nodes_visited += other.nodes_visited
+        self.pruned_parent_dist += other.pruned_parent_dist
+        self.pruned_radius += other.pruned_radius
+        self.error_bound = max(self.error_bound, other.error_bound)
+        return self
+
+    def __str__(self):
+        return f'queries: {self.queries}, distance calls: {self.dist_calls}, page reads: {self.page_reads}, ' \
+               f'nodes visited: {self.nodes_visited}, ' \
+               f'pruned by parent distance: {self.pruned_parent_dist}, pruned by radius: {self.pruned_radius}, ' \
+               f'error bound: {self.error_bound}'
@@ -1,9 +1,8 @@
 from tkinter import *
 from tkinter import messagebox
 
-from mtree.mtree import MTree
 from test.testgui import TestGUI
-from _pickle_handler import *
+from _storage_handler import *
 from _mtreegui import MTreeGui
 
 
@@ -43,8 +42,8 @@ class Program:
         """
         Runs M-Tree app with new blank M-Tree
         """
-        # init new M-Tree
-        self._tree = MTree(split_function=split_data_perfect)
+        # init new M-Tree (replaces the saved one)
+        self._tree = new_mtree()
         print(self._tree)
         # run M-Tree GUI app
         self._run_mtree_app()
@@ -53,10 +52,10 @@ class Program:
         """
         Runs M-Tree app with new sample generated M-Tree
         """
-        # generate new pickle file
-        generate_pkl()
+        # generate new stored M-Tree
+        generate_sample()
         # load the M-Tree
-        self._tree = load_from_pkl()
+        self._tree = load_tree()
         # run M-Tree GUI app
         self._run_mtree_app()
 
@@ -66,7 +65,7 @@ class Program:
         :return:
         """
         # try to load mtree
-        self._tree = load_from_pkl()
+        self._tree = load_tree()
 
         if self._tree is None:
             # loading failed
@@ -84,4 +83,4 @@ class Program:
             # destroy main window
             self._window.destroy()
             # run the app with current M-Tree, save the result
-            save_to_pkl(MTreeGui(self._tree).run())
+            save_tree(MTreeGui(self._tree).run())
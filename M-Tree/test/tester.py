@@ -1,9 +1,27 @@
+import asyncio
+import gc
+import itertools
 import logging
+import math
+import os
+import random
+import shutil
+import tempfile
 import time
+import tracemalloc
 from pathlib import Path
 import concurrent.futures as futures
 
+from mtree._vectorized import np
+from mtree.aio import AsyncMTree
+from mtree.durable import DurableMTree
+from mtree.frozen import FrozenMTree
+from mtree.metrics import chebyshev, euclidean, manhattan
 from mtree.mtree import MTree
+from mtree.paged import PagedMTree
+from mtree.parallel import QueryExecutor
+from mtree.sharded import ShardedMTree, PARTITION_HASH, PARTITION_PIVOT
+from mtree.stats import DistanceCounter
 from test.engine import parser
 from test.engine.generator import Generator
 from test._config import *
@@ -40,6 +58,48 @@ class Tester:
         filename = self._get_logs_filename()
         self._init_logger(console, file, filename)
 
+    def test_all(self) -> list:
+        """
+        Runs all the tests (the results are compared with brute force search of the data where possible)
+        :return: names of the failed tests
+        """
+        failed = []
+        # in the order of the features, basic ones first
+        for test in (self.test_add_remove,
+                     self.test_queries,
+                     self.test_limited_range,
+                     self.test_metrics,
+                     self.test_bulk_load,
+                     self.test_promotion_policies,
+                     self.test_stats,
+                     self.test_vectorized,
+                     self.test_batch_metrics,
+                     self.test_batch_queries,
+                     self.test_save_load,
+                     self.test_frozen,
+                     self.test_paged,
+                     self.test_delete,
+                     self.test_locator,
+                     self.test_payloads,
+                     self.test_iter_nearest,
+                     self.test_approximate_knn,
+                     self.test_joins,
+                     self.test_executor,
+                     self.test_sharded,
+                     self.test_sharded_delete,
+                     self.test_concurrent_stats,
+                     self.test_concurrent_writes,
+                     self.test_snapshots,
+                     self.test_durable_recovery,
+                     self.test_async):
+            result = test()
+            # some tests report more results, skipped tests return None
+            results = result if isinstance(result, tuple) else (result,)
+            if False in results:
+                failed.append(test.__name__)
+        self._logger.info(f'ALL TESTS RESULT: {self._get_result_str(len(failed) == 0)}\n')
+        return failed
+
     def test_add_remove(self):
         """
         Tests data insertion & deletion from an M-Tree
@@ -78,15 +138,641 @@ class Tester:
                           f' | remove: {self._get_result_str(success_remove)}\n')
         return success_add, success_remove
 
+    def test_sharded_delete(self):
+        """
+        Tests deletion from a sharded M-Tree, also before all the pivots of the shards are known
+        (duplicate data become several equal pivots then)
+        :return: success
+        """
+        success = True
+        self._logger.info('Testing ShardedMTree.delete()\n')
+        fng = Generator().data_file_name_generator()
+        for i in range(TESTS_NUM):
+            dataset = list(parser.read_dataset(PATH_TEST + next(fng)))
+            with ShardedMTree(processes=False) as forest:
+                # (1) the first object twice, only two of the pivots are known, each copy is deleted once
+                test_ok = forest.add(dataset[0]) and forest.add(dataset[0])
+                test_ok = test_ok and forest.delete(dataset[0]) and forest.delete(dataset[0])
+                test_ok = test_ok and not forest.delete(dataset[0])
+                # (2) all the data
+                forest.add_many(dataset)
+                test_ok = test_ok and all(forest.delete(data) for data in dataset)
+                test_ok = test_ok and len(forest.range_query(dataset[0], INFINITY)) == 0
+            success = success and test_ok
+            self._logger.debug(f'Sharded deletion test {i}: {test_ok}\n')
+        self._logger.info(f'TEST RESULT - sharded delete: {self._get_result_str(success)}\n')
+        return success
+
+    def test_concurrent_stats(self, threads: int = 8):
+        """
+        Tests that queries running together in several threads report the same stats as when they run alone
+        :param threads: number of threads querying the tree
+        :return: success
+        """
+        success = True
+        self._logger.info('Testing stats of concurrent queries\n')
+        fng_add = Generator().data_file_name_generator()
+        fng_knn_q = Generator().knn_q_file_name_generator()
+        # (k, data) pairs of all the knn queries
+        queries = [query for _ in range(QUERY_NUM) for query in parser.read_query_knn(PATH_TEST + next(fng_knn_q))]
+        for i in range(TESTS_NUM):
+            mtree = self._init_mtree(parser.read_dataset(PATH_TEST + next(fng_add)), split_data_smart)
+
+            def query(k_data):
+                k, data = k_data
+                return mtree.knn_query(data, k, with_stats=True)[1].dist_calls
+
+            # (1) one query after another, (2) all the queries at once
+            alone = [query(k_data) for k_data in queries]
+            with futures.ThreadPoolExecutor(max_workers=threads) as executor:
+                together = list(executor.map(query, queries))
+            test_ok = alone == together
+            success = success and test_ok
+            self._logger.debug(f'Concurrent stats test {i}: {test_ok}\n')
+        self._logger.info(f'TEST RESULT - concurrent stats: {self._get_result_str(success)}\n')
+        return success
+
+    def test_durable_recovery(self):
+        """
+        Tests recovery of a durable M-Tree after a simulated crash (the files are copied while the tree is open,
+        the log ends with a torn record), the recovered tree has to contain the same objects
+        and answer queries as brute force search of them
+        :return: success
+        """
+        success = True
+        range_queries, knn_queries = self._read_queries()
+        self._logger.info('Testing DurableMTree recovery\n')
+        fng = Generator().data_file_name_generator()
+        with tempfile.TemporaryDirectory() as directory:
+            for i in range(TESTS_NUM):
+                dataset = [tuple(map(float, data)) for data in parser.read_dataset(PATH_TEST + next(fng))]
+                path, crashed = os.path.join(directory, f'live_{i}'), os.path.join(directory, f'crashed_{i}')
+                # checkpoints happen a few times, the last operations are only in the log
+                with DurableMTree(path, dim=len(dataset[0]), checkpoint_every=len(dataset) // 3) as mtree:
+                    for data in dataset:
+                        mtree.add(data)
+                    for data in dataset[::2]:
+                        mtree.delete(data)
+                    expected = sorted((found.oid, found.data) for found in mtree.range_query(dataset[0], INFINITY))
+                    # (1) crash, the files are left as they are
+                    for suffix in ('', '.wal'):
+                        shutil.copyfile(path + suffix, crashed + suffix)
+                    with open(crashed + '.wal', 'ab') as log:
+                        log.write(b'\xff\x00\x00\x00torn')
+                # (2) recovery, also compared with brute force search of the data left
+                with DurableMTree(crashed) as recovered:
+                    found = sorted((found.oid, found.data) for found in recovered.range_query(dataset[0], INFINITY))
+                    test_ok = found == expected and \
+                        self._check_queries(recovered, dataset[1::2], range_queries, knn_queries)
+                success = success and test_ok
+                self._logger.debug(f'Durable recovery test {i}: {test_ok}\n')
+        self._logger.info(f'TEST RESULT - durable recovery: {self._get_result_str(success)}\n')
+        return success
+
+    def test_queries(self):
+        """
+        Tests range & knn queries (best-first search) against brute force search of the data
+        :return: success
+        """
+        range_queries, knn_queries = self._read_queries()
+
+        def check(dataset):
+            mtree = self._init_mtree(dataset, split_data_smart)
+            return self._check_queries(mtree, dataset, range_queries, knn_queries)
+
+        return self._test_datasets('queries', check)
+
+    def test_bulk_load(self):
+        """
+        Tests M-Tree built by MTree.bulk_load() against brute force search of the data, also after more insertions
+        :return: success
+        """
+        range_queries, knn_queries = self._read_queries()
+
+        def check(dataset):
+            half = len(dataset) // 2
+            mtree = MTree.bulk_load(dataset[:half], split_function=split_data_smart)
+            test_ok = self._check_queries(mtree, dataset[:half], range_queries, knn_queries)
+            # the tree keeps growing by insertions
+            for data in dataset[half:]:
+                mtree.add(data)
+            return test_ok and self._check_queries(mtree, dataset, range_queries, knn_queries)
+
+        return self._test_datasets('bulk load', check)
+
+    def test_vectorized(self):
+        """
+        Tests M-Tree with NumPy array-backed leafs against brute force search of the data, after insertions
+        (also into a bulk-loaded tree) and deletions
+        :return: success (None when NumPy is not installed)
+        """
+        if np is None:
+            self._logger.info('TEST SKIPPED - vectorized leafs: NumPy is not installed\n')
+            return None
+        range_queries, knn_queries = self._read_queries()
+
+        def check(dataset):
+            half = len(dataset) // 2
+            test_ok = True
+            # (tree, data still to be added) pairs
+            trees = [(MTree(split_function=split_data_smart, vectorized=True), dataset),
+                     (MTree.bulk_load(dataset[:half], split_function=split_data_smart, vectorized=True),
+                      dataset[half:])]
+            for mtree, rest in trees:
+                # (1) all the data
+                for data in rest:
+                    mtree.add(data)
+                test_ok = test_ok and self._check_queries(mtree, dataset, range_queries, knn_queries)
+                # (2) half of the data is deleted
+                test_ok = test_ok and all(mtree.delete(data) for data in dataset[:half])
+                test_ok = test_ok and self._check_queries(mtree, dataset[half:], range_queries, knn_queries)
+            return test_ok
+
+        return self._test_datasets('vectorized leafs', check)
+
+    def test_batch_queries(self):
+        """
+        Tests batch queries (MTree.range_query_many() & MTree.knn_query_many()) against brute force search of the data
+        :return: success
+        """
+        range_queries, knn_queries = self._read_queries()
+
+        def check(dataset):
+            mtree = self._init_mtree(dataset, split_data_smart)
+            return self._check_queries_many(mtree, dataset, range_queries, knn_queries)
+
+        return self._test_datasets('batch queries', check)
+
+    def test_save_load(self):
+        """
+        Tests M-Tree saved by MTree.save() & loaded by MTree.load() against brute force search of the data,
+        also after more insertions & deletions of the loaded tree
+        :return: success
+        """
+        range_queries, knn_queries = self._read_queries()
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'tree')
+
+            def check(dataset):
+                half = len(dataset) // 2
+                self._init_mtree(dataset[:half], split_data_smart).save(path)
+                mtree = MTree.load(path, split_function=split_data_smart)
+                test_ok = self._check_queries(mtree, dataset[:half], range_queries, knn_queries)
+                # the loaded tree can be modified
+                for data in dataset[half:]:
+                    mtree.add(data)
+                test_ok = test_ok and all(mtree.delete(data) for data in dataset[:half])
+                return test_ok and self._check_queries(mtree, dataset[half:], range_queries, knn_queries)
+
+            return self._test_datasets('save & load', check)
+
+    def test_frozen(self):
+        """
+        Tests memory-mapped FrozenMTree against brute force search of the data, half of the data is deleted
+        before the tree is saved (shrunk and merged nodes are saved too)
+        :return: success
+        """
+        range_queries, knn_queries = self._read_queries()
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'tree')
+
+            def check(dataset):
+                half = len(dataset) // 2
+                mtree = self._init_mtree(dataset, split_data_smart)
+                for data in dataset[:half]:
+                    mtree.delete(data)
+                mtree.save(path)
+                with FrozenMTree(path) as frozen:
+                    return self._check_queries(frozen, dataset[half:], range_queries, knn_queries)
+
+            return self._test_datasets('frozen', check)
+
+    def test_paged(self, buffer_pages: int = 8):
+        """
+        Tests paged M-Tree against brute force search of the data, the buffer pool is small, so the nodes
+        are evicted to the file and read again, then the reopened file is tested too
+        :param buffer_pages: maximal number of pages kept in memory
+        :return: success
+        """
+        range_queries, knn_queries = self._read_queries()
+
+        def check(dataset):
+            half = len(dataset) // 2
+            with tempfile.TemporaryDirectory() as directory:
+                path = os.path.join(directory, 'tree')
+                with PagedMTree(path, dim=len(dataset[0]), split_function=split_data_smart, type_code='q',
+                                buffer_pages=buffer_pages) as mtree:
+                    for data in dataset:
+                        mtree.add(data)
+                    test_ok = all(mtree.delete(data) for data in dataset[:half])
+                    test_ok = test_ok and self._check_queries(mtree, dataset[half:], range_queries, knn_queries)
+                # (2) the tree is read from the file again
+                with PagedMTree(path, buffer_pages=buffer_pages) as mtree:
+                    return test_ok and self._check_queries(mtree, dataset[half:], range_queries, knn_queries)
+
+        return self._test_datasets('paged', check)
+
+    def test_delete(self, capacity_max: int = 4, seed: int = 0):
+        """
+        Tests M-Tree against brute force search of the data while objects are deleted in random order
+        (small nodes underflow often, so they are merged, borrow objects and shrink their radii)
+        :param capacity_max: maximal number of objects any node can store
+        :param seed: seed of the order of the deletions
+        :return: success
+        """
+        range_queries, knn_queries = self._read_queries()
+        rand = random.Random(seed)
+
+        def check(dataset):
+            mtree = MTree(capacity_max=capacity_max, split_function=split_data_smart)
+            for data in dataset:
+                mtree.add(data)
+            remaining = dataset[:]
+            rand.shuffle(remaining)
+            test_ok = True
+            # check after each quarter of the data is deleted
+            while test_ok and len(remaining) > 0:
+                for data in remaining[:len(dataset) // 4]:
+                    test_ok = test_ok and mtree.delete(data)
+                remaining = remaining[len(dataset) // 4:]
+                test_ok = test_ok and self._check_queries(mtree, remaining, range_queries, knn_queries)
+            return test_ok
+
+        return self._test_datasets('delete', check)
+
+    def test_locator(self):
+        """
+        Tests targeted deletion (M-Tree with locator) against brute force search of the data,
+        objects are deleted & moved by MTree.update() using their ids
+        :return: success
+        """
+        range_queries, knn_queries = self._read_queries()
+
+        def check(dataset):
+            half = len(dataset) // 2
+            mtree = MTree(split_function=split_data_smart, locate=True)
+            test_ok = all(mtree.add(data, oid) for oid, data in enumerate(dataset))
+            # (1) ids are unique
+            test_ok = test_ok and not mtree.add(dataset[0], 0)
+            # (2) objects of the first half are deleted, objects of the second half are moved to their data
+            for oid in range(half):
+                test_ok = test_ok and mtree.delete(dataset[oid], oid)
+            for oid, new_data in zip(range(half, len(dataset)), dataset):
+                test_ok = test_ok and mtree.update(dataset[oid], new_data, oid)
+            # (3) deleted ids are not found anymore
+            test_ok = test_ok and not mtree.delete(dataset[0], 0)
+            moved = dataset[:len(dataset) - half]
+            return test_ok and self._check_queries(mtree, moved, range_queries, knn_queries)
+
+        return self._test_datasets('locator', check)
+
+    def test_iter_nearest(self):
+        """
+        Tests incremental nearest neighbour search (MTree.iter_nearest()) against brute force search of the data,
+        first k objects of each knn query, all the objects for the first one
+        :return: success
+        """
+        _, knn_queries = self._read_queries()
+
+        def check(dataset):
+            mtree = self._init_mtree(dataset, split_data_smart)
+            test_ok = all(self._same_distances(list(itertools.islice(mtree.iter_nearest(data), k)),
+                                               self._brute_force_knn(dataset, data, k))
+                          for k, data in knn_queries)
+            data = knn_queries[0][1]
+            return test_ok and self._same_distances(list(mtree.iter_nearest(data)),
+                                                    self._brute_force_knn(dataset, data, len(dataset)))
+
+        return self._test_datasets('iter nearest', check)
+
+    def test_approximate_knn(self, epsilon: float = 0.5, max_leafs: int = 20):
+        """
+        Tests approximate knn queries against brute force search of the data, distance of each found object
+        has to be within the reported error bound (and within the allowed relative error) of the exact one
+        :param epsilon: allowed relative error
+        :param max_leafs: maximal number of leafs searched by the queries with limited budget
+        :return: success
+        """
+        _, knn_queries = self._read_queries()
+
+        def within_bound(found, expected, error_bound) -> bool:
+            return len(found) == len(expected) and \
+                all(x.d <= (1 + error_bound) * d + 1e-9 for x, d in zip(found, expected))
+
+        def check(dataset):
+            mtree = self._init_mtree(dataset, split_data_smart)
+            test_ok = True
+            for k, data in knn_queries:
+                expected = self._brute_force_knn(dataset, data, k)
+                # (1) allowed relative error, (2) limited number of leafs
+                found, stats = mtree.knn_query(data, k, with_stats=True, epsilon=epsilon)
+                test_ok = test_ok and stats.error_bound <= epsilon and within_bound(found, expected, epsilon)
+                found, stats = mtree.knn_query(data, k, with_stats=True, max_leafs=max_leafs)
+                # nothing is guaranteed when the budget runs out too early (e.g. before k objects are found)
+                test_ok = test_ok and (stats.error_bound == INFINITY or
+                                       within_bound(found, expected, stats.error_bound))
+            return test_ok
+
+        return self._test_datasets('approximate knn', check)
+
+    def test_joins(self, r: float = 100, k: int = 5):
+        """
+        Tests similarity joins (self-join & join of two trees) and knn graph against brute force search of the data
+        :param r: maximal distance of the objects of a pair
+        :param k: number of neighbours of each object in the knn graph
+        :return: success
+        """
+        def check(dataset):
+            half = len(dataset) // 2
+            mtree = self._init_mtree(dataset, split_data_smart)
+            # (1) self-join, each pair once
+            expected = sorted(d for i, first in enumerate(dataset) for second in dataset[i + 1:]
+                              for d in (dist_euclidean(first, second),) if d <= r)
+            test_ok = self._same_distances(mtree.similarity_join(mtree, r), expected)
+            # (2) join of two trees
+            first_tree = self._init_mtree(dataset[:half], split_data_smart)
+            second_tree = self._init_mtree(dataset[half:], split_data_smart)
+            expected = sorted(d for first in dataset[:half] for second in dataset[half:]
+                              for d in (dist_euclidean(first, second),) if d <= r)
+            test_ok = test_ok and self._same_distances(first_tree.similarity_join(second_tree, r), expected)
+            # (3) knn graph, object ids are indices of the data
+            graph = mtree.knn_graph(k)
+            return test_ok and len(graph) == len(dataset) and \
+                all(self._same_distances(graph[oid], self._brute_force_knn(dataset[:oid] + dataset[oid + 1:], data, k))
+                    for oid, data in enumerate(dataset))
+
+        return self._test_datasets('joins', check)
+
+    def test_executor(self, workers: int = 2):
+        """
+        Tests queries run in worker processes (QueryExecutor) against brute force search of the data,
+        the tree is modified after the executor is created (the workers don't see the changes)
+        :param workers: number of worker processes
+        :return: success
+        """
+        range_queries, knn_queries = self._read_queries()
+
+        def check(dataset):
+            half = len(dataset) // 2
+            mtree = self._init_mtree(dataset[:half], split_data_smart)
+            with QueryExecutor(mtree, workers=workers) as executor:
+                for data in dataset[half:]:
+                    mtree.add(data)
+                return self._check_queries_many(executor, dataset[:half], range_queries, knn_queries)
+
+        return self._test_datasets('executor', check)
+
+    def test_sharded(self):
+        """
+        Tests scatter-gather queries of sharded M-Tree (both partitionings, shards in worker processes too)
+        against brute force search of the data
+        :return: success
+        """
+        range_queries, knn_queries = self._read_queries()
+
+        def check(dataset):
+            half = len(dataset) // 2
+            test_ok = True
+            for partitioning, processes in ((PARTITION_PIVOT, False), (PARTITION_HASH, False), (PARTITION_PIVOT, True)):
+                with ShardedMTree(partitioning=partitioning, processes=processes,
+                                  split_function=split_data_smart) as forest:
+                    forest.add_many(dataset)
+                    test_ok = test_ok and all(forest.delete(data) for data in dataset[:half])
+                    test_ok = test_ok and self._check_queries(forest, dataset[half:], range_queries, knn_queries)
+            return test_ok
+
+        return self._test_datasets('sharded', check)
+
+    def test_concurrent_writes(self, threads: int = 4):
+        """
+        Tests queries running in several threads while the data are being added against brute force search,
+        each query has to see the tree either before or after each insertion (a prefix of the data)
+        :param threads: number of threads querying the tree
+        :return: success
+        """
+        range_queries, knn_queries = self._read_queries()
+
+        def check(dataset):
+            half = len(dataset) // 2
+            mtree = self._init_mtree(dataset[:half], split_data_smart)
+
+            def query(_):
+                # all the objects, object ids are indices of the data
+                found = mtree.range_query(dataset[0], INFINITY)
+                oids = sorted(x.oid for x in found)
+                return oids == list(range(len(found))) and \
+                    self._same_distances(found, self._brute_force_range(dataset[:len(found)], dataset[0], INFINITY))
+
+            with futures.ThreadPoolExecutor(max_workers=threads) as executor:
+                results = executor.map(query, range(len(dataset)))
+                for data in dataset[half:]:
+                    mtree.add(data)
+                    # let the queries run between the insertions
+                    time.sleep(0.0001)
+                test_ok = all(results)
+            return test_ok and self._check_queries(mtree, dataset, range_queries, knn_queries)
+
+        return self._test_datasets('concurrent writes', check)
+
+    def test_snapshots(self):
+        """
+        Tests snapshots (MTree.snapshot()) against brute force search of the data, the tree is modified
+        after each snapshot, snapshots have to keep the data of their time, the tree has to see the changes
+        :return: success
+        """
+        range_queries, knn_queries = self._read_queries()
+
+        def check(dataset):
+            half = len(dataset) // 2
+            mtree = self._init_mtree(dataset[:half], split_data_smart)
+            # (1) data are added, (2) the older half is deleted
+            first = mtree.snapshot()
+            for data in dataset[half:]:
+                mtree.add(data)
+            second = mtree.snapshot()
+            test_ok = all(mtree.delete(data) for data in dataset[:half])
+            # snapshots are read-only
+            try:
+                first.add(dataset[0])
+                test_ok = False
+            except TypeError:
+                pass
+            return test_ok and self._check_queries(first, dataset[:half], range_queries, knn_queries) and \
+                self._check_queries(second, dataset, range_queries, knn_queries) and \
+                self._check_queries(mtree, dataset[half:], range_queries, knn_queries)
+
+        return self._test_datasets('snapshots', check)
+
+    def test_async(self):
+        """
+        Tests asyncio front-end (AsyncMTree) against brute force search of the data, all the queries are awaited
+        together, so they are coalesced into fewer batches
+        :return: success
+        """
+        range_queries, knn_queries = self._read_queries()
+
+        async def query_all(mtree):
+            async with AsyncMTree(mtree) as front_end:
+                results = await asyncio.gather(*(front_end.range_query(data, r) for r, data in range_queries),
+                                               *(front_end.knn_query(data, k) for k, data in knn_queries))
+            return results, front_end.batches
+
+        def check(dataset):
+            results, batches = asyncio.run(query_all(self._init_mtree(dataset, split_data_smart)))
+            expected = [self._brute_force_range(dataset, data, r) for r, data in range_queries] + \
+                [self._brute_force_knn(dataset, data, k) for k, data in knn_queries]
+            return batches < len(expected) and \
+                all(self._same_distances(found, distances) for found, distances in zip(results, expected))
+
+        return self._test_datasets('async', check)
+
+    def test_metrics(self):
+        """
+        Tests M-Trees using other metrics than euclidean distance (split heuristics have to use them too)
+        against brute force search of the data
+        :return: success
+        """
+        range_queries, knn_queries = self._read_queries()
+
+        def check(dataset):
+            test_ok = True
+            for dist_function in (manhattan, chebyshev):
+                for split_h in (split_data_random, split_data_smart):
+                    mtree = self._init_mtree(dataset, split_h, dist_function)
+                    test_ok = test_ok and self._check_queries(mtree, dataset, range_queries, knn_queries,
+                                                              dist_function)
+            return test_ok
+
+        return self._test_datasets('metrics', check)
+
+    def test_promotion_policies(self):
+        """
+        Tests M-Trees split by the promotion policies (m_RAD, mM_RAD, M_LB_DIST, also with sampling)
+        against brute force search of the data
+        :return: success
+        """
+        range_queries, knn_queries = self._read_queries()
+
+        def check(dataset):
+            return all(self._check_queries(self._init_mtree(dataset, split_h), dataset, range_queries, knn_queries)
+                       for split_h in (split_data_m_rad, split_data_mm_rad, split_data_m_rad_sampled,
+                                       split_data_mm_rad_sampled, split_data_m_lb_dist))
+
+        return self._test_datasets('promotion policies', check)
+
+    def test_stats(self):
+        """
+        Tests query stats, distances counted by the queries have to match the calls of the distance function,
+        the results have to match brute force search of the data
+        :return: success
+        """
+        range_queries, knn_queries = self._read_queries()
+
+        def check(dataset):
+            calls = [0]
+
+            def dist_counted(a, b):
+                calls[0] += 1
+                return dist_euclidean(a, b)
+
+            mtree = self._init_mtree(dataset, split_data_smart, dist_counted)
+            mtree.reset_stats()
+            test_ok = True
+            dist_calls = 0
+            for query, arg, data, expected in \
+                    [(mtree.range_query, r, data, self._brute_force_range(dataset, data, r))
+                     for r, data in range_queries] + \
+                    [(mtree.knn_query, k, data, self._brute_force_knn(dataset, data, k)) for k, data in knn_queries]:
+                calls[0] = 0
+                found, stats = query(data, arg, with_stats=True)
+                dist_calls += stats.dist_calls
+                test_ok = test_ok and stats.queries == 1 and stats.dist_calls == calls[0] and \
+                    self._same_distances(found, expected)
+            # cumulative stats of all the queries
+            return test_ok and mtree.stats.queries == len(range_queries) + len(knn_queries) and \
+                mtree.stats.dist_calls == dist_calls
+
+        return self._test_datasets('stats', check)
+
+    def test_batch_metrics(self):
+        """
+        Tests batch interface of the distance functions (one_to_many() & many_to_many()) against the distances
+        of the pairs, and M-Trees using them against brute force search of the data
+        :return: success
+        """
+        range_queries, knn_queries = self._read_queries()
+
+        def check(dataset):
+            test_ok = True
+            queried = [data for _, data in knn_queries]
+            for dist_function in (euclidean, manhattan, chebyshev):
+                # rows of the distances of the queried data, counted in batches & one by one
+                rows = [dist_function.one_to_many(queried[0], dataset)] + \
+                    list(dist_function.many_to_many(queried, dataset))
+                expected = [[dist_function(data, other) for other in dataset] for data in [queried[0]] + queried]
+                test_ok = test_ok and len(rows) == len(expected) and \
+                    all(len(row) == len(distances) and
+                        all(math.isclose(d, e, abs_tol=1e-9) for d, e in zip(row, distances))
+                        for row, distances in zip(rows, expected))
+                mtree = self._init_mtree(dataset, split_data_smart, dist_function)
+                test_ok = test_ok and self._check_queries(mtree, dataset, range_queries, knn_queries, dist_function)
+            return test_ok
+
+        return self._test_datasets('batch metrics', check)
+
+    def test_limited_range(self, k: int = 10):
+        """
+        Tests range queries limited to k closest objects (collected in a heap) against brute force search of the data
+        :param k: maximum number of objects found by a query
+        :return: success
+        """
+        range_queries, _ = self._read_queries()
+
+        def check(dataset):
+            mtree = self._init_mtree(dataset, split_data_smart)
+            return all(self._same_distances(mtree.range_query(data, r, k),
+                                            self._brute_force_range(dataset, data, r)[:k])
+                       for r, data in range_queries)
+
+        return self._test_datasets('limited range', check)
+
+    def test_payloads(self):
+        """
+        Tests object ids & payloads returned by the queries (added one by one & bulk-loaded),
+        the objects have to match brute force search of the data
+        :return: success
+        """
+        range_queries, knn_queries = self._read_queries()
+
+        def check(dataset):
+            half = len(dataset) // 2
+            mtree = MTree.bulk_load(dataset[:half], split_function=split_data_smart,
+                                    payloads=(f'payload {oid}' for oid in range(half)))
+            for oid in range(half, len(dataset)):
+                mtree.add(dataset[oid], payload=f'payload {oid}')
+            test_ok = self._check_queries(mtree, dataset, range_queries, knn_queries)
+            # ids are indices of the data
+            for r, data in range_queries:
+                test_ok = test_ok and all(found.data == dataset[found.oid] and found.payload == f'payload {found.oid}'
+                                          for found in mtree.range_query(data, r))
+            return test_ok
+
+        return self._test_datasets('payloads', check)
+
     def time_test_all(self):
         """
         Repeatedly tries all split heuristics, measures time of insertion and queries
         """
         self._logger.info('testing time performance..\n')
-        # test all 3 heuristics
+        # test all heuristics
         self._time_test_heuristic(split_data_random)
         self._time_test_heuristic(split_data_perfect)
         self._time_test_heuristic(split_data_smart)
+        self._time_test_heuristic(split_data_m_rad)
+        self._time_test_heuristic(split_data_mm_rad)
+        self._time_test_heuristic(split_data_m_rad_sampled)
+        self._time_test_heuristic(split_data_mm_rad_sampled)
+        self._time_test_heuristic(split_data_m_lb_dist)
 
     def time_test_random(self):
         """
@@ -132,11 +818,73 @@ class Tester:
             _, t_query = self._measure_time(self._query_tree, mtree)
             t_query_sum += t_query
             self._logger.debug(f'time test QUERY {i}:  {t_query:.4f}s\n')
+            self._logger.debug(f'query stats {i}: {mtree.stats}\n')
         # return average times
         t_add_avg, t_query_avg = t_add_sum / TESTS_NUM, t_query_sum / TESTS_NUM
         self._logger.info(f'TIME TEST RESULT: add: {t_add_avg:.4f}s, query: {t_query_avg:.4f}s\n')
         return t_add_avg, t_query_avg
 
+    def memory_test(self, split_h=split_data_smart) -> float:
+        """
+        Measures memory occupied by the M-Tree structures (entries & nodes), data objects themselves are not counted
+        :param split_h: split heuristic function
+        :return: average number of bytes per indexed object
+        """
+        bytes_sum, objects_sum = 0, 0
+        fng_add = Generator().data_file_name_generator()
+        for i in range(TESTS_NUM):
+            # read the data before the tracing starts
+            dataset = list(parser.read_dataset(PATH_TEST + next(fng_add)))
+            gc.collect()
+            tracemalloc.start()
+            mtree = self._init_mtree(dataset, split_h)
+            gc.collect()
+            size, _ = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            bytes_sum += size
+            objects_sum += len(dataset)
+            self._logger.debug(f'memory test {i}: {size / len(dataset):.1f}B per object\n')
+            del mtree
+        bytes_avg = bytes_sum / objects_sum
+        self._logger.info(f'MEMORY TEST RESULT: {bytes_avg:.1f}B per object\n')
+        return bytes_avg
+
+    @_run_as_worker
+    def time_test_bulk_load(self, split_h=split_data_smart) -> (float, float):
+        """
+        Compares MTree.bulk_load() with adding the data one by one, measures build time, distance calls
+        of the build and distance calls of the same queries on both trees
+        :param split_h: split heuristic function
+        :return: bulk load average time, insertion average time
+        """
+        t_bulk_sum, t_add_sum = 0, 0
+        calls_bulk, calls_add = 0, 0
+        queries_bulk, queries_add = 0, 0
+        fng_add = Generator().data_file_name_generator()
+        for i in range(TESTS_NUM):
+            dataset = list(parser.read_dataset(PATH_TEST + next(fng_add)))
+            # (1) bulk load
+            counter = DistanceCounter(dist_euclidean)
+            bulk, t_bulk = self._measure_time(MTree.bulk_load, dataset, dist_function=counter, split_function=split_h)
+            t_bulk_sum += t_bulk
+            calls_bulk += counter.count
+            # (2) one by one
+            counter = DistanceCounter(dist_euclidean)
+            mtree, t_add = self._measure_time(self._init_mtree, dataset, split_h, counter)
+            t_add_sum += t_add
+            calls_add += counter.count
+            self._logger.debug(f'bulk load test {i}: bulk {t_bulk:.4f}s | add {t_add:.4f}s\n')
+            # (3) the same queries on both trees
+            self._query_tree(bulk)
+            self._query_tree(mtree)
+            queries_bulk += bulk.stats.dist_calls
+            queries_add += mtree.stats.dist_calls
+        t_bulk_avg, t_add_avg = t_bulk_sum / TESTS_NUM, t_add_sum / TESTS_NUM
+        self._logger.info(f'BULK LOAD TEST RESULT: build: {t_bulk_avg:.4f}s vs {t_add_avg:.4f}s, '
+                          f'build distances: {calls_bulk // TESTS_NUM} vs {calls_add // TESTS_NUM}, '
+                          f'query distances: {queries_bulk // TESTS_NUM} vs {queries_add // TESTS_NUM}\n')
+        return t_bulk_avg, t_add_avg
+
     @staticmethod
     def _query_tree(tree: MTree):
         """
@@ -160,19 +908,112 @@ class Tester:
                 tree.knn_query(data, k)
 
     @staticmethod
-    def _init_mtree(data_it, split_h):
+    def _init_mtree(data_it, split_h, dist_function=dist_euclidean):
         """
         Initializes M-Tree with data
         :param data_it: iterator to the data
         :param split_h: split heuristic function
+        :param dist_function: metrics of the tree
         :return: new M-Tree
         """
-        mtree = MTree(split_function=split_h)
+        mtree = MTree(dist_function=dist_function, split_function=split_h)
         # add data one by one
         for data in data_it:
             mtree.add(data)
         return mtree
 
+    def _test_datasets(self, name: str, check) -> bool:
+        """
+        Runs a check on each of the test datasets, logs the results
+        :param name: name of the test
+        :param check: function taking the dataset (list of data), returns success
+        :return: success of all the checks
+        """
+        success = True
+        self._logger.info(f'Testing {name}\n')
+        fng = Generator().data_file_name_generator()
+        for i in range(TESTS_NUM):
+            test_ok = check(list(parser.read_dataset(PATH_TEST + next(fng))))
+            success = success and test_ok
+            self._logger.debug(f'{name} test {i}: {test_ok}\n')
+        self._logger.info(f'TEST RESULT - {name}: {self._get_result_str(success)}\n')
+        return success
+
+    def _check_queries(self, tree, dataset, range_queries, knn_queries, dist_function=dist_euclidean) -> bool:
+        """
+        Compares results of range & knn queries of the tree with brute force search of the data
+        :param tree: tree to be queried (anything with range_query() & knn_query())
+        :param dataset: list of all the data stored in the tree
+        :param range_queries: list of (range, data) pairs
+        :param knn_queries: list of (k, data) pairs
+        :param dist_function: metrics of the tree
+        :return: success
+        """
+        return all(self._same_distances(tree.range_query(data, r),
+                                        self._brute_force_range(dataset, data, r, dist_function))
+                   for r, data in range_queries) and \
+            all(self._same_distances(tree.knn_query(data, k), self._brute_force_knn(dataset, data, k, dist_function))
+                for k, data in knn_queries)
+
+    def _check_queries_many(self, tree, dataset, range_queries, knn_queries) -> bool:
+        """
+        Compares results of batch range & knn queries of the tree with brute force search of the data,
+        queries of the same range (k) are run in one batch
+        :param tree: tree to be queried (anything with range_query_many() & knn_query_many())
+        :param dataset: list of all the data stored in the tree
+        :param range_queries: list of (range, data) pairs
+        :param knn_queries: list of (k, data) pairs
+        :return: success
+        """
+        for queries, query_many, brute_force in ((range_queries, tree.range_query_many, self._brute_force_range),
+                                                 (knn_queries, tree.knn_query_many, self._brute_force_knn)):
+            # range (k) -> all the queried data
+            batches = {}
+            for arg, data in queries:
+                batches.setdefault(arg, []).append(data)
+            for arg, batch in batches.items():
+                results = query_many(batch, arg)
+                if len(results) != len(batch) or \
+                        not all(self._same_distances(found, brute_force(dataset, data, arg))
+                                for found, data in zip(results, batch)):
+                    return False
+        return True
+
+    @staticmethod
+    def _read_queries() -> (list, list):
+        """
+        :return: list of (range, data) pairs of all the range queries, list of (k, data) pairs of all the knn queries
+        """
+        fng_r_q = Generator().range_q_file_name_generator()
+        fng_knn_q = Generator().knn_q_file_name_generator()
+        range_queries = [query for _ in range(QUERY_NUM)
+                         for query in parser.read_query_range(PATH_TEST + next(fng_r_q))]
+        knn_queries = [query for _ in range(QUERY_NUM) for query in parser.read_query_knn(PATH_TEST + next(fng_knn_q))]
+        return range_queries, knn_queries
+
+    @staticmethod
+    def _brute_force_range(dataset, data, r, dist_function=dist_euclidean) -> list:
+        """
+        :return: sorted distances of all the objects within the range from the data
+        """
+        return sorted(d for d in (dist_function(data, other) for other in dataset) if d <= r)
+
+    @staticmethod
+    def _brute_force_knn(dataset, data, k, dist_function=dist_euclidean) -> list:
+        """
+        :return: sorted distances of k objects closest to the data
+        """
+        return sorted(dist_function(data, other) for other in dataset)[:k]
+
+    @staticmethod
+    def _same_distances(found, expected) -> bool:
+        """
+        :param found: query result (sorted objects with distances)
+        :param expected: sorted distances found by brute force (objects of equal distance may differ)
+        :return: True when the distances are the same
+        """
+        return len(found) == len(expected) and all(math.isclose(x.d, d, abs_tol=1e-9) for x, d in zip(found, expected))
+
     @staticmethod
     def _measure_time(f, *args, **kwargs):
         """
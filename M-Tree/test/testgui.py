@@ -47,8 +47,29 @@ class TestGUI:
         Entry(self._window, state='readonly', textvariable=self._smart_query).grid(row=3, column=3)
         Button(self._window, text='smart split test', width=15, command=self._on_smart).grid(row=3, column=4)
 
+        # bulk load stuff
+        Label(self._window, text='  bulk load time: ').grid(row=4, column=0)
+        self._bulk_load = StringVar()
+        Entry(self._window, state='readonly', textvariable=self._bulk_load).grid(row=4, column=1)
+        Label(self._window, text='  insertion time: ').grid(row=4, column=2)
+        self._bulk_insert = StringVar()
+        Entry(self._window, state='readonly', textvariable=self._bulk_insert).grid(row=4, column=3)
+        Button(self._window, text='bulk load test', width=15, command=self._on_bulk_load).grid(row=4, column=4)
+
+        # memory stuff
+        Label(self._window, text='  bytes per object: ').grid(row=5, column=0)
+        self._memory = StringVar()
+        Entry(self._window, state='readonly', textvariable=self._memory).grid(row=5, column=1)
+        Button(self._window, text='memory test', width=15, command=self._on_memory).grid(row=5, column=4)
+
+        # all the checks (compared with brute force search)
+        Label(self._window, text='  failed tests: ').grid(row=6, column=0)
+        self._checks = StringVar()
+        Entry(self._window, state='readonly', textvariable=self._checks).grid(row=6, column=1, columnspan=3, sticky=W+E)
+        Button(self._window, text='run all tests', width=15, command=self._on_checks).grid(row=6, column=4)
+
         # generate data button
-        Button(self._window, text='generate new data', width=15, command=self._on_generate).grid(row=4, column=4)
+        Button(self._window, text='generate new data', width=15, command=self._on_generate).grid(row=7, column=4)
 
     def go(self):
         """
@@ -105,6 +126,50 @@ class TestGUI:
         self._smart_insert.set(f'{t_insert:.5f}')
         self._smart_query.set(f'{t_query:.5f}')
 
+    def _on_bulk_load(self):
+        """
+        Bulk load time test action button
+        """
+        if not self._check_data():
+            return
+
+        # show the test is running
+        self._set_running(self._bulk_load)
+        self._set_running(self._bulk_insert)
+        # run the test
+        t_bulk, t_insert = self._tester.time_test_bulk_load()
+        # show the results
+        self._bulk_load.set(f'{t_bulk:.5f}')
+        self._bulk_insert.set(f'{t_insert:.5f}')
+
+    def _on_memory(self):
+        """
+        Memory test action button
+        """
+        if not self._check_data():
+            return
+
+        # show the test is running
+        self._set_running(self._memory)
+        # run the test
+        bytes_avg = self._tester.memory_test()
+        # show the result
+        self._memory.set(f'{bytes_avg:.1f}')
+
+    def _on_checks(self):
+        """
+        All tests action button
+        """
+        if not self._check_data():
+            return
+
+        # show the tests are running
+        self._set_running(self._checks)
+        # run the tests
+        failed = self._tester.test_all()
+        # show names of the failed tests
+        self._checks.set(', '.join(failed) if len(failed) > 0 else 'none')
+
     def _on_generate(self):
         """
         Generates new test data
@@ -118,6 +183,10 @@ class TestGUI:
         self._clear_input(self._perfect_query)
         self._clear_input(self._smart_insert)
         self._clear_input(self._smart_query)
+        self._clear_input(self._bulk_load)
+        self._clear_input(self._bulk_insert)
+        self._clear_input(self._memory)
+        self._clear_input(self._checks)
 
     @staticmethod
     def _clear_input(entry: StringVar):